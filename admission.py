@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Optional
+
+from pricing import load_model_list
+
+logger = logging.getLogger("litellm-proxy")
+
+# Per-upstream admission control
+#
+# Each model with max_concurrency in its config.yaml model_info gets a
+# limiter: up to max_concurrency calls run at once, up to max_queue more
+# wait in FIFO order for at most queue_timeout seconds. A request that finds
+# the queue full is rejected at once with 429; one that waits past its
+# deadline gets 503. Both carry Retry-After. Models without limits are
+# admitted without bookkeeping.
+#
+# Limiters are used from the event loop only, so they need no locks.
+
+DEFAULT_QUEUE_TIMEOUT = 30.0
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {"Retry-After": str(max(1, int(round(self.retry_after))))}
+
+class UpstreamLimiter:
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float = DEFAULT_QUEUE_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters: "deque[asyncio.Future]" = deque()
+        self.counters = {"admitted": 0, "queued_total": 0, "rejected_full": 0, "rejected_timeout": 0}
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def try_acquire(self) -> bool:
+        """Take a free slot without queueing; False if none is free"""
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            self.counters["admitted"] += 1
+            return True
+        return False
+
+    async def acquire(self):
+        """Take a slot, waiting in the queue if needed; raises AdmissionRejected"""
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            self.counters["admitted"] += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.counters["rejected_full"] += 1
+            raise AdmissionRejected(429, "Upstream queue is full", self.queue_timeout)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.counters["queued_total"] += 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the deadline passed; give it back
+                self.release()
+            else:
+                waiter.cancel()
+            self.counters["rejected_timeout"] += 1
+            raise AdmissionRejected(503, "Upstream queue deadline exceeded", self.queue_timeout)
+        except asyncio.CancelledError:
+            # Client went away while queued
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                waiter.cancel()
+            raise
+        finally:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+        waited = time.monotonic() - started
+        self.queue_wait_total += waited
+        self.queue_wait_max = max(self.queue_wait_max, waited)
+        self.counters["admitted"] += 1
+
+    def release(self):
+        """Free a slot, handing it straight to the oldest live waiter"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # The slot moves to the waiter; active stays the same
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def metrics(self) -> Dict[str, Any]:
+        waited = self.counters["queued_total"] - self.counters["rejected_timeout"]
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "queue_timeout": self.queue_timeout,
+            "active": self.active,
+            "queued": self.queued,
+            **self.counters,
+            "queue_wait_avg": self.queue_wait_total / waited if waited > 0 else 0.0,
+            "queue_wait_max": self.queue_wait_max,
+        }
+
+class AdmissionController:
+    def __init__(self, limiters: Dict[str, UpstreamLimiter]):
+        self.limiters = limiters
+
+    async def acquire(self, model: Optional[str]) -> Optional[Callable[[], None]]:
+        """Admit a call to model; returns the function that frees its slot (None if unlimited)"""
+        limiter = self.limiters.get(model)
+        if limiter is None:
+            return None
+        await limiter.acquire()
+        return _releaser(limiter)
+
+    def try_acquire(self, model: Optional[str]) -> Optional[Callable[[], None]]:
+        """Take a free slot for model without queueing
+
+        Returns the function that frees it (a no-op for unlimited models),
+        or None if the model is at its limit.
+        """
+        limiter = self.limiters.get(model)
+        if limiter is None:
+            return lambda: None
+        if not limiter.try_acquire():
+            return None
+        return _releaser(limiter)
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        return {model: limiter.metrics() for model, limiter in self.limiters.items()}
+
+def _releaser(limiter: UpstreamLimiter) -> Callable[[], None]:
+    # Frees the slot once, however many times it is called
+    released = False
+
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            limiter.release()
+
+    return release
+
+def load_admission_limits(config_path: str) -> AdmissionController:
+    """Limiters from model_list[].model_info (max_concurrency, max_queue, queue_timeout)"""
+    limiters = {}
+    for entry in load_model_list(config_path):
+        info = entry.get("model_info") or {}
+        if not entry.get("model_name") or not info.get("max_concurrency"):
+            continue
+        max_concurrency = int(info["max_concurrency"])
+        limiters[entry["model_name"]] = UpstreamLimiter(
+            max_concurrency,
+            int(info.get("max_queue", max_concurrency * 2)),
+            float(info.get("queue_timeout", DEFAULT_QUEUE_TIMEOUT)),
+        )
+    return AdmissionController(limiters)
@@ -0,0 +1,311 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional
+
+# Offline replay benchmark for the routing path
+#
+# Replays a JSONL corpus of recorded requests through route_request, the
+# ModelRouterMiddleware (with a stub downstream app, so no model is called)
+# and PII masking, and reports throughput, p50/p99 latency per stage and
+# the distribution of routed models. The stream_ttfb stage times the first
+# byte of a streamed (SSE) response through the middleware, with masking of
+# streamed responses enabled. Results can be saved as a baseline
+# and later runs compared against it to catch regressions between commits.
+#
+# Each corpus line is either a chat completion body ({"messages": ...}),
+# {"request": {...}}, or a text record ({"title": ..., "body": ...} /
+# {"text": ...}) that is replayed as a single user message.
+
+def load_corpus(path: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    requests = []
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "request" in record:
+                record = record["request"]
+            if "messages" not in record:
+                text = "\n\n".join(str(record[field]) for field in ("title", "body", "text", "prompt") if record.get(field))
+                record = {"messages": [{"role": "user", "content": text}]}
+            request = dict(record)
+            request.setdefault("model", "auto")
+            requests.append(request)
+            if limit and len(requests) >= limit:
+                break
+    return requests
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+def summarize(durations: List[float]) -> Dict[str, float]:
+    """Throughput and latency percentiles (microseconds) for one stage"""
+    values = sorted(durations)
+    total = sum(values)
+    return {
+        "requests": len(values),
+        "total_seconds": total,
+        "throughput_rps": len(values) / total if total else 0.0,
+        "p50_us": percentile(values, 0.50) * 1e6,
+        "p99_us": percentile(values, 0.99) * 1e6,
+        "max_us": (values[-1] if values else 0.0) * 1e6,
+    }
+
+def time_each(func: Callable[[Dict[str, Any]], Any], requests: List[Dict[str, Any]], passes: int) -> List[float]:
+    durations = []
+    for _ in range(passes):
+        for request in requests:
+            start = time.perf_counter()
+            func(request)
+            durations.append(time.perf_counter() - start)
+    return durations
+
+def bench_route_request(requests, passes):
+    from model_router import route_request, routing_cache
+
+    # First pass runs against an empty routing cache
+    routing_cache.invalidate()
+    models = Counter(route_request(request)["model"] for request in requests)
+    routing_cache.invalidate()
+    return time_each(route_request, requests, passes), dict(models.most_common())
+
+def bench_masking(requests, passes, config_path):
+    from pii_masker import create_masker
+
+    masker = create_masker(config_path)
+
+    def mask_request(request):
+        for message in request.get("messages") or []:
+            content = message.get("content")
+            if isinstance(content, str):
+                masker.mask(content)
+
+    return time_each(mask_request, requests, passes)
+
+def bench_middleware(requests, passes):
+    from middleware import ModelRouterMiddleware
+    from model_router import routing_cache
+
+    async def downstream(scope, receive, send):
+        # Stub for the LiteLLM endpoint: read the (rewritten) body and answer 200
+        await _read_request(receive)
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    middleware = ModelRouterMiddleware(downstream)
+    bodies = [json.dumps(request).encode() for request in requests]
+
+    async def run():
+        routing_cache.invalidate()
+        durations = []
+        for _ in range(passes):
+            for body in bodies:
+                start = time.perf_counter()
+                await _replay(middleware, body)
+                durations.append(time.perf_counter() - start)
+        return durations
+
+    return asyncio.run(run())
+
+# A streamed completion as the stub upstream sends it: one SSE event per body message
+_STREAM_EVENTS = [
+    b'data: {"id":"bench","object":"chat.completion.chunk","choices":[{"index":0,"delta":{"content":"token %d "},"finish_reason":null}]}\n\n' % i
+    for i in range(32)
+] + [b"data: [DONE]\n\n"]
+
+def bench_stream_ttfb(requests, passes, config_path):
+    from middleware import ModelRouterMiddleware
+    from model_router import routing_cache
+    from pii_masker import create_masker
+
+    async def downstream(scope, receive, send):
+        # Stub for a streaming LiteLLM endpoint
+        await _read_request(receive)
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/event-stream")]})
+        for event in _STREAM_EVENTS:
+            await send({"type": "http.response.body", "body": event, "more_body": True})
+            await asyncio.sleep(0)
+        await send({"type": "http.response.body", "body": b""})
+
+    middleware = ModelRouterMiddleware(downstream, response_masker=create_masker(config_path))
+    bodies = [json.dumps(dict(request, stream=True)).encode() for request in requests]
+
+    async def run():
+        routing_cache.invalidate()
+        durations = []
+        for _ in range(passes):
+            for body in bodies:
+                durations.append(await _replay(middleware, body, first_byte=True))
+        return durations
+
+    return asyncio.run(run())
+
+async def _read_request(receive):
+    more_body = True
+    while more_body:
+        message = await receive()
+        more_body = message.get("more_body", False)
+
+async def _replay(app, body: bytes, first_byte: bool = False) -> float:
+    # One POST /v1/chat/completions through app; seconds until the response
+    # (or, with first_byte, its first non-empty body chunk) was sent
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/v1/chat/completions",
+        "raw_path": b"/v1/chat/completions",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 0),
+        "server": ("127.0.0.1", 80),
+    }
+    received = False
+    response_complete = asyncio.Event()
+    start = time.perf_counter()
+    first_body = None
+
+    async def receive():
+        nonlocal received
+        if received:
+            # Like the client hanging up once the whole response has arrived
+            await response_complete.wait()
+            return {"type": "http.disconnect"}
+        received = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        nonlocal first_body
+        if message["type"] != "http.response.body":
+            return
+        if first_body is None and message.get("body"):
+            first_body = time.perf_counter()
+        if not message.get("more_body", False):
+            response_complete.set()
+
+    await app(scope, receive, send)
+    end = first_body if first_byte and first_body is not None else time.perf_counter()
+    return end - start
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(corpus_path: str, passes: int = 3, limit: Optional[int] = None, stages: Optional[List[str]] = None,
+        config_path: str = "config.yaml") -> Dict[str, Any]:
+    requests = load_corpus(corpus_path, limit)
+    with open(corpus_path, "rb") as f:
+        corpus_hash = hashlib.sha256(f.read()).hexdigest()[:16]
+
+    stages = stages or ["route_request", "middleware", "stream_ttfb", "mask_pii"]
+    results: Dict[str, Any] = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "corpus": {"path": corpus_path, "requests": len(requests), "sha256": corpus_hash},
+        "passes": passes,
+        "stages": {},
+        "skipped": {},
+    }
+    if "route_request" in stages:
+        durations, models = bench_route_request(requests, passes)
+        results["stages"]["route_request"] = summarize(durations)
+        results["models"] = models
+    if "middleware" in stages:
+        try:
+            results["stages"]["middleware"] = summarize(bench_middleware(requests, passes))
+        except ImportError as e:
+            results["skipped"]["middleware"] = f"missing dependency: {e.name}"
+    if "stream_ttfb" in stages:
+        try:
+            results["stages"]["stream_ttfb"] = summarize(bench_stream_ttfb(requests, passes, config_path))
+        except ImportError as e:
+            results["skipped"]["stream_ttfb"] = f"missing dependency: {e.name}"
+    if "mask_pii" in stages:
+        results["stages"]["mask_pii"] = summarize(bench_masking(requests, passes, config_path))
+    return results
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float, p99_threshold: float) -> List[str]:
+    """Regressions beyond threshold (fraction) in p50/p99 or throughput, and routing changes"""
+    regressions = []
+    for stage, current in results["stages"].items():
+        previous = baseline.get("stages", {}).get(stage)
+        if not previous:
+            continue
+        # Tail latencies of microsecond stages are noisy; they get their own threshold
+        for metric, allowed in (("p50_us", threshold), ("p99_us", p99_threshold)):
+            if previous[metric] and current[metric] > previous[metric] * (1 + allowed):
+                regressions.append(f"{stage} {metric}: {previous[metric]:.1f} -> {current[metric]:.1f}")
+        if previous["throughput_rps"] and current["throughput_rps"] < previous["throughput_rps"] * (1 - threshold):
+            regressions.append(f"{stage} throughput_rps: {previous['throughput_rps']:.0f} -> {current['throughput_rps']:.0f}")
+    if baseline.get("corpus", {}).get("sha256") == results["corpus"]["sha256"] and baseline.get("models") != results.get("models"):
+        regressions.append(f"model distribution changed: {baseline.get('models')} -> {results.get('models')}")
+    return regressions
+
+def print_report(results: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None):
+    corpus = results["corpus"]
+    print(f"corpus {corpus['path']} ({corpus['requests']} requests x {results['passes']} passes) at {results['revision'] or 'unknown revision'}")
+    print(f"{'stage':15s} {'req/s':>10s} {'p50 us':>10s} {'p99 us':>10s} {'max us':>10s}")
+    for stage, summary in results["stages"].items():
+        line = f"{stage:15s} {summary['throughput_rps']:10.0f} {summary['p50_us']:10.1f} {summary['p99_us']:10.1f} {summary['max_us']:10.1f}"
+        previous = (baseline or {}).get("stages", {}).get(stage)
+        if previous and previous["p50_us"]:
+            line += f"   p50 {(summary['p50_us'] / previous['p50_us'] - 1) * 100:+.1f}% vs {baseline.get('revision') or 'baseline'}"
+        print(line)
+    for stage, reason in results["skipped"].items():
+        print(f"{stage:15s} skipped ({reason})")
+    if results.get("models"):
+        total = sum(results["models"].values())
+        print("models: " + ", ".join(f"{model} {count / total:.1%}" for model, count in results["models"].items()))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(description="Replay a request corpus through the routing path")
+    parser.add_argument("corpus", nargs="?", default="requests.jsonl", help="JSONL corpus of recorded requests")
+    parser.add_argument("--passes", type=int, default=3, help="Times to replay the corpus (the first pass starts with an empty routing cache)")
+    parser.add_argument("--limit", type=int, default=None, help="Only replay the first N requests")
+    parser.add_argument("--stage", action="append", choices=["route_request", "middleware", "stream_ttfb", "mask_pii"], help="Stage to run (repeatable; default all)")
+    parser.add_argument("--config", type=str, default=os.environ.get("CONFIG_FILE", "config.yaml"), help="config.yaml for PII masking patterns")
+    parser.add_argument("--save", type=str, default=None, help="Write the results to this baseline file")
+    parser.add_argument("--compare", type=str, default=None, help="Compare with a saved baseline; exit 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.15, help="Allowed p50 / throughput slowdown before a stage counts as regressed (fraction)")
+    parser.add_argument("--p99-threshold", type=float, default=0.5, help="Allowed p99 slowdown (fraction)")
+
+    args = parser.parse_args()
+    results = run(args.corpus, passes=args.passes, limit=args.limit, stages=args.stage, config_path=args.config)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"saved baseline to {args.save}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold, args.p99_threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
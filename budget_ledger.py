@@ -0,0 +1,193 @@
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+# In-memory budget ledger
+#
+# Each request reserves its estimated cost before it is sent upstream, so
+# concurrent requests on one key cannot overshoot max_budget while their
+# usage is still in flight. When the completion callback reports the real
+# cost the reservation is settled: the estimate is dropped and the actual
+# cost is held as "pending" until the usage writer has added it to the key
+# balance. Failed requests simply release their reservation.
+#
+# Keys are spread over independently locked shards so requests on
+# different keys never contend on the same lock.
+#
+# With a SharedCounters instance (shared_state.py) every change to a key's
+# reserved, pending and spent totals is mirrored into shared counters, and
+# budget checks use the shared totals, so several workers or machines
+# enforce one budget together. Shared totals lag other workers by at most
+# the counters' flush interval plus max staleness.
+
+# Shared counter names
+SPENT_PREFIX = "budget:spent:"
+RESERVED_PREFIX = "budget:reserved:"
+PENDING_PREFIX = "budget:pending:"
+class _Shard:
+    __slots__ = ("lock", "reserved", "pending", "reservations", "operations")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reserved: Dict[str, float] = {}
+        self.pending: Dict[str, float] = {}
+        # reservation id -> (key, amount, expires at)
+        self.reservations: Dict[str, Tuple[str, float, float]] = {}
+        self.operations = 0
+
+class BudgetLedger:
+    def __init__(self, shards: int = 64, reservation_ttl: float = 600.0, sweep_every: int = 1024, shared=None):
+        self._shards = [_Shard() for _ in range(shards)]
+        self.shared = shared
+        self.reservation_ttl = reservation_ttl
+        self.sweep_every = sweep_every
+        self._stats_lock = threading.Lock()
+        self.stats = {"reserved": 0, "rejected": 0, "settled": 0, "released": 0, "expired": 0}
+
+    def _shard_for_key(self, key: str) -> _Shard:
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _shard_for_reservation(self, reservation_id: str) -> _Shard:
+        # Reservation ids are prefixed with their shard number
+        return self._shards[int(reservation_id.split(":", 1)[0])]
+
+    def reserve(self, key: str, amount: float, spent: float, max_budget: Optional[float]) -> Optional[str]:
+        """Reserve amount for key, or return None if it would exceed max_budget"""
+        index = hash(key) % len(self._shards)
+        shard = self._shards[index]
+        now = time.monotonic()
+        with shard.lock:
+            self._maybe_sweep(shard, now)
+            if max_budget and self._spent(key, spent) + self._outstanding(shard, key) + amount > max_budget:
+                rejected = True
+            else:
+                rejected = False
+                reservation_id = f"{index}:{uuid.uuid4().hex}"
+                shard.reserved[key] = shard.reserved.get(key, 0.0) + amount
+                shard.reservations[reservation_id] = (key, amount, now + self.reservation_ttl)
+                if self.shared is not None:
+                    self.shared.add(RESERVED_PREFIX + key, amount)
+        self._count("rejected" if rejected else "reserved")
+        return None if rejected else reservation_id
+
+    def settle(self, key: str, cost: float, reservation_id: Optional[str] = None):
+        """Replace a reservation with the actual cost until it reaches the key balance"""
+        shard = self._shard_for_key(key)
+        with shard.lock:
+            shard.pending[key] = shard.pending.get(key, 0.0) + cost
+        if self.shared is not None:
+            self.shared.add(PENDING_PREFIX + key, cost)
+        if reservation_id:
+            self._drop(reservation_id, "settled")
+
+    def applied(self, key: str, cost: float):
+        """The usage writer added cost to the key balance; stop counting it as pending"""
+        shard = self._shard_for_key(key)
+        with shard.lock:
+            remaining = shard.pending.get(key, 0.0) - cost
+            if remaining > 1e-12:
+                shard.pending[key] = remaining
+            else:
+                shard.pending.pop(key, None)
+        if self.shared is not None:
+            self.shared.add(PENDING_PREFIX + key, -cost)
+            self.shared.add(SPENT_PREFIX + key, cost)
+
+    def release(self, reservation_id: Optional[str]):
+        """Give back a reservation whose request failed"""
+        if reservation_id:
+            self._drop(reservation_id, "released")
+
+    def outstanding(self, key: str) -> float:
+        """Reserved plus pending cost for key that is not yet in its balance"""
+        shard = self._shard_for_key(key)
+        with shard.lock:
+            return self._outstanding(shard, key)
+
+    def spent(self, key: str, local_spent: float) -> float:
+        """Balance of key, using the shared total when one is configured"""
+        return self._spent(key, local_spent)
+
+    async def seed_balances(self, balances: Dict[str, float]):
+        """Initialise shared balances from persisted key usage (existing totals win)
+
+        Also starts tracking the keys' shared reserved/pending totals, so the
+        first budget check on this worker already sees other workers' requests.
+        """
+        if self.shared is not None:
+            counters = {}
+            for key, value in balances.items():
+                counters[SPENT_PREFIX + key] = value
+                counters[RESERVED_PREFIX + key] = 0.0
+                counters[PENDING_PREFIX + key] = 0.0
+            await self.shared.seed(counters)
+
+    def shared_balances(self) -> List[Tuple[str, float]]:
+        """(key, shared balance) for every key whose balance this worker tracks"""
+        if self.shared is None:
+            return []
+        return self.shared.cached_items(SPENT_PREFIX)
+
+    def _spent(self, key: str, local_spent: float) -> float:
+        if self.shared is None:
+            return local_spent
+        # The local balance already includes this worker's applied usage
+        return max(local_spent, self.shared.get(SPENT_PREFIX + key))
+
+    def _outstanding(self, shard: _Shard, key: str) -> float:
+        # Caller holds shard.lock
+        if self.shared is not None:
+            return self.shared.get(RESERVED_PREFIX + key) + self.shared.get(PENDING_PREFIX + key)
+        return shard.reserved.get(key, 0.0) + shard.pending.get(key, 0.0)
+
+    def metrics(self) -> Dict:
+        with self._stats_lock:
+            metrics = dict(self.stats)
+        open_reservations = 0
+        reserved_total = 0.0
+        for shard in self._shards:
+            with shard.lock:
+                open_reservations += len(shard.reservations)
+                reserved_total += sum(shard.reserved.values())
+        metrics["open_reservations"] = open_reservations
+        metrics["reserved_total"] = reserved_total
+        return metrics
+
+    def _drop(self, reservation_id: str, outcome: str):
+        try:
+            shard = self._shard_for_reservation(reservation_id)
+        except (ValueError, IndexError):
+            return
+        with shard.lock:
+            entry = shard.reservations.pop(reservation_id, None)
+            if entry is not None:
+                self._unreserve(shard, entry[0], entry[1])
+        if entry is not None:
+            self._count(outcome)
+
+    def _unreserve(self, shard: _Shard, key: str, amount: float):
+        remaining = shard.reserved.get(key, 0.0) - amount
+        if remaining > 1e-12:
+            shard.reserved[key] = remaining
+        else:
+            shard.reserved.pop(key, None)
+        if self.shared is not None:
+            self.shared.add(RESERVED_PREFIX + key, -amount)
+
+    def _maybe_sweep(self, shard: _Shard, now: float):
+        # Drop reservations whose request never reported back (caller holds shard.lock)
+        shard.operations += 1
+        if shard.operations % self.sweep_every:
+            return
+        expired = [rid for rid, entry in shard.reservations.items() if entry[2] < now]
+        for rid in expired:
+            key, amount, _ = shard.reservations.pop(rid)
+            self._unreserve(shard, key, amount)
+        if expired:
+            with self._stats_lock:
+                self.stats["expired"] += len(expired)
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self.stats[name] += 1
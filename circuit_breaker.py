@@ -0,0 +1,194 @@
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+# Circuit breakers per model deployment
+#
+# Outcomes of upstream calls (from the completion callbacks) are kept for
+# the last window seconds. When at least min_requests calls were made and
+# the share of errors and timeouts reaches failure_threshold, the breaker
+# opens: the router and the fallback logic skip the model without calling
+# it. After open_seconds the breaker goes half-open and lets
+# half_open_probes calls through; a successful probe closes it, a failed
+# one opens it again. Probes that never report back (e.g. the request was
+# rejected before reaching the model) are forgotten after open_seconds.
+#
+# Only failures that say something about the upstream count: timeouts,
+# connection errors, rate limiting (429) and 5xx responses. Bad requests
+# and the like are the caller's problem.
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+def is_upstream_failure(exception: Optional[BaseException]) -> bool:
+    """True for failures that count against a deployment"""
+    if exception is None:
+        return True
+    status_code = getattr(exception, "status_code", None)
+    if status_code is None:
+        # Timeouts, connection errors and other transport failures
+        return True
+    return status_code in (408, 429) or status_code >= 500
+
+def is_timeout(exception: Optional[BaseException]) -> bool:
+    return exception is not None and (
+        isinstance(exception, TimeoutError) or "timeout" in type(exception).__name__.lower()
+        or getattr(exception, "status_code", None) == 408
+    )
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: float = 0.5, min_requests: int = 5, window: float = 60.0,
+                 open_seconds: float = 30.0, half_open_probes: int = 1):
+        self.failure_threshold = failure_threshold
+        self.min_requests = min_requests
+        self.window = window
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.times_opened = 0
+        # (time, outcome) with outcome "success", "error" or "timeout"
+        self._outcomes: "deque[tuple]" = deque()
+        self._probes: "deque[float]" = deque()
+
+    def _trim(self, now: float):
+        while self._outcomes and now - self._outcomes[0][0] > self.window:
+            self._outcomes.popleft()
+        while self._probes and now - self._probes[0] > self.open_seconds:
+            self._probes.popleft()
+
+    def _advance(self, now: float):
+        if self.state == OPEN and now - self.opened_at >= self.open_seconds:
+            self.state = HALF_OPEN
+            self._probes.clear()
+
+    def available(self, now: float) -> bool:
+        """Whether a call may be sent now (does not take a probe slot)"""
+        self._advance(now)
+        self._trim(now)
+        if self.state == OPEN:
+            return False
+        return self.state == CLOSED or len(self._probes) < self.half_open_probes
+
+    def allow(self, now: float) -> bool:
+        """Like available(), but takes a probe slot when half-open"""
+        if not self.available(now):
+            return False
+        if self.state == HALF_OPEN:
+            self._probes.append(now)
+        return True
+
+    def record(self, outcome: str, now: float):
+        self._advance(now)
+        if self.state == HALF_OPEN:
+            if self._probes:
+                self._probes.popleft()
+            if outcome == "success":
+                self.state = CLOSED
+                self._outcomes.clear()
+            else:
+                self._open(now)
+            return
+        self._outcomes.append((now, outcome))
+        self._trim(now)
+        if self.state == CLOSED and len(self._outcomes) >= self.min_requests:
+            failures = sum(1 for _, result in self._outcomes if result != "success")
+            if failures / len(self._outcomes) >= self.failure_threshold:
+                self._open(now)
+
+    def _open(self, now: float):
+        self.state = OPEN
+        self.opened_at = now
+        self.times_opened += 1
+        self._probes.clear()
+
+    def snapshot(self, now: float) -> Dict[str, Any]:
+        self._advance(now)
+        self._trim(now)
+        total = len(self._outcomes)
+        errors = sum(1 for _, result in self._outcomes if result == "error")
+        timeouts = sum(1 for _, result in self._outcomes if result == "timeout")
+        return {
+            "state": self.state,
+            "requests": total,
+            "error_rate": errors / total if total else 0.0,
+            "timeout_rate": timeouts / total if total else 0.0,
+            "times_opened": self.times_opened,
+            "retry_in": max(0.0, self.opened_at + self.open_seconds - now) if self.state == OPEN else 0.0,
+        }
+
+class CircuitBreakers:
+    def __init__(self, **settings):
+        self.settings = settings
+        # model -> fallback model (router_settings.fallbacks)
+        self.fallbacks: Dict[str, str] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def _breaker(self, model: str) -> CircuitBreaker:
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = self._breakers[model] = CircuitBreaker(**self.settings)
+        return breaker
+
+    def is_open(self, model: Optional[str]) -> bool:
+        """True while calls to model should be skipped"""
+        with self._lock:
+            breaker = self._breakers.get(model)
+            return breaker is not None and not breaker.available(time.monotonic())
+
+    def allow(self, model: Optional[str]) -> bool:
+        """Admit one call to model (takes a half-open probe slot)"""
+        with self._lock:
+            breaker = self._breakers.get(model)
+            return breaker is None or breaker.allow(time.monotonic())
+
+    def record(self, model: Optional[str], success: bool, exception: Optional[BaseException] = None):
+        """Outcome of an upstream call; failures that are not the upstream's fault are ignored"""
+        if not model:
+            return
+        if not success and not is_upstream_failure(exception):
+            return
+        outcome = "success" if success else ("timeout" if is_timeout(exception) else "error")
+        with self._lock:
+            self._breaker(model).record(outcome, time.monotonic())
+
+    def route_around(self, model: Optional[str]) -> Optional[str]:
+        """model if its breaker lets the call through, else the first usable fallback (None if none)"""
+        seen = set()
+        while model and model not in seen:
+            if self.allow(model):
+                return model
+            seen.add(model)
+            model = self.fallbacks.get(model)
+        return None
+
+    def retry_after(self, model: Optional[str]) -> float:
+        with self._lock:
+            breaker = self._breakers.get(model)
+            return breaker.snapshot(time.monotonic())["retry_in"] if breaker is not None else 0.0
+
+    def reset(self, model: Optional[str] = None):
+        """Close one breaker (or all of them)"""
+        with self._lock:
+            if model is None:
+                self._breakers.clear()
+            else:
+                self._breakers.pop(model, None)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            return {model: breaker.snapshot(now) for model, breaker in self._breakers.items()}
+
+# Shared breakers used by the router, the middleware and the completion callbacks
+circuit_breakers = CircuitBreakers(
+    failure_threshold=float(os.environ.get("BREAKER_FAILURE_THRESHOLD", 0.5)),
+    min_requests=int(os.environ.get("BREAKER_MIN_REQUESTS", 5)),
+    window=float(os.environ.get("BREAKER_WINDOW", 60)),
+    open_seconds=float(os.environ.get("BREAKER_OPEN_SECONDS", 30)),
+    half_open_probes=int(os.environ.get("BREAKER_HALF_OPEN_PROBES", 1)),
+)
@@ -0,0 +1,3 @@
+# test_api.py is a smoke test script run against a deployed proxy
+# (python test_api.py --base-url ...); the other test_*.py files run offline.
+collect_ignore = ["test_api.py"]
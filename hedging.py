@@ -0,0 +1,303 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+from typing import Any, Callable, Dict, Optional
+
+import litellm
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from admission import AdmissionRejected
+from model_stats import ModelStatsRegistry
+
+logger = logging.getLogger("litellm-proxy")
+
+# Hedged requests
+#
+# Fallbacks in router_settings only help after a request has failed. With
+# hedging enabled, a chat request to a model that has a fallback is sent to
+# the primary model as a stream; if no first token arrives within the
+# model's deadline (a percentile of its recent time to first token), the
+# fallback model is called in parallel. Whichever produces a first token
+# first serves the response and the other call is cancelled. A primary that
+# fails before the deadline fails over to the fallback straight away.
+#
+# Hedges cost a second upstream call, so they are capped as a fraction of
+# hedge-eligible traffic: every eligible request adds max_hedge_rate credits
+# (up to burst) and each hedge spends one. A hedge also needs a free
+# admission slot on the fallback model (no hedge otherwise); a failover may
+# queue for one. The slot is held until the call loses or its response ends.
+
+# Request fields that are not passed through to the upstream call
+_PROXY_FIELDS = {"model", "stream", "metadata", "user_preferences"}
+
+_ENV_REFERENCE = re.compile(r'\$\{(\w+)\}')
+
+def _load_config(config_path: str) -> Dict:
+    try:
+        import yaml
+    except ImportError:
+        logger.warning("PyYAML is not installed; ignoring hedging settings in config.yaml")
+        return {}
+    try:
+        with open(config_path, "r") as f:
+            return yaml.safe_load(f) or {}
+    except FileNotFoundError:
+        return {}
+
+def _expand_env(value: Any) -> Any:
+    # ${VAR} references in config.yaml are filled in from the environment
+    if isinstance(value, str):
+        return _ENV_REFERENCE.sub(lambda match: os.environ.get(match.group(1), ""), value)
+    return value
+
+def load_deployments(config: Dict) -> Dict[str, Dict[str, Any]]:
+    """model_name -> litellm_params from config.yaml model_list"""
+    deployments = {}
+    for entry in config.get("model_list") or []:
+        params = {key: _expand_env(value) for key, value in (entry.get("litellm_params") or {}).items()}
+        if entry.get("model_name") and params.get("model"):
+            deployments[entry["model_name"]] = {key: value for key, value in params.items() if value != ""}
+    return deployments
+
+def load_fallbacks(config: Dict) -> Dict[str, str]:
+    """model -> fallback_model from router_settings.fallbacks"""
+    fallbacks = {}
+    for entry in (config.get("router_settings") or {}).get("fallbacks") or []:
+        if isinstance(entry, dict) and entry.get("model") and entry.get("fallback_model"):
+            fallbacks[entry["model"]] = entry["fallback_model"]
+    return fallbacks
+
+def _sse_event(chunk) -> bytes:
+    data = chunk.model_dump() if hasattr(chunk, "model_dump") else dict(chunk)
+    return b"data: " + json.dumps(data, default=str).encode() + b"\n\n"
+
+class Hedger:
+    def __init__(self, deployments: Dict[str, Dict[str, Any]], fallbacks: Dict[str, str], stats: ModelStatsRegistry,
+                 percentile: float = 0.95, max_hedge_rate: float = 0.05, burst: float = 5.0, min_samples: int = 20,
+                 min_deadline: float = 0.2, max_deadline: float = 10.0, admission=None, breakers=None):
+        self.deployments = deployments
+        # Only models whose primary and fallback are both deployed can be hedged
+        self.fallbacks = {
+            model: fallback for model, fallback in fallbacks.items()
+            if model in deployments and fallback in deployments
+        }
+        self.stats = stats
+        self.percentile = percentile
+        self.max_hedge_rate = max_hedge_rate
+        self.burst = burst
+        self.min_samples = min_samples
+        self.min_deadline = min_deadline
+        self.max_deadline = max_deadline
+        # AdmissionController: hedges and failovers take a slot on the fallback model
+        self.admission = admission
+        # CircuitBreakers: no hedge or failover to a fallback whose breaker is open
+        self.breakers = breakers
+        self._credits = burst
+        self._lock = threading.Lock()
+        self.counters = {
+            "requests": 0, "hedges": 0, "hedge_wins": 0, "primary_wins": 0,
+            "failovers": 0, "capped": 0, "no_slot": 0, "failures": 0,
+        }
+
+    def applies(self, model: Optional[str]) -> bool:
+        return model in self.fallbacks
+
+    def deadline(self, model: str) -> float:
+        """Seconds to wait for the primary's first token before hedging"""
+        ttft = self.stats.ttft_percentile(model, self.percentile, self.min_samples)
+        if ttft is None:
+            # Not enough samples for a percentile yet
+            return self.max_deadline
+        return min(self.max_deadline, max(self.min_deadline, ttft))
+
+    def _has_credit(self) -> bool:
+        with self._lock:
+            if self._credits >= 1.0:
+                return True
+            self.counters["capped"] += 1
+            return False
+
+    def _take_credit(self):
+        with self._lock:
+            self._credits -= 1.0
+            self.counters["hedges"] += 1
+
+    def _count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+
+    async def _first_chunk(self, model: str, request_data: Dict[str, Any], metadata: Dict[str, Any]):
+        # Start a streamed call and wait for its first chunk
+        params = dict(self.deployments[model])
+        params.update({key: value for key, value in request_data.items() if key not in _PROXY_FIELDS})
+        params["stream"] = True
+        # The router would set model_group; callbacks key model stats by the config name, not the deployment's
+        params["metadata"] = dict(metadata, model_group=model)
+        stream = await litellm.acompletion(**params)
+        iterator = stream.__aiter__()
+        first = await iterator.__anext__()
+        return stream, iterator, first
+
+    async def _discard(self, task: asyncio.Task, tracking: Dict[str, Any], release: Callable[[Dict[str, Any]], None],
+                       release_slot: Optional[Callable[[], None]] = None):
+        # Cancel the losing call and give back its reservation / in-flight slot / admission slot
+        if not task.done():
+            task.cancel()
+        try:
+            stream, _, _ = await task
+            close = getattr(stream, "aclose", None)
+            if close is not None:
+                await close()
+        except BaseException:
+            pass
+        finally:
+            if release_slot is not None:
+                release_slot()
+        release(tracking)
+
+    async def _fallback_slot(self, fallback: str, wait: bool) -> Optional[Callable[[], None]]:
+        # Admission slot for a call to the fallback (a no-op without limits); None if there is none
+        if self.admission is None:
+            return lambda: None
+        if not wait:
+            return self.admission.try_acquire(fallback)
+        try:
+            release_slot = await self.admission.acquire(fallback)
+        except AdmissionRejected:
+            return None
+        return release_slot or (lambda: None)
+
+    async def complete(self, request_data: Dict[str, Any], api_key: str, tracking: Optional[Dict[str, Any]],
+                       release: Callable[[Dict[str, Any]], None]):
+        """Serve a chat request with hedging; None if the model is not hedged"""
+        model = request_data.get("model")
+        if not self.applies(model):
+            return None
+        fallback = self.fallbacks[model]
+        with self._lock:
+            self.counters["requests"] += 1
+            self._credits = min(self.burst, self._credits + self.max_hedge_rate)
+
+        metadata = dict(request_data.get("metadata") or {})
+        metadata["api_key"] = api_key
+        primary_tracking = dict(tracking or {})
+        primary = asyncio.create_task(self._first_chunk(model, request_data, metadata))
+        # task -> (model, tracking, admission slot release); the middleware holds the primary's slot
+        attempts = {primary: (model, primary_tracking, None)}
+
+        done, _ = await asyncio.wait({primary}, timeout=self.deadline(model))
+        primary_failed = bool(done) and primary.exception() is not None
+        if primary_failed:
+            self._count("failovers")
+        fallback_up = self.breakers is None or not self.breakers.is_open(fallback)
+        release_slot = None
+        if fallback_up and primary_failed:
+            release_slot = await self._fallback_slot(fallback, wait=True)
+            if release_slot is None:
+                self._count("no_slot")
+        elif fallback_up and not done and self._has_credit():
+            release_slot = await self._fallback_slot(fallback, wait=False)
+            if release_slot is None:
+                self._count("no_slot")
+            else:
+                self._take_credit()
+        if release_slot is not None:
+            # The hedge gets its own in-flight slot; its usage is billed without a reservation
+            hedge_metadata = {key: value for key, value in metadata.items() if key != "budget_reservation_id"}
+            hedge_metadata["model_stats_token"] = self.stats.start(fallback)
+            hedge = asyncio.create_task(self._first_chunk(fallback, request_data, hedge_metadata))
+            attempts[hedge] = (fallback, {"model_stats_token": hedge_metadata["model_stats_token"]}, release_slot)
+
+        # The first call to produce a chunk wins; failed calls drop out
+        winner = None
+        pending = set(attempts)
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and winner is None:
+                    winner = task
+                elif task.exception() is not None:
+                    logger.warning(f"Hedged call to {attempts[task][0]} failed: {str(task.exception())}")
+        for task, (_, attempt_tracking, attempt_slot) in attempts.items():
+            if task is not winner:
+                await self._discard(task, attempt_tracking, release, attempt_slot)
+
+        if winner is None:
+            self._count("failures")
+            return JSONResponse(status_code=502, content={"detail": "All upstream attempts failed"})
+        if winner is primary:
+            self._count("primary_wins")
+        else:
+            self._count("hedge_wins")
+            if not primary_failed:
+                logger.info(f"Hedge to {fallback} answered before {model}")
+
+        served_model, _, winner_slot = attempts[winner]
+        winner_slot = winner_slot or (lambda: None)
+        stream, iterator, first = winner.result()
+        headers = {"X-Served-Model": served_model, "X-Hedged": "true" if len(attempts) > 1 else "false"}
+
+        if request_data.get("stream"):
+            async def events():
+                try:
+                    yield _sse_event(first)
+                    async for chunk in iterator:
+                        yield _sse_event(chunk)
+                    yield b"data: [DONE]\n\n"
+                finally:
+                    winner_slot()
+                    close = getattr(stream, "aclose", None)
+                    if close is not None:
+                        await close()
+
+            return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+        # Non-streaming clients get the assembled completion
+        chunks = [first]
+        try:
+            async for chunk in iterator:
+                chunks.append(chunk)
+        finally:
+            winner_slot()
+        response = litellm.stream_chunk_builder(chunks, messages=request_data.get("messages"))
+        content = response.model_dump() if hasattr(response, "model_dump") else dict(response)
+        return JSONResponse(content=content, headers=headers)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            metrics = dict(self.counters)
+            metrics["credits"] = self._credits
+        metrics["hedge_rate"] = metrics["hedges"] / metrics["requests"] if metrics["requests"] else 0.0
+        metrics["max_hedge_rate"] = self.max_hedge_rate
+        metrics["deadlines"] = {model: self.deadline(model) for model in self.fallbacks}
+        metrics["fallbacks"] = dict(self.fallbacks)
+        return metrics
+
+def load_router_fallbacks(config_path: str) -> Dict[str, str]:
+    """router_settings.fallbacks of config.yaml"""
+    return load_fallbacks(_load_config(config_path))
+
+def create_hedger(config_path: str, stats: ModelStatsRegistry, admission=None, breakers=None) -> Optional[Hedger]:
+    """Hedger from the hedging section of config.yaml (None unless enabled)"""
+    config = _load_config(config_path)
+    settings = config.get("hedging") or {}
+    if not settings.get("enabled"):
+        return None
+    fallbacks = load_fallbacks(config)
+    fallbacks.update(settings.get("fallbacks") or {})
+    return Hedger(
+        load_deployments(config),
+        fallbacks,
+        stats,
+        percentile=float(settings.get("percentile", 0.95)),
+        max_hedge_rate=float(settings.get("max_hedge_rate", 0.05)),
+        burst=float(settings.get("burst", 5)),
+        min_samples=int(settings.get("min_samples", 20)),
+        min_deadline=float(settings.get("min_deadline", 0.2)),
+        max_deadline=float(settings.get("max_deadline", 10.0)),
+        admission=admission,
+        breakers=breakers,
+    )
@@ -0,0 +1,238 @@
+import asyncio
+import bisect
+import logging
+import threading
+from datetime import datetime
+from typing import Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+logger = logging.getLogger("litellm-proxy")
+
+# Resident API key index
+#
+# The index is loaded once at startup and answers every auth check from
+# memory. Mutations are recorded as pending changes (changed keys, deleted
+# keys and usage increments) and a background flusher hands only those to
+# the saver (write-behind), so request handlers never touch the disk and
+# workers sharing the store never overwrite each other's keys. The flusher
+# also compares the store's version with the one last loaded and reloads
+# when another process changed it; a lookup miss checks right away so keys
+# created on another worker work immediately. Keys are also kept sorted by
+# (created_at, key) for cursor pagination.
+class APIKeyIndex:
+    def __init__(self, loader: Callable[[], Dict], saver: Callable[[Dict[str, Dict], List[str], Dict[str, float]], None],
+                 flush_interval: float = 1.0, version: Optional[Callable[[], Hashable]] = None):
+        self._loader = loader
+        self._saver = saver
+        self._version = version
+        self._flush_interval = flush_interval
+        self._keys: Dict[str, Dict] = {}
+        self._expires: Dict[str, float] = {}
+        self._order: List[Tuple[str, str]] = []
+        self._lock = threading.RLock()
+        # Serializes saves and reloads so a reload never reads the store halfway through a flush
+        self._io_lock = threading.Lock()
+        self._loaded_version: Optional[Hashable] = None
+        self._changed: Set[str] = set()
+        self._deleted: Set[str] = set()
+        self._usage: Dict[str, float] = {}
+
+    def load(self):
+        """Load all keys from the backing store into memory"""
+        with self._io_lock:
+            version = self._version() if self._version else None
+            keys = self._loader()
+            with self._lock:
+                self._replace(keys)
+                self._loaded_version = version
+                self._changed.clear()
+                self._deleted.clear()
+                self._usage.clear()
+        logger.info(f"API key index loaded: {len(keys)} keys")
+
+    def refresh(self, blocking: bool = True) -> bool:
+        """Reload the keys if another process changed the backing store since the last load
+
+        Pending local changes are kept on top of the reloaded keys. With
+        blocking=False the check is skipped while a flush is running.
+        """
+        if self._version is None:
+            return False
+        if not self._io_lock.acquire(blocking=blocking):
+            return False
+        try:
+            version = self._version()
+            if version == self._loaded_version:
+                return False
+            keys = self._loader()
+            with self._lock:
+                for key in self._deleted:
+                    keys.pop(key, None)
+                for key, cost in self._usage.items():
+                    if key in keys and key not in self._changed:
+                        keys[key]["usage"] = keys[key].get("usage", 0.0) + cost
+                for key in self._changed:
+                    data = self._keys.get(key)
+                    if data is None:
+                        continue
+                    stored = keys.get(key)
+                    if stored is not None:
+                        data = dict(data, usage=stored.get("usage", 0.0) + self._usage.get(key, 0.0))
+                    keys[key] = data
+                self._replace(keys)
+                self._loaded_version = version
+        finally:
+            self._io_lock.release()
+        logger.info(f"API key index reloaded: {len(keys)} keys")
+        return True
+
+    def _replace(self, keys: Dict[str, Dict]):
+        self._keys = keys
+        self._expires = {key: _expiry_timestamp(data) for key, data in keys.items()}
+        self._order = sorted((data.get("created_at") or "", key) for key, data in keys.items())
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key: str) -> Optional[Dict]:
+        data = self._keys.get(key)
+        if data is None and self.refresh(blocking=False):
+            data = self._keys.get(key)
+        return data
+
+    def items(self):
+        with self._lock:
+            return list(self._keys.items())
+
+    def page(self, after: Optional[Tuple[str, str]] = None, limit: Optional[int] = None,
+             since: Optional[str] = None, until: Optional[str] = None) -> Tuple[List[Tuple[str, Dict]], Optional[Tuple[str, str]]]:
+        """Return keys ordered by creation time, limited to created_at in [since, until)
+
+        after is the (created_at, key) of the last entry of the previous page.
+        Returns the page and the cursor for the next page, if any.
+        """
+        with self._lock:
+            start = bisect.bisect_right(self._order, after) if after else 0
+            if since:
+                start = max(start, bisect.bisect_left(self._order, (since,)))
+            end = bisect.bisect_left(self._order, (until,)) if until else len(self._order)
+            stop = end if limit is None else min(end, start + limit)
+            entries = self._order[start:stop]
+            next_after = entries[-1] if stop < end and entries else None
+            return [(key, self._keys[key]) for _, key in entries], next_after
+
+    def is_expired(self, key: str, now: Optional[float] = None) -> bool:
+        expires = self._expires.get(key)
+        if expires is None:
+            return False
+        return expires < (now if now is not None else datetime.now().timestamp())
+
+    def put(self, key: str, data: Dict):
+        with self._lock:
+            if key in self._keys:
+                self._remove_order(key)
+            self._keys[key] = data
+            self._expires[key] = _expiry_timestamp(data)
+            bisect.insort(self._order, (data.get("created_at") or "", key))
+            self._changed.add(key)
+            self._deleted.discard(key)
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            if key not in self._keys:
+                return False
+            self._remove_order(key)
+            del self._keys[key]
+            self._expires.pop(key, None)
+            self._changed.discard(key)
+            self._usage.pop(key, None)
+            self._deleted.add(key)
+        return True
+
+    def add_usage(self, key: str, cost: float):
+        with self._lock:
+            data = self._keys.get(key)
+            if data is None:
+                return
+            data["usage"] = data.get("usage", 0.0) + cost
+            self._usage[key] = self._usage.get(key, 0.0) + cost
+
+    def raise_usage(self, key: str, usage: float):
+        """Raise the in-memory balance of key to usage (balances only ever grow)
+
+        Used for balances other workers added; they persist their own
+        increments, so nothing is written for this.
+        """
+        with self._lock:
+            data = self._keys.get(key)
+            if data is None or usage <= data.get("usage", 0.0):
+                return
+            data["usage"] = usage
+
+    def _remove_order(self, key: str):
+        entry = (self._keys[key].get("created_at") or "", key)
+        index = bisect.bisect_left(self._order, entry)
+        if index < len(self._order) and self._order[index] == entry:
+            del self._order[index]
+
+    def flush(self):
+        """Persist the keys changed, the keys deleted and the usage added since the last flush
+
+        Changed keys are handed over without their usage; the saver keeps
+        the stored balance and adds the usage increments instead.
+        """
+        with self._io_lock:
+            with self._lock:
+                if not (self._changed or self._deleted or self._usage):
+                    return
+                upserts = {
+                    key: {name: value for name, value in self._keys[key].items() if name != "usage"}
+                    for key in self._changed
+                }
+                deletes = sorted(self._deleted)
+                usage = self._usage
+                self._changed, self._deleted, self._usage = set(), set(), {}
+            try:
+                self._saver(upserts, deletes, usage)
+            except Exception:
+                with self._lock:
+                    self._changed.update(key for key in upserts if key in self._keys)
+                    self._deleted.update(key for key in deletes if key not in self._keys)
+                    for key, cost in usage.items():
+                        if key in self._keys:
+                            self._usage[key] = self._usage.get(key, 0.0) + cost
+                raise
+
+    async def run_flusher(self):
+        """Background task that flushes pending changes and picks up other processes' changes every flush_interval seconds"""
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                logger.error(f"API key index flush failed: {str(e)}")
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                logger.error(f"API key index reload failed: {str(e)}")
+
+def apply_key_changes(api_keys: Dict[str, Dict], upserts: Dict[str, Dict], deletes: List[str], usage: Dict[str, float]):
+    """Apply a flush from APIKeyIndex to a dict of stored keys (in place)
+
+    Upserted keys keep their stored usage; usage increments are added on top.
+    """
+    for key, data in upserts.items():
+        api_keys[key] = dict(data, usage=api_keys.get(key, {}).get("usage", 0.0))
+    for key in deletes:
+        api_keys.pop(key, None)
+    for key, cost in usage.items():
+        if key in api_keys:
+            api_keys[key]["usage"] = api_keys[key].get("usage", 0.0) + cost
+
+def _expiry_timestamp(data: Dict) -> Optional[float]:
+    expires_at = data.get("expires_at")
+    if not expires_at:
+        return None
+    return datetime.fromisoformat(expires_at).timestamp()
@@ -1,21 +1,39 @@
-
-from fastapi import FastAPI, Request, Depends, HTTPException, status
+from fastapi import FastAPI, Request, Response, Query, Depends, HTTPException, status
 from fastapi.security import APIKeyHeader
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
 from litellm.proxy.proxy_server import router as litellm_router
-from model_router import route_request
+from model_router import route_batch, routing_cache, estimate_prompt_tokens, shutdown_process_pool, model_tiers
+from model_stats import model_stats
 import stripe
 from pydantic import BaseModel
 from typing import Optional
 from middleware import ModelRouterMiddleware
+from request_context import RequestContext
+from key_store import APIKeyIndex, apply_key_changes
+from usage_log import UsageJournal
+from usage_rollups import UsageRollups
+from usage_queue import UsageQueue
+from sqlite_store import SQLiteStore, SQLiteUsageJournal
+from budget_ledger import BudgetLedger
+from shared_state import RateLimiter, create_shared_counters
+from pii_masker import create_masker, response_masking_enabled
+from pricing import load_pricing
+from hedging import create_hedger, load_router_fallbacks
+from circuit_breaker import circuit_breakers
+from admission import load_admission_limits
+from response_cache import ResponseCache
 import os
 import uuid
+import fcntl
+import contextlib
 import json
 import re
 import logging
+import asyncio
+import base64
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
 import litellm
@@ -54,29 +72,84 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Auto-Selected-Model", "X-Served-Model", "X-Hedged", "X-Cache"],
 )
 
-# Add model router middleware
-app.add_middleware(ModelRouterMiddleware)
-
 # API key header for authentication
 api_key_header = APIKeyHeader(name="Authorization", auto_error=False)
 
 # Path to store API keys
 API_KEYS_FILE = os.environ.get("API_KEYS_FILE", "/app/api_keys.json")
 
+# Storage backend: "json" (API_KEYS_FILE + usage journal) or "sqlite" (single WAL database).
+# Defaults to sqlite when API_KEYS_FILE points at a .db/.sqlite file.
+STORAGE_BACKEND = os.environ.get(
+    "STORAGE_BACKEND",
+    "sqlite" if API_KEYS_FILE.endswith((".db", ".sqlite", ".sqlite3")) else "json",
+).lower()
+SQLITE_POOL_SIZE = int(os.environ.get("SQLITE_POOL_SIZE", 4))
+
+# How often the in-memory key index is written back to disk (seconds)
+API_KEYS_FLUSH_INTERVAL = float(os.environ.get("API_KEYS_FLUSH_INTERVAL", 1.0))
+
+# Append-only usage journal settings
+USAGE_LOG_DIR = os.environ.get("USAGE_LOG_DIR", os.path.join(os.path.dirname(API_KEYS_FILE), "usage"))
+USAGE_SEGMENT_BYTES = int(os.environ.get("USAGE_SEGMENT_BYTES", 16 * 1024 * 1024))
+USAGE_FSYNC_BATCH = int(os.environ.get("USAGE_FSYNC_BATCH", 32))
+USAGE_FSYNC_INTERVAL = float(os.environ.get("USAGE_FSYNC_INTERVAL", 1.0))
+USAGE_ROLLUPS_FILE = os.environ.get(
+    "USAGE_ROLLUPS_FILE",
+    f"{API_KEYS_FILE}.rollups.json" if STORAGE_BACKEND == "sqlite" else os.path.join(USAGE_LOG_DIR, "rollups.json"),
+)
+
+# Usage accounting queue settings
+USAGE_QUEUE_SIZE = int(os.environ.get("USAGE_QUEUE_SIZE", 10000))
+USAGE_BATCH_SIZE = int(os.environ.get("USAGE_BATCH_SIZE", 256))
+USAGE_FLUSH_INTERVAL = float(os.environ.get("USAGE_FLUSH_INTERVAL", 0.5))
+
 # Cost optimization settings
 MAX_TOKENS_PER_REQUEST = int(os.environ.get("MAX_TOKENS_PER_REQUEST", 4000))
 CACHE_TTL = int(os.environ.get("CACHE_TTL", 3600))  # Cache TTL in seconds
 ENABLE_CACHING = os.environ.get("ENABLE_CACHING", "true").lower() == "true"
 
-# PII filtering patterns
-PII_PATTERNS = {
-    "email": r'[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}',
-    "phone_jp": r'0\d{1,4}[-\s]?\d{1,4}[-\s]?\d{4}',
-    "credit_card": r'(?:\d{4}[-\s]?){3}\d{4}',
-    "address_jp": r'〒?\d{3}[-\s]?\d{4}',
-}
+# Local response cache in front of litellm.Cache: in-process LRU plus a SQLite file
+RESPONSE_CACHE_MEMORY_BYTES = int(os.environ.get("RESPONSE_CACHE_MEMORY_BYTES", 64 * 1024 * 1024))
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRY_BYTES", 1024 * 1024))
+RESPONSE_CACHE_PATH = os.environ.get(
+    "RESPONSE_CACHE_PATH", os.path.join(os.path.dirname(API_KEYS_FILE), "response_cache.db")
+)  # Empty keeps the cache in memory only
+RESPONSE_CACHE_DISK_BYTES = int(os.environ.get("RESPONSE_CACHE_DISK_BYTES", 1024 * 1024 * 1024))
+RESPONSE_CACHE_STREAM_CHUNK_CHARS = int(os.environ.get("RESPONSE_CACHE_STREAM_CHUNK_CHARS", 16))  # Content characters per replayed SSE event (0 = one event)
+
+# Batch routing settings (/v1/route)
+ROUTE_BATCH_MAX_ITEMS = int(os.environ.get("ROUTE_BATCH_MAX_ITEMS", 10000))
+ROUTE_BATCH_PARALLEL_CHARS = int(os.environ.get("ROUTE_BATCH_PARALLEL_CHARS", 1000000))  # Prompt characters before a process pool is used
+ROUTE_BATCH_PROCESSES = int(os.environ.get("ROUTE_BATCH_PROCESSES", 0)) or None  # 0 = one per CPU
+
+# Budget reservation settings
+BUDGET_LEDGER_SHARDS = int(os.environ.get("BUDGET_LEDGER_SHARDS", 64))
+BUDGET_RESERVATION_TTL = float(os.environ.get("BUDGET_RESERVATION_TTL", 600))  # Seconds before an unsettled reservation is dropped
+
+# Shared state for running several workers / machines ("local" or redis://host:port/db; empty keeps state per process)
+SHARED_STATE_URL = os.environ.get("SHARED_STATE_URL", "")
+SHARED_STATE_FLUSH_INTERVAL = float(os.environ.get("SHARED_STATE_FLUSH_INTERVAL", 0.05))
+SHARED_STATE_MAX_STALENESS = float(os.environ.get("SHARED_STATE_MAX_STALENESS", 0.5))
+
+# Rate limiting settings (requests per key per timeframe)
+ENABLE_RATE_LIMIT = os.environ.get("ENABLE_RATE_LIMIT", "false").lower() == "true"
+RATE_LIMIT = int(os.environ.get("RATE_LIMIT", 100))
+RATE_LIMIT_TIMEFRAME = float(os.environ.get("RATE_LIMIT_TIMEFRAME", 60))
+
+# Proxy configuration file (model list, PII patterns, ...)
+CONFIG_FILE = os.environ.get("CONFIG_FILE", "config.yaml")
+
+# PII filtering: built-in patterns plus pii_masking.extra_patterns from config.yaml
+pii_masker = create_masker(CONFIG_FILE)
+# Model prices from config.yaml model_info and MODEL_INFO
+pricing = load_pricing(CONFIG_FILE)
+
+# Mask streamed responses too when litellm_settings.post_response_processing is set
+MASK_STREAMED_RESPONSES = response_masking_enabled(CONFIG_FILE)
 
 # Models for API key management
 class APIKeyCreate(BaseModel):
@@ -86,6 +159,15 @@ class APIKeyCreate(BaseModel):
     metadata: Optional[Dict] = None
     max_budget: Optional[float] = None
 
+# Models for batch routing
+class RouteItem(BaseModel):
+    messages: List[Dict]
+    user_preferences: Optional[Dict] = None
+    max_tokens: Optional[int] = None
+
+class RouteBatchRequest(BaseModel):
+    requests: List[RouteItem]
+
 class APIKeyResponse(BaseModel):
     key: str
     name: str
@@ -98,66 +180,257 @@ class APIKeyResponse(BaseModel):
 
 # Initialize API keys storage
 def init_api_keys():
+    if STORAGE_BACKEND == "sqlite":
+        sqlite_store.open()
+        return
+    
     if not os.path.exists(os.path.dirname(API_KEYS_FILE)):
         os.makedirs(os.path.dirname(API_KEYS_FILE), exist_ok=True)
     
     if not os.path.exists(API_KEYS_FILE):
         with open(API_KEYS_FILE, "w") as f:
-            json.dump({"keys": {}, "usage": []}, f)
+            json.dump({"keys": {}}, f)
 
 # Load API keys from file
 def load_api_keys():
+    return read_api_keys_file().get("keys", {})
+
+def read_api_keys_file():
     try:
         with open(API_KEYS_FILE, "r") as f:
-            data = json.load(f)
-            return data.get("keys", {})
+            return json.load(f)
     except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+        return {"keys": {}}
 
-# Load usage logs from file
-def load_usage_logs():
+def write_api_keys_file(data):
+    tmp_path = f"{API_KEYS_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, API_KEYS_FILE)
+
+# Workers read-modify-write the keys file under an exclusive lock on a sidecar file
+@contextlib.contextmanager
+def api_keys_file_lock():
+    with open(f"{API_KEYS_FILE}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+# Save the key changes (and usage increments) flushed by the key index
+def save_api_keys(upserts, deletes, usage):
+    with api_keys_file_lock():
+        data = read_api_keys_file()
+        apply_key_changes(data.setdefault("keys", {}), upserts, deletes, usage)
+        write_api_keys_file(data)
+
+# Changes whenever any worker rewrites the keys file
+def api_keys_file_version():
     try:
-        with open(API_KEYS_FILE, "r") as f:
-            data = json.load(f)
-            return data.get("usage", [])
-    except (FileNotFoundError, json.JSONDecodeError):
-        return []
+        stat = os.stat(API_KEYS_FILE)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+if STORAGE_BACKEND == "sqlite":
+    # Keys, balances and usage all live in one SQLite database
+    sqlite_store = SQLiteStore(API_KEYS_FILE, pool_size=SQLITE_POOL_SIZE)
+    key_index = APIKeyIndex(
+        sqlite_store.load_keys,
+        sqlite_store.save_keys,
+        flush_interval=API_KEYS_FLUSH_INTERVAL,
+        version=sqlite_store.keys_version,
+    )
+    usage_journal = SQLiteUsageJournal(sqlite_store)
+else:
+    # Resident API key index, loaded at startup, flushed and reloaded in the background
+    key_index = APIKeyIndex(
+        load_api_keys,
+        save_api_keys,
+        flush_interval=API_KEYS_FLUSH_INTERVAL,
+        version=api_keys_file_version,
+    )
+    
+    # Usage records live in their own append-only journal, separate from key balances
+    usage_journal = UsageJournal(
+        USAGE_LOG_DIR,
+        segment_bytes=USAGE_SEGMENT_BYTES,
+        fsync_batch=USAGE_FSYNC_BATCH,
+        fsync_interval=USAGE_FSYNC_INTERVAL,
+    )
 
-# Save all data to file
-def save_data(api_keys, usage_logs):
-    with open(API_KEYS_FILE, "w") as f:
-        json.dump({
-            "keys": api_keys,
-            "usage": usage_logs
-        }, f)
+# Per-key, per-model and per-hour totals, updated as usage is recorded
+usage_rollups = UsageRollups(USAGE_ROLLUPS_FILE)
+
+# Move usage logs stored inside API_KEYS_FILE by older versions into the journal
+def migrate_legacy_usage():
+    if STORAGE_BACKEND == "sqlite":
+        return
+    
+    with api_keys_file_lock():
+        data = read_api_keys_file()
+        legacy_logs = data.get("usage")
+        if not legacy_logs:
+            return
+        
+        # A non-empty journal means a previous migration already copied the logs
+        if next(usage_journal.iter_records(), None) is None:
+            usage_journal.append_many(legacy_logs)
+            usage_journal.sync()
+            logger.info(f"Migrated {len(legacy_logs)} usage logs to {USAGE_LOG_DIR}")
+        
+        del data["usage"]
+        write_api_keys_file(data)
 
 # Mask PII information
 def mask_pii(text):
-    masked_text = text
-    for pattern_name, pattern in PII_PATTERNS.items():
-        masked_text = re.sub(pattern, f"[{pattern_name}]", masked_text)
-    return masked_text
+    return pii_masker.mask(text)
 
 # Calculate cost
 def calculate_cost(model, input_tokens, output_tokens):
-    cost_map = {
-        "gpt-3.5-turbo": {"input": 0.0015, "output": 0.002},
-        "gpt-4": {"input": 0.03, "output": 0.06},
-    }
+    return pricing.cost(model, input_tokens, output_tokens)
+
+# Write a batch of usage records (runs on the usage queue writer)
+def write_usage_batch(records):
+    usage_journal.append_many(records)
+    # Fold the journal tail (this batch and anything other workers appended before it)
+    usage_rollups.replay(usage_journal)
     
-    if model in cost_map:
-        return (input_tokens / 1000 * cost_map[model]["input"]) + (output_tokens / 1000 * cost_map[model]["output"])
-    else:
-        return (input_tokens / 1000 * 0.002) + (output_tokens / 1000 * 0.002)
+    # Coalesce balance updates so each key is touched once per batch
+    key_costs = {}
+    for record in records:
+        key_costs[record["key_id"]] = key_costs.get(record["key_id"], 0.0) + record["cost"]
+    for key_id, cost in key_costs.items():
+        key_index.add_usage(key_id, cost)
+        budget_ledger.applied(key_id, cost)
 
-# Log usage
-def log_usage(key_id, model, input_tokens, output_tokens, request_id):
-    api_keys = load_api_keys()
-    usage_logs = load_usage_logs()
+# Usage records are written in batches off the request path
+usage_queue = UsageQueue(
+    write_usage_batch,
+    maxsize=USAGE_QUEUE_SIZE,
+    batch_size=USAGE_BATCH_SIZE,
+    flush_interval=USAGE_FLUSH_INTERVAL,
+)
+
+# Balances, reservations and rate counters shared between workers
+shared_counters = create_shared_counters(
+    SHARED_STATE_URL or "local",
+    flush_interval=SHARED_STATE_FLUSH_INTERVAL,
+    max_staleness=SHARED_STATE_MAX_STALENESS,
+)
+
+# Reservations for requests in flight, checked against max_budget before sending upstream
+budget_ledger = BudgetLedger(
+    shards=BUDGET_LEDGER_SHARDS,
+    reservation_ttl=BUDGET_RESERVATION_TTL,
+    shared=shared_counters if SHARED_STATE_URL else None,
+)
+
+rate_limiter = RateLimiter(shared_counters, RATE_LIMIT, RATE_LIMIT_TIMEFRAME) if ENABLE_RATE_LIMIT else None
+
+# Estimate the worst-case cost of a chat request from its prompt size and max_tokens
+def estimate_request_cost(request_data, input_tokens=None):
+    if input_tokens is None:
+        input_tokens = estimate_prompt_tokens(request_data.get("messages") or [])
+    output_tokens = min(request_data.get("max_tokens") or MAX_TOKENS_PER_REQUEST, MAX_TOKENS_PER_REQUEST)
+    return calculate_cost(request_data.get("model"), input_tokens, output_tokens)
+
+# Apply the rate limit and reserve the estimated cost of a chat request against its key's budget
+def admit_chat_request(context: RequestContext):
+    api_key = context.api_key
+    if not api_key:
+        return None, None
+    
+    key_data = key_index.get(api_key)
+    if key_data is None:
+        # Unknown keys are rejected by authentication
+        return None, None
+    request_data = context.data
     
+    # Checked here as well because cached and hedged responses never reach LiteLLM's authentication
+    if key_index.is_expired(api_key):
+        return None, JSONResponse(status_code=status.HTTP_401_UNAUTHORIZED, content={"detail": "API key has expired"})
+    allowed_models = key_data.get("models")
+    if allowed_models and request_data.get("model") not in allowed_models:
+        return None, JSONResponse(
+            status_code=status.HTTP_403_FORBIDDEN,
+            content={"detail": f"Model {request_data.get('model')} is not allowed for this API key"},
+        )
+    context.key_record = key_data
+    
+    if rate_limiter is not None and not rate_limiter.hit(api_key):
+        return None, JSONResponse(status_code=status.HTTP_429_TOO_MANY_REQUESTS, content={"detail": "Rate limit exceeded"})
+    
+    tracking = {}
+    if key_data.get("max_budget"):
+        # Unlimited keys need no reservation
+        reservation_id = budget_ledger.reserve(
+            api_key,
+            estimate_request_cost(request_data, context.prompt_tokens),
+            key_data.get("usage", 0.0),
+            key_data["max_budget"],
+        )
+        if reservation_id is None:
+            return None, JSONResponse(status_code=status.HTTP_403_FORBIDDEN, content={"detail": "Budget limit reached"})
+        tracking["budget_reservation_id"] = reservation_id
+    
+    # Count the request as in flight for its model until a callback finishes it
+    tracking["model_stats_token"] = model_stats.start(request_data.get("model") or "unknown")
+    return tracking, None
+
+# Give back the reservation and in-flight slot of a request that never reached a model or failed
+# (the failure callback still records the outcome against the model)
+def release_chat_request(tracking):
+    budget_ledger.release(tracking.get("budget_reservation_id"))
+    model_stats.finish(tracking.get("model_stats_token"))
+
+# Per-model concurrency limits and wait queues (model_list[].model_info in config.yaml)
+admission = load_admission_limits(CONFIG_FILE)
+
+# Hedged requests (hedging section of config.yaml; disabled by default)
+hedger = create_hedger(CONFIG_FILE, model_stats, admission, circuit_breakers)
+
+# Requests to a model whose circuit breaker is open go down its fallback chain
+circuit_breakers.fallbacks = load_router_fallbacks(CONFIG_FILE)
+
+# Serve a chat request through the hedger when its model has a fallback
+async def hedge_chat_request(context: RequestContext, tracking):
+    if hedger is None or not hedger.applies(context.data.get("model")):
+        return None
+    if context.key_record is None:
+        # Hedged calls skip LiteLLM's authentication, so only keys admit_chat_request accepted
+        # (known, unexpired and allowed this model) are hedged
+        return None
+    return await hedger.complete(context.data, context.api_key, tracking, release_chat_request)
+
+# Completed responses served without calling upstream (ENABLE_CACHING)
+response_cache = ResponseCache(
+    ttl=CACHE_TTL,
+    max_memory_bytes=RESPONSE_CACHE_MEMORY_BYTES,
+    max_entry_bytes=RESPONSE_CACHE_MAX_ENTRY_BYTES,
+    disk_path=RESPONSE_CACHE_PATH or None,
+    max_disk_bytes=RESPONSE_CACHE_DISK_BYTES,
+    stream_chunk_chars=RESPONSE_CACHE_STREAM_CHUNK_CHARS,
+) if ENABLE_CACHING else None
+
+# Add model router middleware
+app.add_middleware(
+    ModelRouterMiddleware,
+    admit_request=admit_chat_request,
+    release_request=release_chat_request,
+    response_masker=pii_masker if MASK_STREAMED_RESPONSES else None,
+    hedge_request=hedge_chat_request,
+    admission=admission,
+    breakers=circuit_breakers,
+    response_cache=response_cache,
+)
+
+# Log usage
+def log_usage(key_id, model, input_tokens, output_tokens, request_id, reservation_id=None):
     cost = calculate_cost(model, input_tokens, output_tokens)
     
-    usage_logs.append({
+    # Swap the reservation for the actual cost until the writer applies it
+    budget_ledger.settle(key_id, cost, reservation_id)
+    
+    usage_queue.submit({
         "key_id": key_id,
         "timestamp": datetime.now().isoformat(),
         "model": model,
@@ -166,16 +439,40 @@ def log_usage(key_id, model, input_tokens, output_tokens, request_id):
         "cost": cost,
         "request_id": request_id
     })
-    
-    # Update API key usage
-    if key_id in api_keys:
-        if "usage" not in api_keys[key_id]:
-            api_keys[key_id]["usage"] = 0.0
-        
-        api_keys[key_id]["usage"] = api_keys[key_id].get("usage", 0.0) + cost
-    
-    save_data(api_keys, usage_logs)
-    logger.info(f"Usage logged: key={key_id}, model={model}, cost={cost}")
+    logger.debug(f"Usage queued: key={key_id}, model={model}, cost={cost}")
+
+# Encode a pagination cursor as an opaque URL-safe token
+def encode_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip("=")
+
+# Decode a pagination cursor produced by encode_cursor
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor",
+        )
+
+# Stored timestamps are naive local time; convert query bounds to match
+def to_local_isoformat(value: Optional[datetime]):
+    if value is None:
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    return value.isoformat()
+
+# Hourly rollup bucket ("YYYY-MM-DDTHH") containing value, or the next one when round_up is set
+def to_hour_bucket(value: Optional[datetime], round_up=False):
+    if value is None:
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    bucket = value.replace(minute=0, second=0, microsecond=0)
+    if round_up and bucket != value:
+        bucket += timedelta(hours=1)
+    return bucket.strftime("%Y-%m-%dT%H")
 
 # Verify API key
 async def verify_api_key(api_key: str = Depends(api_key_header)):
@@ -189,24 +486,23 @@ async def verify_api_key(api_key: str = Depends(api_key_header)):
     if api_key.startswith("Bearer "):
         api_key = api_key[7:]
     
-    api_keys = load_api_keys()
-    
-    if api_key not in api_keys:
+    if api_key not in key_index:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid API key",
         )
     
     # Check if key is expired
-    key_data = api_keys[api_key]
-    if key_data.get("expires_at") and datetime.fromisoformat(key_data["expires_at"]) < datetime.now():
+    if key_index.is_expired(api_key):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="API key has expired",
         )
     
-    # Check if budget is exceeded
-    if key_data.get("max_budget") and key_data.get("usage", 0.0) >= key_data.get("max_budget"):
+    # Check if budget is exceeded (against the shared balance when workers share state)
+    key_data = key_index.get(api_key)
+    max_budget = key_data.get("max_budget")
+    if max_budget and budget_ledger.spent(api_key, key_data.get("usage", 0.0)) >= max_budget:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Budget limit reached",
@@ -218,14 +514,11 @@ async def verify_api_key(api_key: str = Depends(api_key_header)):
 @app.post("/api/keys", response_model=APIKeyResponse)
 async def create_api_key(key_data: APIKeyCreate, _: str = Depends(verify_api_key)):
     """Create a new API key"""
-    api_keys = load_api_keys()
-    usage_logs = load_usage_logs()
-    
     # Generate a new API key
     new_key = f"sk-{uuid.uuid4().hex}"
     
     # Store the key data
-    api_keys[new_key] = {
+    key_index.put(new_key, {
         "name": key_data.name,
         "created_at": datetime.now().isoformat(),
         "expires_at": key_data.expires_at.isoformat() if key_data.expires_at else None,
@@ -233,9 +526,7 @@ async def create_api_key(key_data: APIKeyCreate, _: str = Depends(verify_api_key
         "metadata": key_data.metadata or {},
         "max_budget": key_data.max_budget,
         "usage": 0.0
-    }
-    
-    save_data(api_keys, usage_logs)
+    })
     
     return {
         "key": new_key,
@@ -249,9 +540,28 @@ async def create_api_key(key_data: APIKeyCreate, _: str = Depends(verify_api_key
     }
 
 @app.get("/api/keys", response_model=List[APIKeyResponse])
-async def list_api_keys(_: str = Depends(verify_api_key)):
-    """List all API keys"""
-    api_keys = load_api_keys()
+async def list_api_keys(
+    response: Response,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    _: str = Depends(verify_api_key),
+):
+    """List API keys ordered by creation time
+
+    since/until filter on created_at. When limit is set and more keys
+    follow, the cursor for the next page is returned in X-Next-Cursor.
+    """
+    after = tuple(decode_cursor(cursor)) if cursor else None
+    entries, next_after = key_index.page(
+        after=after,
+        limit=limit,
+        since=to_local_isoformat(since),
+        until=to_local_isoformat(until),
+    )
+    if next_after:
+        response.headers["X-Next-Cursor"] = encode_cursor(next_after)
     
     return [
         {
@@ -264,80 +574,158 @@ async def list_api_keys(_: str = Depends(verify_api_key)):
             "max_budget": data.get("max_budget"),
             "current_usage": data.get("usage", 0.0)
         }
-        for key, data in api_keys.items()
+        for key, data in entries
     ]
 
 @app.delete("/api/keys/{key_id}")
 async def delete_api_key(key_id: str, _: str = Depends(verify_api_key)):
     """Delete an API key"""
-    api_keys = load_api_keys()
-    usage_logs = load_usage_logs()
-    
-    if key_id not in api_keys:
+    if not key_index.delete(key_id):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="API key not found",
         )
     
-    del api_keys[key_id]
-    save_data(api_keys, usage_logs)
-    
     return {"message": "API key deleted successfully"}
 
 @app.get("/api/usage")
-async def get_usage(key_id: Optional[str] = None, _: str = Depends(verify_api_key)):
-    """Get usage statistics"""
-    usage_logs = load_usage_logs()
-    
-    if key_id:
-        # Return usage for specific key only
-        filtered_logs = [log for log in usage_logs if log["key_id"] == key_id]
-        
-        total_cost = sum(log["cost"] for log in filtered_logs)
-        model_usage = {}
-        
-        for log in filtered_logs:
-            model = log["model"]
-            if model not in model_usage:
-                model_usage[model] = {"cost": 0.0, "requests": 0}
-            
-            model_usage[model]["cost"] += log["cost"]
-            model_usage[model]["requests"] += 1
-        
-        return {
-            "key_id": key_id,
-            "total_cost": total_cost,
-            "model_usage": model_usage,
-            "request_count": len(filtered_logs)
-        }
-    else:
-        # Return all usage
-        total_cost = sum(log["cost"] for log in usage_logs)
-        key_usage = {}
-        model_usage = {}
-        
-        for log in usage_logs:
-            key = log["key_id"]
-            model = log["model"]
-            
-            if key not in key_usage:
-                key_usage[key] = {"cost": 0.0, "requests": 0}
-            
-            if model not in model_usage:
-                model_usage[model] = {"cost": 0.0, "requests": 0}
-            
-            key_usage[key]["cost"] += log["cost"]
-            key_usage[key]["requests"] += 1
-            
-            model_usage[model]["cost"] += log["cost"]
-            model_usage[model]["requests"] += 1
-        
-        return {
-            "total_cost": total_cost,
-            "key_usage": key_usage,
-            "model_usage": model_usage,
-            "request_count": len(usage_logs)
-        }
+async def get_usage(
+    response: Response,
+    key_id: Optional[str] = None,
+    hourly: bool = False,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    model: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=0, le=1000),
+    _: str = Depends(verify_api_key),
+):
+    """Get usage statistics
+
+    since/until select whole hourly buckets. Without key_id, key_usage is
+    paginated with limit/cursor (limit=0 returns only the totals) and the
+    next cursor is returned in X-Next-Cursor.
+    """
+    # Pick up records other workers appended since this worker last wrote
+    await asyncio.to_thread(usage_rollups.replay, usage_journal)
+    usage, next_key = usage_rollups.summary(
+        key_id,
+        include_hourly=hourly,
+        since_hour=to_hour_bucket(since),
+        until_hour=to_hour_bucket(until, round_up=True),
+        model=model,
+        after_key=decode_cursor(cursor) if cursor else None,
+        limit=limit,
+    )
+    if next_key:
+        response.headers["X-Next-Cursor"] = encode_cursor(next_key)
+    return usage
+
+@app.get("/api/usage/records")
+async def get_usage_records(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    key_id: Optional[str] = None,
+    model: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    _: str = Depends(verify_api_key),
+):
+    """Get raw usage records in [since, until), one page at a time"""
+    records, next_after = await asyncio.to_thread(
+        usage_journal.query,
+        since=to_local_isoformat(since),
+        until=to_local_isoformat(until),
+        key_id=key_id,
+        model=model,
+        after=decode_cursor(cursor) if cursor else None,
+        limit=limit,
+    )
+    return {
+        "records": records,
+        "next_cursor": encode_cursor(next_after) if next_after else None
+    }
+
+@app.get("/api/metrics/budget")
+async def get_budget_metrics(_: str = Depends(verify_api_key)):
+    """Get budget reservation metrics"""
+    return budget_ledger.metrics()
+
+@app.get("/api/metrics/usage-queue")
+async def get_usage_queue_metrics(_: str = Depends(verify_api_key)):
+    """Get usage accounting queue metrics"""
+    return usage_queue.metrics()
+
+@app.get("/api/pricing")
+async def get_pricing(_: str = Depends(verify_api_key)):
+    """Get the model pricing table (USD per 1K tokens)"""
+    return pricing.to_dict()
+
+@app.get("/api/metrics/routing-cache")
+async def get_routing_cache_metrics(_: str = Depends(verify_api_key)):
+    """Get auto routing decision cache metrics"""
+    return routing_cache.metrics()
+
+@app.delete("/api/metrics/routing-cache")
+async def clear_routing_cache(_: str = Depends(verify_api_key)):
+    """Rebuild the routing tables and drop cached routing decisions"""
+    routing_cache.invalidate()
+    return {"status": "cleared"}
+
+@app.get("/api/metrics/models")
+async def get_model_metrics(_: str = Depends(verify_api_key)):
+    """Get live per-model latency, time to first token, error rate and in-flight counts"""
+    return model_stats.snapshot(model_tiers())
+
+@app.get("/api/metrics/circuit-breakers")
+async def get_circuit_breakers(_: str = Depends(verify_api_key)):
+    """Get circuit breaker state, error and timeout rates per model deployment"""
+    return circuit_breakers.snapshot()
+
+@app.delete("/api/metrics/circuit-breakers")
+async def reset_circuit_breakers(model: Optional[str] = None, _: str = Depends(verify_api_key)):
+    """Close the breaker of one model (or all breakers)"""
+    circuit_breakers.reset(model)
+    return {"status": "reset", "model": model}
+
+@app.get("/api/metrics/response-cache")
+async def get_response_cache_metrics(_: str = Depends(verify_api_key)):
+    """Get response cache hit rates, bytes saved and tier sizes"""
+    if response_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **(await response_cache.metrics())}
+
+@app.delete("/api/metrics/response-cache")
+async def clear_response_cache(_: str = Depends(verify_api_key)):
+    """Drop every cached response (memory and disk)"""
+    if response_cache is not None:
+        await response_cache.clear()
+    return {"status": "cleared"}
+
+@app.get("/api/metrics/upstreams")
+async def get_upstream_metrics(_: str = Depends(verify_api_key)):
+    """Get per-model concurrency, queue depth and admission rejections"""
+    return admission.metrics()
+
+@app.get("/api/metrics/hedging")
+async def get_hedging_metrics(_: str = Depends(verify_api_key)):
+    """Get hedged request counters, hedge rate and current deadlines"""
+    if hedger is None:
+        return {"enabled": False}
+    return {"enabled": True, **hedger.metrics()}
+
+@app.get("/api/metrics/pii")
+async def get_pii_metrics(_: str = Depends(verify_api_key)):
+    """Get PII masking counters per category"""
+    return pii_masker.metrics()
+
+@app.get("/api/metrics/shared-state")
+async def get_shared_state_metrics(_: str = Depends(verify_api_key)):
+    """Get shared state sync metrics"""
+    metrics = shared_counters.metrics()
+    metrics["backend"] = "redis" if SHARED_STATE_URL.startswith(("redis", "unix")) else "local"
+    metrics["shared"] = bool(SHARED_STATE_URL)
+    return metrics
 
 # Stripe checkout session request model
 class CheckoutSessionRequest(BaseModel):
@@ -445,58 +833,40 @@ async def admin(request: Request):
     host = request.headers.get("host", "litellm-proxy.fly.dev")
     return templates.TemplateResponse("admin.html", {"request": request, "host": host})
 
-# Auto model selection endpoint
-@app.post("/v1/chat/completions/auto")
-async def auto_chat_completions(request: Request):
-    """
-    自動モデル選択を行うエンドポイント
-    リクエストを受け取り、内容に基づいて最適なモデルを選択し、適切なLLMにルーティングする
-    """
-    # リクエストボディを取得
-    request_data = await request.json()
-    
-    # 認証ヘッダーを取得
-    auth_header = request.headers.get("Authorization")
-    if not auth_header:
-        raise HTTPException(status_code=401, detail="Authorization header is required")
-    
-    # リクエストをルーティング（モデルを自動選択）
-    request_data["model"] = "auto"  # 自動選択モードを設定
-    routed_request = route_request(request_data)
-    
-    # 選択されたモデルをログに記録
-    selected_model = routed_request["model"]
-    logger.info(f"Auto-selected model: {selected_model} for request")
-    
-    # 標準のLiteLLMエンドポイントにリダイレクト
-    # 新しいリクエストを作成
-    new_request = Request(
-        scope=request.scope,
-        receive=request.receive,
-        send=request.send
-    )
-    
-    # ヘッダーとボディを設定
-    headers = dict(request.headers)
-    headers["content-type"] = "application/json"
-    
-    # LiteLLMルーターにリクエストを転送
-    response = await litellm_router.chat_completions(new_request, body=routed_request)
-    
-    # レスポンスにモデル選択情報を追加
-    response_data = response.body
-    if isinstance(response_data, bytes):
-        response_data = json.loads(response_data.decode("utf-8"))
-    
-    # モデル選択情報を追加
-    if isinstance(response_data, dict):
-        response_data["auto_selected_model"] = selected_model
+# Batch routing endpoint
+@app.post("/v1/route")
+async def route_requests(batch: RouteBatchRequest, _: str = Depends(verify_api_key)):
+    """Select a model and estimate the cost for many requests without calling any model"""
+    if len(batch.requests) > ROUTE_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {ROUTE_BATCH_MAX_ITEMS} requests per batch",
+        )
     
-    return JSONResponse(
-        content=response_data,
-        status_code=response.status_code,
-        headers=dict(response.headers)
+    # Feature extraction is CPU-bound; keep it off the event loop
+    results = await asyncio.to_thread(
+        route_batch,
+        [item.model_dump() for item in batch.requests],
+        pricing=pricing,
+        default_max_tokens=MAX_TOKENS_PER_REQUEST,
+        parallel_chars=ROUTE_BATCH_PARALLEL_CHARS,
+        processes=ROUTE_BATCH_PROCESSES,
     )
+    
+    model_counts = {}
+    for result in results:
+        model_counts[result["model"]] = model_counts.get(result["model"], 0) + 1
+    return {
+        "results": results,
+        "total_estimated_cost": sum(result["estimated_cost"] for result in results),
+        "model_counts": model_counts
+    }
+
+# Auto model selection endpoint
+# POST /v1/chat/completions/auto is served by ModelRouterMiddleware: the request is
+# routed with "model": "auto" and handled as /v1/chat/completions, so streaming
+# works as on the direct endpoint. The chosen model is returned in the
+# X-Auto-Selected-Model header (and as auto_selected_model in JSON responses).
 
 # Health check endpoint
 @app.get("/health")
@@ -504,14 +874,40 @@ async def health_check():
     """Health check endpoint"""
     return {"status": "healthy"}
 
+# Seconds between two callback timestamps (datetimes or epoch floats)
+def _elapsed(start, end):
+    if start is None or end is None:
+        return None
+    delta = end - start
+    return delta.total_seconds() if hasattr(delta, "total_seconds") else float(delta)
+
+# Feed latency, time to first token and outcome of a completion into the per-model
+# statistics and circuit breakers
+def record_model_stats(kwargs, metadata, success, start_time, end_time):
+    model = metadata.get("model_group") or kwargs.get("model")
+    ttft = _elapsed(start_time, kwargs.get("completion_start_time")) if kwargs.get("stream") else None
+    model_stats.finish(
+        metadata.get("model_stats_token"),
+        success=success,
+        latency=_elapsed(start_time, end_time),
+        ttft=ttft,
+        model=model,
+    )
+    circuit_breakers.record(model, success, kwargs.get("exception"))
+
 # LiteLLM callback function
 def litellm_success_callback(kwargs, response_obj, start_time, end_time):
     try:
+        metadata = kwargs.get("litellm_params", {}).get("metadata", {}) or {}
+        reservation_id = metadata.get("budget_reservation_id")
+        record_model_stats(kwargs, metadata, True, start_time, end_time)
+        
         # Get API key
-        api_key = kwargs.get("litellm_params", {}).get("metadata", {}).get("api_key")
+        api_key = metadata.get("api_key")
         
         if not api_key:
             logger.warning("API key not found")
+            budget_ledger.release(reservation_id)
             return
         
         # Get model name
@@ -525,22 +921,49 @@ def litellm_success_callback(kwargs, response_obj, start_time, end_time):
         request_id = response_obj.get("id", str(uuid.uuid4()))
         
         # Log usage
-        log_usage(api_key, model, input_tokens, output_tokens, request_id)
+        log_usage(api_key, model, input_tokens, output_tokens, request_id, reservation_id)
         
     except Exception as e:
         logger.error(f"Callback error: {str(e)}")
 
+# LiteLLM failure callback: give back the budget reserved for the request
+def litellm_failure_callback(kwargs, response_obj, start_time, end_time):
+    try:
+        metadata = kwargs.get("litellm_params", {}).get("metadata", {}) or {}
+        budget_ledger.release(metadata.get("budget_reservation_id"))
+        record_model_stats(kwargs, metadata, False, start_time, end_time)
+    except Exception as e:
+        logger.error(f"Failure callback error: {str(e)}")
+
+# Copy balances other workers added into the key index so reported usage includes them
+async def run_balance_sync():
+    while True:
+        await asyncio.sleep(API_KEYS_FLUSH_INTERVAL)
+        for key, balance in budget_ledger.shared_balances():
+            key_index.raise_usage(key, balance)
+
 # Initialize the proxy
 @app.on_event("startup")
 async def startup():
     # Initialize API keys storage
     init_api_keys()
+    usage_journal.open()
+    migrate_legacy_usage()
+    
+    # Bring the usage rollups up to date with the journal (each worker keeps its own snapshot)
+    usage_rollups.claim_snapshot_slot()
+    usage_rollups.load()
+    replayed = usage_rollups.replay(usage_journal)
+    if replayed:
+        logger.info(f"Replayed {replayed} usage records into rollups")
+    
+    # Load the resident key index
+    key_index.load()
     
     # Create a default admin API key if none exists
-    api_keys = load_api_keys()
-    if not api_keys:
+    if not len(key_index):
         admin_key = f"sk-{uuid.uuid4().hex}"
-        api_keys[admin_key] = {
+        key_index.put(admin_key, {
             "name": "admin",
             "created_at": datetime.now().isoformat(),
             "expires_at": None,
@@ -548,33 +971,74 @@ async def startup():
             "metadata": {"role": "admin"},
             "max_budget": None,
             "usage": 0.0
-        }
-        usage_logs = []
-        save_data(api_keys, usage_logs)
+        })
+        key_index.flush()
         logger.info(f"Created default admin API key: {admin_key}")
     
+    # Publish persisted balances to the shared state (balances already there win)
+    await budget_ledger.seed_balances({
+        key: data.get("usage", 0.0) for key, data in key_index.items() if data.get("max_budget")
+    })
+    
     # LiteLLM settings
     litellm.success_callback = [litellm_success_callback]
+    litellm.failure_callback = [litellm_failure_callback]
+    usage_queue.start()
     
     # PII detection settings - add custom function to process prompts
     litellm.add_function_to_prompt = mask_pii
     
     # Enable caching
     if ENABLE_CACHING:
+        response_cache.open()
         litellm.cache = litellm.Cache()
         logger.info("Caching enabled")
     
-    # Enable cost tracking
-    litellm.success_callback = ["litellm.callbacks.track_cost_callback"]
+    # Enable cost tracking (keep our usage callback registered as well)
+    litellm.success_callback.append("litellm.callbacks.track_cost_callback")
     
     # Initialize proxy config
     proxy_config = ProxyConfig()
     # Load config from file
-    litellm.config_path = "config.yaml"
+    litellm.config_path = CONFIG_FILE
     litellm.set_verbose = True
     
+    # Write key changes back to disk and pick up other workers' changes in the background
+    app.state.key_flusher = asyncio.create_task(key_index.run_flusher())
+    app.state.usage_syncer = asyncio.create_task(usage_journal.run_syncer())
+    app.state.rollups_flusher = asyncio.create_task(usage_rollups.run_flusher(usage_journal))
+    app.state.shared_state_syncer = asyncio.create_task(shared_counters.run())
+    if SHARED_STATE_URL:
+        app.state.balance_syncer = asyncio.create_task(run_balance_sync())
+    
     logger.info("LiteLLM Proxy started")
 
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.key_flusher.cancel()
+    app.state.usage_syncer.cancel()
+    app.state.rollups_flusher.cancel()
+    app.state.shared_state_syncer.cancel()
+    shutdown_process_pool()
+    if SHARED_STATE_URL:
+        app.state.balance_syncer.cancel()
+    
+    # Write out queued usage before closing the journal
+    await usage_queue.stop()
+    
+    # Push this worker's remaining increments to the shared state
+    try:
+        await shared_counters.close()
+    except Exception as e:
+        logger.error(f"Shared state close failed: {str(e)}")
+    
+    # Persist any key changes and usage records that have not been flushed yet
+    key_index.flush()
+    usage_journal.close()
+    usage_rollups.flush()
+    if response_cache is not None:
+        response_cache.close()
+
 # Run the proxy server
 if __name__ == "__main__":
     import uvicorn
@@ -1,32 +1,327 @@
-from starlette.middleware.base import BaseHTTPMiddleware
-from fastapi import Request
-import json
+from fastapi.responses import JSONResponse
 from model_router import route_request
+from request_context import RequestContext, dumps, set_request_context
+from pii_masker import SSEMaskingStream
+from admission import AdmissionRejected
 import logging
 
 logger = logging.getLogger("litellm-proxy")
 
-class ModelRouterMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        # /v1/chat/completionsエンドポイントのみを処理
-        if request.url.path == "/v1/chat/completions" and request.method == "POST":
-            # リクエストボディを読み取り
-            body = await request.body()
-            request_data = json.loads(body)
-            
-            # モデルが "auto" の場合、自動選択を行う
-            if request_data.get("model") == "auto":
-                # リクエストをルーティング
-                routed_request = route_request(request_data)
-                selected_model = routed_request["model"]
-                logger.info(f"Auto-selected model: {selected_model} for request")
-                
-                # リクエストを更新
-                body = json.dumps(routed_request).encode()
-                
-                # 新しいリクエストを作成
-                request._body = body
-        
+CHAT_COMPLETIONS_PATH = "/v1/chat/completions"
+# 常に自動選択を行うエンドポイント（/v1/chat/completions として処理し、応答はそのまま中継する）
+AUTO_CHAT_COMPLETIONS_PATH = "/v1/chat/completions/auto"
+
+# 純粋なASGIミドルウェア
+# BaseHTTPMiddlewareと違い、応答（SSEストリームを含む）をタスクやメモリチャネルで
+# 中継せず、送信メッセージをそのまま（必要な場合のみマスクして）下流から送り返す。
+# リクエストボディは一度だけ読み取って RequestContext に解析し、以降の処理（予約・ルーティング・
+# ヘッジ・エンドポイント・LiteLLM）で共有する。書き換えた場合は新しいボディを receive から渡す。
+class ModelRouterMiddleware:
+    def __init__(self, app, admit_request=None, release_request=None, response_masker=None, hedge_request=None,
+                 admission=None, breakers=None, response_cache=None):
+        self.app = app
+        # admit_request(context) -> (tracking, error_response)
+        # レート制限・予算予約・実行中カウントを行い、拒否する場合はエラー応答を返す
+        # tracking（予約IDなど）はコールバックに渡すためリクエストのメタデータに追加する
+        self.admit_request = admit_request
+        # release_request(tracking) は失敗したリクエストの予約と実行中カウントを解放する
+        self.release_request = release_request
+        # response_masker (PIIMasker) が指定された場合、ストリーミング応答の個人情報をマスク
+        self.response_masker = response_masker
+        # hedge_request(context, tracking) -> Optional[Response]
+        # ヘッジ対象のモデルならプライマリとフォールバックを投機的に呼び出して応答を返す（対象外はNone）
+        self.hedge_request = hedge_request
+        # admission (AdmissionController) はモデルごとの同時実行数と待ち行列を制限する
+        self.admission = admission
+        # breakers (CircuitBreakers) が開いているモデルは呼び出さずにフォールバック先へ切り替える
+        self.breakers = breakers
+        # response_cache (ResponseCache) にヒットしたリクエストは上流を呼ばずに保存済みの応答を返す
+        self.response_cache = response_cache
+
+    async def __call__(self, scope, receive, send):
+        # /v1/chat/completions（と /v1/chat/completions/auto）エンドポイントのみを処理
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in (
+            CHAT_COMPLETIONS_PATH, AUTO_CHAT_COMPLETIONS_PATH
+        ):
+            await self.app(scope, receive, send)
+            return
+        force_auto = scope["path"] == AUTO_CHAT_COMPLETIONS_PATH
+
+        # リクエストボディを読み取り（途中で切断された場合は何もしない）
+        body = await _read_body(receive)
+        if body is None:
+            return
+
+        try:
+            context = RequestContext.from_body(body, _header(scope, b"authorization"))
+        except ValueError:
+            # 不正なボディはそのまま渡し、エラー応答はLiteLLMに任せる
+            await self.app(scope, _replay_body(body, receive), send)
+            return
+
+        request_data = context.data
+        tracking = None
+        release_slot = None
+        modified = False
+        selected_model = None
+
+        if force_auto:
+            if context.api_key is None:
+                response = JSONResponse(status_code=401, content={"detail": "Authorization header is required"})
+                await response(scope, receive, send)
+                return
+            # 自動選択モードを設定し、標準のLiteLLMエンドポイントで処理する
+            request_data["model"] = "auto"
+            scope = dict(scope, path=CHAT_COMPLETIONS_PATH, raw_path=CHAT_COMPLETIONS_PATH.encode())
+
+        # モデルが "auto" の場合、自動選択を行う
+        if request_data.get("model") == "auto":
+            # リクエストをルーティング
+            request_data = context.data = route_request(request_data, context)
+            selected_model = request_data["model"]
+            logger.info(f"Auto-selected model: {selected_model} for request")
+            modified = True
+
+        # 障害中（ブレーカーが開いている）のモデルはフォールバック先に切り替え、なければ即座に503
+        requested_model = request_data.get("model")
+        if self.breakers is not None and requested_model:
+            available_model = self.breakers.route_around(requested_model)
+            if available_model is None:
+                retry_after = max(1, int(self.breakers.retry_after(requested_model)))
+                response = JSONResponse(
+                    status_code=503,
+                    content={"detail": f"{requested_model} is temporarily unavailable"},
+                    headers={"Retry-After": str(retry_after)},
+                )
+                await response(scope, receive, send)
+                return
+            if available_model != requested_model:
+                logger.info(f"Circuit open for {requested_model}; using {available_model}")
+                request_data["model"] = available_model
+                if selected_model is not None:
+                    selected_model = available_model
+                modified = True
+
+        # 推定コストを事前に予約（レート制限・予算超過の場合は即座に拒否）
+        if self.admit_request:
+            tracking, error_response = self.admit_request(context)
+            if error_response is not None:
+                await error_response(scope, receive, send)
+                return
+            if tracking:
+                # コールバックで精算・集計できるよう予約IDなどをメタデータに渡す
+                metadata = dict(request_data.get("metadata") or {})
+                metadata.update(tracking)
+                request_data["metadata"] = metadata
+                modified = True
+
+        # 応答は送信メッセージ単位でそのまま転送する
+        # エラー応答なら予約を解放し、SSEのデルタは逐次マスク（一致しうる末尾だけを次のチャンクまで保留）
+        # 自動選択したモデルは X-Auto-Selected-Model ヘッダーで返す（ストリーミングでも最初のバイトから分かる）
+        # /v1/chat/completions/auto のJSON応答には従来どおり auto_selected_model も追加する
+        # キャッシュ対象のリクエストは成功した応答を保存する（SSEは完了した時点で1つの応答に組み立てる）
+        masking = None
+        held_start = None
+        cache_entry = None
+        captured = None
+        assembler = None
+
+        async def send_response(message):
+            nonlocal masking, held_start, captured, assembler
+            if message["type"] == "http.response.start":
+                content_type = _header_in(message, b"content-type")
+                if message["status"] >= 400:
+                    self._release(tracking)
+                elif self.response_masker is not None and content_type.startswith("text/event-stream"):
+                    masking = SSEMaskingStream(self.response_masker)
+                extra_headers = []
+                if cache_entry is not None:
+                    extra_headers.append((b"x-cache", b"MISS"))
+                    if message["status"] == 200 and content_type.startswith("application/json"):
+                        captured = []
+                    elif message["status"] == 200 and content_type.startswith("text/event-stream"):
+                        assembler = self.response_cache.assembler()
+                if selected_model is not None:
+                    extra_headers.append((b"x-auto-selected-model", selected_model.encode()))
+                if extra_headers:
+                    message = dict(message, headers=list(message.get("headers") or []) + extra_headers)
+                if selected_model is not None and force_auto and content_type.startswith("application/json"):
+                    # 本文の先頭を見てからContent-Lengthを確定する
+                    held_start = message
+                    return
+            elif message["type"] == "http.response.body":
+                if captured is not None:
+                    captured.append(message.get("body", b""))
+                    if not message.get("more_body", False):
+                        self.response_cache.put(cache_entry[0], b"".join(captured), cache_entry[1])
+                        captured = None
+                elif assembler is not None:
+                    # マスク前の上流の応答を組み立てる（再生時に改めてマスクされる）
+                    assembler.feed(message.get("body", b""))
+                    if not message.get("more_body", False):
+                        self.response_cache.put_stream(cache_entry[0], assembler, cache_entry[1])
+                        assembler = None
+                if held_start is not None:
+                    body = message.get("body", b"")
+                    field = b'"auto_selected_model":' + dumps(selected_model)
+                    updated = _insert_field(body, field)
+                    start, held_start = _add_content_length(held_start, len(updated) - len(body)), None
+                    await send(start)
+                    message = dict(message, body=updated)
+                elif masking is not None:
+                    more_body = message.get("more_body", False)
+                    chunk = masking.feed(message.get("body", b""))
+                    if not more_body:
+                        chunk += masking.finish()
+                    elif not chunk:
+                        return
+                    message = dict(message, body=chunk)
+            await send(message)
+
+        # 応答キャッシュを確認（認証済みのリクエストのみ。ヒットした場合は上流を呼ばずに返す）
+        # ストリーミングのリクエストには保存済みの応答を chat.completion.chunk のSSEとして再生する
+        if self.response_cache is not None and (self.admit_request is None or context.key_record is not None):
+            cache_entry = self.response_cache.key_for(
+                request_data, context.key_record, _header(scope, b"cache-control"), context.prompt_hash
+            )
+        if cache_entry is not None:
+            cached = await self.response_cache.get(*cache_entry)
+            events = None
+            if cached is not None and request_data.get("stream"):
+                events = self.response_cache.replay(cached, request_data)
+            if events is not None:
+                self._release(tracking)
+                cache_entry = None
+                await send_response({
+                    "type": "http.response.start",
+                    "status": 200,
+                    "headers": [
+                        (b"content-type", b"text/event-stream; charset=utf-8"),
+                        (b"cache-control", b"no-cache"),
+                        (b"x-cache", b"HIT"),
+                    ],
+                })
+                try:
+                    for event in events:
+                        await send_response({"type": "http.response.body", "body": event, "more_body": True})
+                    await send_response({"type": "http.response.body", "body": b""})
+                finally:
+                    if masking is not None:
+                        masking.close()
+                return
+            if cached is not None and not request_data.get("stream"):
+                self._release(tracking)
+                cache_entry = None
+                await send_response({
+                    "type": "http.response.start",
+                    "status": 200,
+                    "headers": [
+                        (b"content-type", b"application/json"),
+                        (b"content-length", str(len(cached)).encode()),
+                        (b"x-cache", b"HIT"),
+                    ],
+                })
+                await send_response({"type": "http.response.body", "body": cached})
+                return
+
+        # 上流モデルの実行枠を確保（待ち行列が満杯・待ち時間超過の場合は429/503で拒否）
+        if self.admission is not None:
+            try:
+                release_slot = await self.admission.acquire(request_data.get("model"))
+            except AdmissionRejected as e:
+                self._release(tracking)
+                response = JSONResponse(status_code=e.status_code, content={"detail": e.detail}, headers=e.headers)
+                await response(scope, receive, send)
+                return
+            except BaseException:
+                self._release(tracking)
+                raise
+
+        # 解析済みのボディと特徴量を下流と共有（LiteLLMは scope["parsed_body"] があればボディを再解析しない）
+        set_request_context(scope, context)
+        if modified:
+            # 書き換えたボディを下流に渡す（Content-Lengthも更新）
+            scope = _with_content_length(scope, len(context.encode()))
+        scope["parsed_body"] = context.parsed_body()
+        receive = _replay_body(context.body, receive)
+
         # 次のミドルウェアまたはエンドポイントにリクエストを渡す
-        response = await call_next(request)
-        return response
\ No newline at end of file
+        # ストリーミング応答は本文の送信が終わるまで実行枠を保持する
+        try:
+            response = None
+            if self.hedge_request is not None:
+                response = await self.hedge_request(context, tracking)
+            if response is not None:
+                await response(scope, receive, send_response)
+            else:
+                await self.app(scope, receive, send_response)
+        except Exception:
+            self._release(tracking)
+            raise
+        finally:
+            if masking is not None:
+                masking.close()
+            if release_slot is not None:
+                release_slot()
+
+    def _release(self, tracking):
+        if tracking and self.release_request:
+            self.release_request(tracking)
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+def _replay_body(body: bytes, receive):
+    # 読み取り済みのボディを一度だけ返し、以降は元の receive（切断の通知など）に委ねる
+    sent = False
+
+    async def replay():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+
+    return replay
+
+def _header(scope, name: bytes):
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+def _header_in(message, name: bytes) -> str:
+    for key, value in message.get("headers") or []:
+        if key.lower() == name:
+            return value.decode("latin-1")
+    return ""
+
+def _insert_field(body: bytes, field: bytes) -> bytes:
+    # JSONオブジェクトの先頭にフィールドを追加する（本文の解析・再エンコードはしない）
+    stripped = body.lstrip()
+    if not stripped.startswith(b"{"):
+        return body
+    rest = stripped[1:]
+    separator = b"" if rest.lstrip().startswith(b"}") else b","
+    return b"{" + field + separator + rest
+
+def _add_content_length(message, delta: int):
+    if not delta:
+        return message
+    headers = [
+        (key, str(int(value) + delta).encode()) if key.lower() == b"content-length" else (key, value)
+        for key, value in message.get("headers") or []
+    ]
+    return dict(message, headers=headers)
+
+def _with_content_length(scope, length: int):
+    headers = [(key, value) for key, value in scope["headers"] if key != b"content-length"]
+    headers.append((b"content-length", str(length).encode()))
+    return dict(scope, headers=headers)
@@ -1,6 +1,15 @@
 import re
+import os
 import json
-from typing import Dict, List, Any, Optional, Union
+import time
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Union
+
+from model_stats import model_stats
+from circuit_breaker import circuit_breakers
+from token_estimator import token_estimator
 
 # モデルの特性と料金情報
 MODEL_INFO = {
@@ -55,25 +64,56 @@ MODEL_INFO = {
     }
 }
 
-# 言語検出パターン
-LANGUAGE_PATTERNS = {
-    "japanese": r'[\u3040-\u309F\u30A0-\u30FF\u4E00-\u9FFF]',
-    "chinese": r'[\u4E00-\u9FFF\u3400-\u4DBF\u20000-\u2A6DF\u2A700-\u2B73F\u2B740-\u2B81F\u2B820-\u2CEAF]',
-    "korean": r'[\uAC00-\uD7AF\u1100-\u11FF\u3130-\u318F\uA960-\uA97F\uD7B0-\uD7FF]',
-    "russian": r'[А-Яа-я]',
-    "arabic": r'[\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF\uFB50-\uFDFF\uFE70-\uFEFF]',
-    "thai": r'[\u0E00-\u0E7F]'
-}
+# 複雑さ階層の順序
+_COMPLEXITY_ORDER = {"low": 0, "medium": 1, "high": 2}
+
+# プロンプトのトークン数による複雑さの閾値（英語で約1000文字・3000文字に相当）
+COMPLEXITY_MEDIUM_TOKENS = 250
+COMPLEXITY_HIGH_TOKENS = 750
 
-# コード検出パターン
-CODE_PATTERNS = {
-    "python": r'(import\s+[a-zA-Z0-9_]+|def\s+[a-zA-Z0-9_]+\s*\(|class\s+[a-zA-Z0-9_]+\s*:|\s*if\s+.*:\s*$)',
-    "javascript": r'(function\s+[a-zA-Z0-9_]+\s*\(|const\s+[a-zA-Z0-9_]+\s*=|let\s+[a-zA-Z0-9_]+\s*=|var\s+[a-zA-Z0-9_]+\s*=)',
-    "html": r'(<html|<body|<div|<p>|<script|<style)',
-    "sql": r'(SELECT\s+.*\s+FROM|INSERT\s+INTO|UPDATE\s+.*\s+SET|DELETE\s+FROM)',
-    "general_code": r'(for\s*\(|while\s*\(|\{\s*$|\}\s*$|if\s*\(.*\)\s*\{)'
+# 言語検出に使う文字範囲（言語ごとの文字数を数え、最も多い言語を採用）
+SCRIPT_RANGES = {
+    "japanese": [(0x3040, 0x309F), (0x30A0, 0x30FF), (0x4E00, 0x9FFF)],
+    "chinese": [(0x4E00, 0x9FFF), (0x3400, 0x4DBF), (0x20000, 0x2A6DF), (0x2A700, 0x2B73F), (0x2B740, 0x2B81F), (0x2B820, 0x2CEAF)],
+    "korean": [(0xAC00, 0xD7AF), (0x1100, 0x11FF), (0x3130, 0x318F), (0xA960, 0xA97F), (0xD7B0, 0xD7FF)],
+    "russian": [(0x0410, 0x044F)],
+    "arabic": [(0x0600, 0x06FF), (0x0750, 0x077F), (0x08A0, 0x08FF), (0xFB50, 0xFDFF), (0xFE70, 0xFEFF)],
+    "thai": [(0x0E00, 0x0E7F)]
 }
 
+# コード検出パターン（小文字化したテキストに適用）
+# 各パターンは先頭のアンカー文字列がテキストに含まれる場合のみ評価する
+CODE_SIGNATURES = [
+    # python
+    ("import", r'import\s+[a-z0-9_]+'),
+    ("def", r'def\s+[a-z0-9_]+\s*\('),
+    ("class", r'class\s+[a-z0-9_]+\s*:'),
+    ("if", r'(?m:if\s+.*:\s*$)'),
+    # javascript
+    ("function", r'function\s+[a-z0-9_]+\s*\('),
+    ("const", r'const\s+[a-z0-9_]+\s*='),
+    ("let", r'let\s+[a-z0-9_]+\s*='),
+    ("var", r'var\s+[a-z0-9_]+\s*='),
+    # html
+    ("<html", r'<html'),
+    ("<body", r'<body'),
+    ("<div", r'<div'),
+    ("<p>", r'<p>'),
+    ("<script", r'<script'),
+    ("<style", r'<style'),
+    # sql
+    ("select", r'select\s+.*\s+from'),
+    ("insert", r'insert\s+into'),
+    ("update", r'update\s+.*\s+set'),
+    ("delete", r'delete\s+from'),
+    # general_code
+    ("for", r'for\s*\('),
+    ("while", r'while\s*\('),
+    ("{", r'(?m:\{\s*$)'),
+    ("}", r'(?m:\}\s*$)'),
+    ("if", r'if\s*\(.*\)\s*\{'),
+]
+
 # 複雑な推論を必要とするタスクのキーワード
 COMPLEX_REASONING_KEYWORDS = [
     "analyze", "compare", "contrast", "evaluate", "explain", "synthesize", 
@@ -93,76 +133,238 @@ ECOMMERCE_KEYWORDS = [
     "商品", "ショッピング", "買う", "購入", "価格", "割引", "セール", "店舗", "小売", "注文", "配送", "楽天", "rakuten"
 ]
 
-def detect_language(text: str) -> Optional[str]:
-    """テキストの主要言語を検出する"""
-    language_counts = {}
-    
-    for language, pattern in LANGUAGE_PATTERNS.items():
-        matches = re.findall(pattern, text)
-        language_counts[language] = len(matches)
-    
-    if not language_counts or max(language_counts.values()) == 0:
+class KeywordAutomaton:
+    """複数のキーワードを1回の走査で検出するAho-Corasickオートマトン"""
+
+    def __init__(self, keywords):
+        self.keywords = sorted(set(keywords))
+        goto: List[Dict[str, int]] = [{}]
+        outputs: List[frozenset] = [frozenset()]
+        for keyword in self.keywords:
+            state = 0
+            for char in keyword:
+                if char not in goto[state]:
+                    goto.append({})
+                    outputs.append(frozenset())
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            outputs[state] = outputs[state] | {keyword}
+
+        # 失敗遷移を幅優先で求め、遷移表を決定性オートマトンに展開する
+        fail = [0] * len(goto)
+        transitions: List[Dict[str, int]] = [dict(goto[0])] + [None] * (len(goto) - 1)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            transitions[state] = {**transitions[fail[state]], **goto[state]}
+            for char, next_state in goto[state].items():
+                fail[next_state] = transitions[fail[state]].get(char, 0) if state else 0
+                outputs[next_state] = outputs[next_state] | outputs[fail[next_state]]
+                queue.append(next_state)
+        self._transitions = transitions
+        self._outputs = outputs
+
+    def find(self, text: str) -> Set[str]:
+        """テキスト（小文字化済み）に含まれるキーワードの集合を返す"""
+        transitions = self._transitions
+        outputs = self._outputs
+        found = set()
+        state = 0
+        for char in text:
+            state = transitions[state].get(char, 0)
+            if outputs[state]:
+                found |= outputs[state]
+        return found
+
+class PromptFeatures(NamedTuple):
+    """ルーティングに使うプロンプトの特徴量"""
+    length: int
+    tokens: int
+    language: Optional[str]
+    has_code: bool
+    has_ecommerce: bool
+    complex_keywords: int
+    creative_keywords: int
+    complexity: str
+
+def _build_script_table():
+    # 文字コード -> 文字種コード（str.translate用）。日本語と中国語で共有する漢字は "H"
+    codes = {"japanese": "J", "chinese": "C", "korean": "K", "russian": "R", "arabic": "A", "thai": "T"}
+    table = [" "] * (max(end for ranges in SCRIPT_RANGES.values() for _, end in ranges) + 1)
+    for language, ranges in SCRIPT_RANGES.items():
+        for start, end in ranges:
+            for codepoint in range(start, end + 1):
+                table[codepoint] = "H" if table[codepoint] in ("J", "C") else codes[language]
+    return "".join(table)
+
+# 言語ごとに数える文字種コード
+_SCRIPT_CODES = {
+    "japanese": "JH",
+    "chinese": "CH",
+    "korean": "K",
+    "russian": "R",
+    "arabic": "A",
+    "thai": "T"
+}
+
+def _compile_routing_tables():
+    # キーワード表・コードパターンからオートマトン等を構築する
+    global _SCRIPT_TABLE, _COMPLEX_KEYWORDS, _CREATIVE_KEYWORDS, _ECOMMERCE_KEYWORDS, _CODE_SIGNATURES, _KEYWORD_AUTOMATON
+    global _TIER_PEERS, _TIER_ALTERNATIVES
+    _SCRIPT_TABLE = _build_script_table()
+    _COMPLEX_KEYWORDS = frozenset(keyword.lower() for keyword in COMPLEX_REASONING_KEYWORDS)
+    _CREATIVE_KEYWORDS = frozenset(keyword.lower() for keyword in CREATIVE_KEYWORDS)
+    _ECOMMERCE_KEYWORDS = frozenset(keyword.lower() for keyword in ECOMMERCE_KEYWORDS)
+    _CODE_SIGNATURES = [(anchor, re.compile(pattern)) for anchor, pattern in CODE_SIGNATURES]
+    _KEYWORD_AUTOMATON = KeywordAutomaton(
+        _COMPLEX_KEYWORDS | _CREATIVE_KEYWORDS | _ECOMMERCE_KEYWORDS | {anchor for anchor, _ in CODE_SIGNATURES}
+    )
+    # 同じ複雑さ階層のモデル（遅延の比較対象）と、専門能力を共有する代替モデル
+    _TIER_PEERS = {
+        model: [peer for peer, peer_info in MODEL_INFO.items() if peer_info.get("complexity") == info.get("complexity")]
+        for model, info in MODEL_INFO.items()
+    }
+    # （モデル名と共有する能力の数、多い順）
+    _TIER_ALTERNATIVES = {}
+    for model, info in MODEL_INFO.items():
+        specialities = set(info["capabilities"]) - {"general"}
+        shared = {
+            peer: len(specialities & set(MODEL_INFO[peer]["capabilities"]))
+            for peer in _TIER_PEERS[model]
+            if peer != model and MODEL_INFO[peer].get("is_local", False) == info.get("is_local", False)
+        }
+        _TIER_ALTERNATIVES[model] = sorted(((peer, count) for peer, count in shared.items() if count), key=lambda item: -item[1])
+
+_compile_routing_tables()
+
+def _count_scripts(text: str) -> Dict[str, int]:
+    # 1回の走査で文字種コードに変換してから数える（ASCIIのみのテキストは走査不要）
+    if text.isascii():
+        return {language: 0 for language in _SCRIPT_CODES}
+    classified = text.translate(_SCRIPT_TABLE)
+    counts = {code: classified.count(code) for code in "JCHKRAT"}
+    return {language: sum(counts[code] for code in codes) for language, codes in _SCRIPT_CODES.items()}
+
+def _language_from_counts(counts: Dict[str, int]) -> Optional[str]:
+    if not counts or max(counts.values()) == 0:
         return None
-    
-    return max(language_counts.items(), key=lambda x: x[1])[0]
+    return max(counts.items(), key=lambda x: x[1])[0]
 
-def contains_code(text: str) -> bool:
-    """テキストにコードが含まれているかを検出する"""
-    for pattern_name, pattern in CODE_PATTERNS.items():
-        if re.search(pattern, text, re.IGNORECASE | re.MULTILINE):
+def _has_code(lowered: str, keywords: Set[str]) -> bool:
+    # アンカーが見つかったパターンだけを評価する
+    for anchor, pattern in _CODE_SIGNATURES:
+        if anchor in keywords and pattern.search(lowered):
             return True
     return False
 
-def estimate_complexity(text: str) -> str:
-    """テキストの複雑さを推定する"""
-    # 文字数による基本的な複雑さの推定
-    if len(text) > 1000:
-        base_complexity = "medium"
-    elif len(text) > 3000:
+def _complexity(tokens: int, complex_keywords: int, creative_keywords: int) -> str:
+    # トークン数による基本的な複雑さの推定
+    if tokens > COMPLEXITY_HIGH_TOKENS:
         base_complexity = "high"
+    elif tokens > COMPLEXITY_MEDIUM_TOKENS:
+        base_complexity = "medium"
     else:
         base_complexity = "low"
-    
+
     # 複雑な推論キーワードの検出
-    for keyword in COMPLEX_REASONING_KEYWORDS:
-        if keyword.lower() in text.lower():
-            return "high"
-    
+    if complex_keywords:
+        return "high"
+
     # 創造的なタスクの検出
-    creative_count = 0
-    for keyword in CREATIVE_KEYWORDS:
-        if keyword.lower() in text.lower():
-            creative_count += 1
-    
-    if creative_count >= 2:
+    if creative_keywords >= 2:
         return "medium" if base_complexity == "low" else "high"
-    
+
     return base_complexity
 
+def extract_features(text: str) -> PromptFeatures:
+    """プロンプトを1回走査してルーティング用の特徴量を抽出する"""
+    lowered = text.lower()
+    keywords = _KEYWORD_AUTOMATON.find(lowered)
+    complex_keywords = len(keywords & _COMPLEX_KEYWORDS)
+    creative_keywords = len(keywords & _CREATIVE_KEYWORDS)
+    tokens = token_estimator.count(text)
+    return PromptFeatures(
+        length=len(text),
+        tokens=tokens,
+        language=_language_from_counts(_count_scripts(text)),
+        has_code=_has_code(lowered, keywords),
+        has_ecommerce=bool(keywords & _ECOMMERCE_KEYWORDS),
+        complex_keywords=complex_keywords,
+        creative_keywords=creative_keywords,
+        complexity=_complexity(tokens, complex_keywords, creative_keywords),
+    )
+
+def detect_language(text: str) -> Optional[str]:
+    """テキストの主要言語を検出する"""
+    return _language_from_counts(_count_scripts(text))
+
+def contains_code(text: str) -> bool:
+    """テキストにコードが含まれているかを検出する"""
+    lowered = text.lower()
+    return _has_code(lowered, _KEYWORD_AUTOMATON.find(lowered))
+
+def estimate_complexity(text: str) -> str:
+    """テキストの複雑さを推定する"""
+    return extract_features(text).complexity
+
 def contains_ecommerce_keywords(text: str) -> bool:
     """テキストにEコマース関連のキーワードが含まれているかを検出する"""
-    text_lower = text.lower()
-    for keyword in ECOMMERCE_KEYWORDS:
-        if keyword.lower() in text_lower:
-            return True
-    return False
+    return bool(_KEYWORD_AUTOMATON.find(text.lower()) & _ECOMMERCE_KEYWORDS)
+
+def user_inputs_of(messages: List[Dict[str, str]]) -> str:
+    """ルーティングの対象となるユーザー入力（userメッセージを連結したもの）"""
+    return " ".join([_content_text(msg.get("content")) for msg in messages if msg.get("role") == "user"])
+
+def _content_text(content: Any) -> str:
+    # マルチパートのcontentはテキスト部分のみを連結する
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content or ""
+
+def estimate_prompt_tokens(messages: List[Dict[str, Any]]) -> int:
+    """メッセージ全体の入力トークン数を推定する（チャット形式のオーバーヘッドを含む）"""
+    return token_estimator.count_messages(messages)
+
+def fit_context_window(model: str, required_tokens: int) -> str:
+    """入力と出力の合計がコンテキストウィンドウ（MODEL_INFOのmax_tokens）に収まるモデルを返す"""
+    info = MODEL_INFO.get(model)
+    if info is None or required_tokens <= info.get("max_tokens", 0):
+        return model
+    candidates = [candidate for candidate, candidate_info in MODEL_INFO.items() if candidate_info.get("max_tokens", 0) >= required_tokens]
+    if not candidates:
+        # どのモデルにも収まらない場合はウィンドウが最大のモデル
+        return max(MODEL_INFO, key=lambda candidate: MODEL_INFO[candidate].get("max_tokens", 0))
+    healthy = [candidate for candidate in candidates if _usable(candidate, _TIER_PEERS[candidate])] or candidates
+    # 専門能力の共有が多く、同じかそれ以上の階層で、安価なモデルを優先
+    specialities = set(info["capabilities"]) - {"general"}
+    tier = _COMPLEXITY_ORDER.get(info.get("complexity"), 0)
+
+    def preference(candidate):
+        candidate_info = MODEL_INFO[candidate]
+        candidate_tier = _COMPLEXITY_ORDER.get(candidate_info.get("complexity"), 0)
+        return (
+            -len(specialities & set(candidate_info["capabilities"])),
+            candidate_tier < tier,
+            candidate_info.get("cost_per_1k_tokens", 0.0),
+        )
+
+    return min(healthy, key=preference)
 
 def select_best_model(messages: List[Dict[str, str]], user_preferences: Optional[Dict[str, Any]] = None) -> str:
-    """メッセージの内容に基づいて最適なモデルを選択する"""
-    # メッセージからユーザーの入力を抽出
-    user_inputs = " ".join([msg["content"] for msg in messages if msg["role"] == "user"])
-    
-    # 言語の検出
-    language = detect_language(user_inputs)
-    
-    # コードの検出
-    has_code = contains_code(user_inputs)
-    
-    # Eコマース関連キーワードの検出
-    has_ecommerce = contains_ecommerce_keywords(user_inputs)
-    
-    # 複雑さの推定
-    complexity = estimate_complexity(user_inputs)
+    """メッセージの内容に基づいて最適なモデルを選択する（障害中・不調のモデルは避ける）"""
+    return demote_unhealthy(_static_choice(messages, user_preferences))
+
+def _static_choice(messages: List[Dict[str, str]], user_preferences: Optional[Dict[str, Any]] = None) -> str:
+    # 言語・コード・Eコマース関連キーワード・複雑さを1回の走査で抽出
+    features = extract_features(user_inputs_of(messages))
+    return select_model_for_features(features, user_preferences)
+
+def select_model_for_features(features: PromptFeatures, user_preferences: Optional[Dict[str, Any]] = None) -> str:
+    """抽出済みの特徴量から最適なモデルを選択する"""
+    language = features.language
+    has_code = features.has_code
+    has_ecommerce = features.has_ecommerce
+    complexity = features.complexity
     
     # ローカルモデルを優先するかどうか
     prefer_local = user_preferences and user_preferences.get("prefer_local", False)
@@ -196,8 +398,120 @@ def select_best_model(messages: List[Dict[str, str]], user_preferences: Optional
     else:
         return "claude-3-haiku"  # 最も安価なモデル
 
-def route_request(request_data: Dict[str, Any]) -> Dict[str, Any]:
-    """リクエストを受け取り、必要に応じてモデルを自動選択して更新したリクエストを返す"""
+def _usable(model: str, peers: List[str]) -> bool:
+    # サーキットブレーカーが開いておらず、遅延・エラー率も正常
+    return not circuit_breakers.is_open(model) and model_stats.is_healthy(model, peers)
+
+def demote_unhealthy(model: str) -> str:
+    """障害中・遅い・失敗が多いモデルを、同じ階層で能力を共有する健全なモデルに置き換える"""
+    peers = _TIER_PEERS.get(model)
+    if peers is None or _usable(model, peers):
+        return model
+    healthy = [(peer, count) for peer, count in _TIER_ALTERNATIVES[model] if _usable(peer, peers)]
+    if not healthy:
+        # 健全な代替がなければ元のモデルのまま
+        return model
+    # 共有する能力が最も多いモデルの中から、エラー率・遅延が小さいものを選ぶ
+    best_count = healthy[0][1]
+    return min((peer for peer, count in healthy if count == best_count), key=model_stats.rank)
+
+def model_tiers() -> Dict[str, str]:
+    """モデル名 -> 複雑さ階層"""
+    return {model: info.get("complexity", "") for model, info in MODEL_INFO.items()}
+
+def routing_tables_fingerprint() -> str:
+    """MODEL_INFOとルーティング表の内容から計算したフィンガープリント"""
+    tables = (MODEL_INFO, COMPLEX_REASONING_KEYWORDS, CREATIVE_KEYWORDS, ECOMMERCE_KEYWORDS, SCRIPT_RANGES, CODE_SIGNATURES)
+    return hashlib.blake2b(repr(tables).encode(), digest_size=16).hexdigest()
+
+class RoutingCache:
+    """自動モデル選択の結果を保持するLRUキャッシュ
+
+    キーはユーザー入力とuser_preferencesのハッシュ。MODEL_INFOやルーティング表が
+    変更されると（check_interval秒ごとに確認）、表を再構築してキャッシュを破棄する。
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300.0, check_interval: float = 1.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._fingerprint = routing_tables_fingerprint()
+        self._checked_at = time.monotonic()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "invalidations": 0}
+
+    @staticmethod
+    def make_key(user_inputs: str, user_preferences: Optional[Dict[str, Any]]) -> bytes:
+        digest = hashlib.blake2b(user_inputs.encode("utf-8", "surrogatepass"), digest_size=16)
+        if user_preferences:
+            digest.update(json.dumps(user_preferences, sort_keys=True, default=str).encode())
+        return digest.digest()
+
+    def get(self, key: bytes) -> Optional[str]:
+        now = time.monotonic()
+        self._check_tables(now)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            model, expires = entry
+            if expires < now:
+                del self._entries[key]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return model
+
+    def put(self, key: bytes, model: str):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (model, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self):
+        """ルーティング表を再構築し、キャッシュを破棄する"""
+        _compile_routing_tables()
+        with self._lock:
+            self._entries.clear()
+            self._fingerprint = routing_tables_fingerprint()
+            self.stats["invalidations"] += 1
+
+    def _check_tables(self, now: float):
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        if routing_tables_fingerprint() != self._fingerprint:
+            self.invalidate()
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            metrics = dict(self.stats)
+            metrics["size"] = len(self._entries)
+        lookups = metrics["hits"] + metrics["misses"]
+        metrics["hit_rate"] = metrics["hits"] / lookups if lookups else 0.0
+        metrics["maxsize"] = self.maxsize
+        metrics["ttl"] = self.ttl
+        return metrics
+
+# ルーティング結果のキャッシュ（ROUTING_CACHE_SIZE=0で無効）
+routing_cache = RoutingCache(
+    maxsize=int(os.environ.get("ROUTING_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("ROUTING_CACHE_TTL", 300)),
+)
+
+def route_request(request_data: Dict[str, Any], context=None) -> Dict[str, Any]:
+    """リクエストを受け取り、必要に応じてモデルを自動選択して更新したリクエストを返す
+
+    context (RequestContext) を渡すと、抽出済みのユーザー入力・特徴量・トークン数を再利用する。
+    """
     # リクエストのコピーを作成
     updated_request = request_data.copy()
     
@@ -206,8 +520,23 @@ def route_request(request_data: Dict[str, Any]) -> Dict[str, Any]:
         messages = updated_request.get("messages", [])
         user_preferences = updated_request.get("user_preferences", {})
         
-        # 最適なモデルを選択
-        best_model = select_best_model(messages, user_preferences)
+        # 最適なモデルを選択（同じ入力と設定の結果はキャッシュから返す）
+        user_inputs = context.user_inputs if context is not None else user_inputs_of(messages)
+        cache_key = routing_cache.make_key(user_inputs, user_preferences) if routing_cache.maxsize > 0 else None
+        best_model = routing_cache.get(cache_key) if cache_key is not None else None
+        if best_model is None:
+            features = context.features if context is not None else extract_features(user_inputs)
+            best_model = select_model_for_features(features, user_preferences)
+            if cache_key is not None:
+                routing_cache.put(cache_key, best_model)
+        
+        # 現在の稼働状況に応じて同じ階層内で降格（キャッシュには静的な選択結果のみ保持）
+        best_model = demote_unhealthy(best_model)
+        
+        # 入力と要求された出力がコンテキストウィンドウに収まるモデルを選ぶ
+        prompt_tokens = context.prompt_tokens if context is not None else estimate_prompt_tokens(messages)
+        required_tokens = prompt_tokens + (updated_request.get("max_tokens") or 0)
+        best_model = fit_context_window(best_model, required_tokens)
         
         # リクエストのモデルを更新
         updated_request["model"] = best_model
@@ -216,4 +545,99 @@ def route_request(request_data: Dict[str, Any]) -> Dict[str, Any]:
         if "user_preferences" in updated_request:
             del updated_request["user_preferences"]
     
-    return updated_request
\ No newline at end of file
+    return updated_request
+
+# バッチルーティング
+#
+# 大量のリクエストをまとめて分類する。同一の入力と設定は1回だけ評価し、
+# 評価する文字数の合計がparallel_charsを超える場合はプロセスプールに分割して処理する
+# （短いプロンプトばかりの場合はプロセス間通信のコストの方が大きい）。
+
+_process_pool = None
+_process_pool_size = None
+_process_pool_lock = threading.Lock()
+
+def get_process_pool(processes: Optional[int] = None):
+    """バッチルーティング用のプロセスプール（初回呼び出し時に作成、processesが変わったら作り直す）
+
+    子プロセスはspawnで起動する（イベントループやロックを持つサーバープロセスをforkしない）。
+    _route_chunkは特徴量とuser_preferencesだけで決まるので、親の状態を引き継ぐ必要はない。
+    """
+    global _process_pool, _process_pool_size
+    with _process_pool_lock:
+        if _process_pool is not None and _process_pool_size != processes:
+            # 実行中のmapは古いプールで最後まで処理される
+            _process_pool.shutdown(wait=False)
+            _process_pool = None
+        if _process_pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            _process_pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+            _process_pool_size = processes
+        return _process_pool
+
+def shutdown_process_pool():
+    global _process_pool, _process_pool_size
+    with _process_pool_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=False, cancel_futures=True)
+            _process_pool = None
+            _process_pool_size = None
+
+def _route_chunk(chunk: List[tuple]) -> List[tuple]:
+    # (ユーザー入力, user_preferences) -> (特徴量, モデル)。プロセスプールから呼ばれる
+    results = []
+    for user_inputs, user_preferences in chunk:
+        features = extract_features(user_inputs)
+        results.append((features, select_model_for_features(features, user_preferences)))
+    return results
+
+def route_batch(items: List[Dict[str, Any]], pricing=None, default_max_tokens: int = 4000,
+                parallel_chars: int = 1000000, chunk_size: int = 500, processes: Optional[int] = None) -> List[Dict[str, Any]]:
+    """複数のリクエスト（messages, user_preferences, max_tokens）のモデルを一括で選択する
+
+    pricingにpricing.PricingTableを渡すと、推定コストもまとめて計算する。
+    """
+    # 同一の入力と設定をまとめる
+    unique: Dict[bytes, int] = {}
+    work: List[tuple] = []
+    slots: List[int] = []
+    for item in items:
+        user_inputs = user_inputs_of(item.get("messages") or [])
+        user_preferences = item.get("user_preferences") or {}
+        key = RoutingCache.make_key(user_inputs, user_preferences)
+        if key not in unique:
+            unique[key] = len(work)
+            work.append((user_inputs, user_preferences))
+        slots.append(unique[key])
+
+    if len(work) > chunk_size and sum(len(user_inputs) for user_inputs, _ in work) > parallel_chars:
+        chunks = [work[i:i + chunk_size] for i in range(0, len(work), chunk_size)]
+        routed = [result for chunk_results in get_process_pool(processes).map(_route_chunk, chunks) for result in chunk_results]
+    else:
+        routed = _route_chunk(work)
+
+    input_tokens = [estimate_prompt_tokens(item.get("messages") or []) for item in items]
+    output_tokens = [min(item.get("max_tokens") or default_max_tokens, default_max_tokens) for item in items]
+    models = [
+        fit_context_window(routed[slot][1], input_tokens[index] + (items[index].get("max_tokens") or 0))
+        for index, slot in enumerate(slots)
+    ]
+    costs = pricing.cost_many(models, input_tokens, output_tokens) if pricing is not None else None
+
+    results = []
+    for index, slot in enumerate(slots):
+        features = routed[slot][0]
+        result = {
+            "model": models[index],
+            "language": features.language,
+            "complexity": features.complexity,
+            "has_code": features.has_code,
+            "has_ecommerce": features.has_ecommerce,
+            "input_tokens": input_tokens[index],
+            "output_tokens": output_tokens[index],
+        }
+        if costs is not None:
+            result["estimated_cost"] = float(costs[index])
+        results.append(result)
+    return results
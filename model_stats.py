@@ -0,0 +1,184 @@
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Dict, Optional
+
+# Live per-model statistics
+#
+# Completion callbacks feed exponentially weighted moving averages of
+# latency, time to first token and error rate per model; requests in
+# flight are counted from admission until their callback (or the
+# middleware, for requests that never reach a model or fail) finishes them.
+# Released tokens stay behind as tombstones, so a callback that runs after
+# the middleware still records the outcome; tokens whose callback never
+# arrives are swept after token_ttl seconds.
+# A model is unhealthy when its error rate is too high or it is much
+# slower than the other models of its tier. Unhealthy models get no
+# traffic, so their statistics stop updating: after recovery_after
+# seconds without a sample they count as healthy again and are retried.
+# The most recent time-to-first-token samples are also kept for
+# percentile deadlines (hedged requests).
+class _ModelStats:
+    __slots__ = ("requests", "errors", "in_flight", "latency", "ttft", "error_rate", "last_sample", "ttft_samples")
+
+    def __init__(self, sample_window: int):
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.latency: Optional[float] = None
+        self.ttft: Optional[float] = None
+        self.error_rate = 0.0
+        self.last_sample = 0.0
+        self.ttft_samples = deque(maxlen=sample_window)
+
+class ModelStatsRegistry:
+    def __init__(self, alpha: float = 0.2, min_samples: int = 5, max_error_rate: float = 0.5,
+                 slow_factor: float = 2.0, recovery_after: float = 60.0, token_ttl: float = 600.0,
+                 sample_window: int = 256):
+        self.alpha = alpha
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.slow_factor = slow_factor
+        self.recovery_after = recovery_after
+        self.token_ttl = token_ttl
+        self.sample_window = sample_window
+        self._lock = threading.Lock()
+        self._models: Dict[str, _ModelStats] = {}
+        # token -> (model, started at, still counted in flight)
+        self._tokens: Dict[str, tuple] = {}
+
+    def _stats(self, model: str) -> _ModelStats:
+        stats = self._models.get(model)
+        if stats is None:
+            stats = self._models[model] = _ModelStats(self.sample_window)
+        return stats
+
+    def start(self, model: str) -> str:
+        """Count a request to model as in flight; returns a token for finish()"""
+        token = uuid.uuid4().hex
+        now = time.monotonic()
+        with self._lock:
+            self._stats(model).in_flight += 1
+            self._tokens[token] = (model, now, True)
+            if len(self._tokens) % 1024 == 0:
+                self._sweep(now)
+        return token
+
+    def finish(self, token: Optional[str], success: Optional[bool] = None,
+               latency: Optional[float] = None, ttft: Optional[float] = None, model: Optional[str] = None):
+        """End an in-flight request and record its outcome
+
+        success=None only releases the in-flight slot (the request never
+        reached the model, or failed before its callback ran); the token is
+        kept so a later call can still record the outcome. Tokens whose
+        outcome was recorded are ignored; without a token the outcome is
+        recorded for model.
+        """
+        with self._lock:
+            entry = self._tokens.get(token) if token else None
+            if entry is not None:
+                model, started, counted = entry
+                if counted:
+                    self._stats(model).in_flight -= 1
+                if success is None:
+                    self._tokens[token] = (model, started, False)
+                    return
+                del self._tokens[token]
+            elif token:
+                # Outcome already recorded; don't count twice
+                return
+            if model is None or success is None:
+                return
+            self._record_locked(model, success, latency, ttft)
+
+    def _record_locked(self, model: str, success: bool, latency: Optional[float], ttft: Optional[float]):
+        stats = self._stats(model)
+        alpha = self.alpha
+        stats.requests += 1
+        stats.last_sample = time.monotonic()
+        stats.error_rate += alpha * ((0.0 if success else 1.0) - stats.error_rate)
+        if not success:
+            stats.errors += 1
+            return
+        if latency is not None:
+            stats.latency = latency if stats.latency is None else stats.latency + alpha * (latency - stats.latency)
+        if ttft is not None:
+            stats.ttft = ttft if stats.ttft is None else stats.ttft + alpha * (ttft - stats.ttft)
+            stats.ttft_samples.append(ttft)
+
+    def ttft_percentile(self, model: str, q: float, min_samples: int = 1) -> Optional[float]:
+        """q-quantile of recent time-to-first-token samples (None with fewer than min_samples)"""
+        with self._lock:
+            stats = self._models.get(model)
+            samples = sorted(stats.ttft_samples) if stats is not None else []
+        if len(samples) < max(1, min_samples):
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def is_healthy(self, model: str, peers=()) -> bool:
+        """False if model is failing, or much slower than the median of its peers"""
+        with self._lock:
+            return self._healthy_locked(model, peers, time.monotonic())
+
+    def _healthy_locked(self, model: str, peers, now: float) -> bool:
+        stats = self._models.get(model)
+        if stats is None or stats.requests < self.min_samples:
+            return True
+        if now - stats.last_sample > self.recovery_after:
+            return True
+        if stats.error_rate > self.max_error_rate:
+            return False
+        latencies = sorted(
+            self._models[peer].latency for peer in peers
+            if peer != model and peer in self._models and self._models[peer].latency is not None
+        )
+        if stats.latency is None or not latencies:
+            return True
+        median = latencies[len(latencies) // 2]
+        return stats.latency <= median * self.slow_factor
+
+    def rank(self, model: str) -> tuple:
+        """Sort key among healthy alternatives: fewer errors, then lower latency"""
+        with self._lock:
+            stats = self._models.get(model)
+            if stats is None:
+                return (0.0, 0.0, 0)
+            return (round(stats.error_rate, 2), stats.latency or 0.0, stats.in_flight)
+
+    def _sweep(self, now: float):
+        # Drop tokens whose callback never arrived (caller holds the lock)
+        expired = [token for token, (_, started, _) in self._tokens.items() if now - started > self.token_ttl]
+        for token in expired:
+            model, _, counted = self._tokens.pop(token)
+            if counted:
+                self._models[model].in_flight -= 1
+
+    def snapshot(self, tiers: Optional[Dict[str, str]] = None) -> Dict[str, Dict]:
+        """Current statistics per model; tiers (model -> tier) adds health against tier peers"""
+        now = time.monotonic()
+        with self._lock:
+            result = {}
+            for model, stats in self._models.items():
+                peers = [peer for peer, tier in (tiers or {}).items() if tier == (tiers or {}).get(model)]
+                result[model] = {
+                    "requests": stats.requests,
+                    "errors": stats.errors,
+                    "in_flight": stats.in_flight,
+                    "latency_ewma": stats.latency,
+                    "ttft_ewma": stats.ttft,
+                    "error_rate_ewma": stats.error_rate,
+                    "seconds_since_sample": now - stats.last_sample if stats.last_sample else None,
+                    "healthy": self._healthy_locked(model, peers, now),
+                }
+            return result
+
+# Shared registry used by the router and the completion callbacks
+model_stats = ModelStatsRegistry(
+    alpha=float(os.environ.get("MODEL_STATS_ALPHA", 0.2)),
+    min_samples=int(os.environ.get("MODEL_HEALTH_MIN_SAMPLES", 5)),
+    max_error_rate=float(os.environ.get("MODEL_HEALTH_MAX_ERROR_RATE", 0.5)),
+    slow_factor=float(os.environ.get("MODEL_HEALTH_SLOW_FACTOR", 2.0)),
+    recovery_after=float(os.environ.get("MODEL_HEALTH_RECOVERY_AFTER", 60)),
+)
@@ -0,0 +1,367 @@
+import argparse
+import json
+import logging
+import re
+import threading
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger("litellm-proxy")
+
+# Single-pass PII masking
+#
+# All categories are compiled into one alternation of named groups, so a
+# prompt is scanned and copied once no matter how many categories are
+# configured; each match is replaced with "[category]". Where two
+# categories could match at the same position the earlier one wins, so
+# longer formats (credit cards) are listed before the shorter ones
+# (phone numbers) they contain. Number patterns are delimited by
+# digit lookarounds rather than \b, which never matches between Japanese
+# text and a digit.
+#
+# Every built-in pattern needs a digit or "@" to match, so text without
+# either is returned untouched after one cheap search.
+
+DEFAULT_PATTERNS = {
+    "email": r'[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}',
+    "credit_card": r'(?<!\d)(?:\d{4}[-\s]?){3}\d{4}(?!\d)',
+    "phone_jp": r'(?<!\d)0\d{1,4}[-\s]?\d{1,4}[-\s]?\d{4}(?!\d)',
+    "address_jp": r'〒?\d{3}[-\s]?\d{4}',
+}
+
+# Characters at least one of which every built-in pattern requires
+DEFAULT_TRIGGERS = r'\d@'
+
+# Streaming: regexes matching any text that could still grow into a match
+# (including a complete match that could be extended). The streaming masker
+# holds back the earliest such suffix of the text seen so far.
+DEFAULT_STREAM_PREFIXES = {
+    "email": r'[A-Za-z0-9._%+-]+(?:@[A-Za-z0-9.-]*)?',
+    "number": r'〒?(?:\d[-\s]?)+|〒',
+}
+
+# Upper bound on held-back characters; longer suffixes are released as-is
+DEFAULT_MAX_HOLDBACK = 64
+
+class PIIMasker:
+    def __init__(self, patterns: Optional[Dict[str, str]] = None, triggers: Optional[str] = DEFAULT_TRIGGERS,
+                 stream_prefixes: Optional[Dict[str, str]] = None, max_holdback: int = DEFAULT_MAX_HOLDBACK):
+        """patterns maps category name -> regex, in priority order
+
+        triggers is a regex character-class body; text containing none of
+        those characters is skipped. Pass None when some pattern can match
+        without them. stream_prefixes are the partial-match regexes used
+        by StreamingPIIMasker.
+        """
+        self.patterns = dict(DEFAULT_PATTERNS if patterns is None else patterns)
+        self.categories: List[str] = list(self.patterns)
+        # Group names are generated so user patterns may use their own named groups
+        self._group_names = {f"_pii{index}": name for index, name in enumerate(self.categories)}
+        self._regex = re.compile("|".join(
+            f"(?P<_pii{index}>{pattern})" for index, pattern in enumerate(self.patterns.values())
+        ))
+        self._replacements = {group: f"[{name}]" for group, name in self._group_names.items()}
+        self._trigger = re.compile(f"[{triggers}]") if triggers else None
+        self._lock = threading.Lock()
+        self.stats = {"scanned": 0, "skipped": 0, "masked_texts": 0}
+        self.category_counts = {name: 0 for name in self.categories}
+
+        prefixes = DEFAULT_STREAM_PREFIXES if stream_prefixes is None else stream_prefixes
+        self._stream_tail = re.compile("(?:" + "|".join(prefixes.values()) + r")\Z") if prefixes else None
+        self.max_holdback = max_holdback
+        self.stream_stats = {"streams": 0, "chunks": 0, "feed_seconds": 0.0, "max_feed_seconds": 0.0, "max_held_chars": 0}
+
+    def holdback_start(self, text: str) -> int:
+        """Index from which text could still become (or extend) a PII match"""
+        if self._stream_tail is None:
+            return len(text)
+        window_start = max(0, len(text) - self.max_holdback)
+        match = self._stream_tail.search(text, window_start)
+        return match.start() if match else len(text)
+
+    def record_stream(self, chunks: int, feed_seconds: float, max_feed_seconds: float, max_held_chars: int):
+        with self._lock:
+            stats = self.stream_stats
+            stats["streams"] += 1
+            stats["chunks"] += chunks
+            stats["feed_seconds"] += feed_seconds
+            stats["max_feed_seconds"] = max(stats["max_feed_seconds"], max_feed_seconds)
+            stats["max_held_chars"] = max(stats["max_held_chars"], max_held_chars)
+
+    def mask(self, text: str) -> str:
+        """Replace every PII match in text with its category placeholder"""
+        if not text or (self._trigger is not None and self._trigger.search(text) is None):
+            with self._lock:
+                self.stats["skipped"] += 1
+            return text
+
+        found: Dict[str, int] = {}
+        replacements = self._replacements
+
+        def replace(match):
+            group = match.lastgroup
+            found[group] = found.get(group, 0) + 1
+            return replacements[group]
+
+        masked = self._regex.sub(replace, text)
+        self._record(found)
+        return masked
+
+    def _record(self, found: Dict[str, int]):
+        with self._lock:
+            self.stats["scanned"] += 1
+            if found:
+                self.stats["masked_texts"] += 1
+                for group, count in found.items():
+                    self.category_counts[self._group_names[group]] += count
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            metrics = dict(self.stats)
+            metrics["matches"] = dict(self.category_counts)
+            streaming = dict(self.stream_stats)
+        streaming["avg_feed_us"] = streaming["feed_seconds"] / streaming["chunks"] * 1e6 if streaming["chunks"] else 0.0
+        streaming["max_feed_us"] = streaming.pop("max_feed_seconds") * 1e6
+        metrics["streaming"] = streaming
+        metrics["fast_path"] = self._trigger is not None
+        return metrics
+
+# Incremental masking of one streamed text
+#
+# feed() returns the part of the text seen so far that can no longer be
+# affected by later chunks, masked; the rest (the shortest suffix that
+# could still become a match, capped at max_holdback) is held until the
+# next chunk or finish().
+class StreamingPIIMasker:
+    def __init__(self, masker: PIIMasker):
+        self.masker = masker
+        self._held = ""
+        self.chunks = 0
+        self.feed_seconds = 0.0
+        self.max_feed_seconds = 0.0
+        self.max_held_chars = 0
+
+    def feed(self, text: str) -> str:
+        start = time.perf_counter()
+        buffer = self._held + text
+        cut = self.masker.holdback_start(buffer)
+        self._held = buffer[cut:]
+        output = self.masker.mask(buffer[:cut]) if cut else ""
+
+        elapsed = time.perf_counter() - start
+        self.chunks += 1
+        self.feed_seconds += elapsed
+        self.max_feed_seconds = max(self.max_feed_seconds, elapsed)
+        self.max_held_chars = max(self.max_held_chars, len(self._held))
+        return output
+
+    def finish(self) -> str:
+        """Release whatever is still held back"""
+        held, self._held = self._held, ""
+        return self.masker.mask(held) if held else ""
+
+class SSEMaskingStream:
+    """Mask choices[].delta.content in an OpenAI-style SSE stream
+
+    Body chunks go in through feed() as they arrive and come out with
+    complete events masked; only the held-back suffix of each choice's text
+    is delayed. Held text is released in the event that carries the
+    choice's finish_reason, or in an extra event before [DONE] (or from
+    finish()) if the stream ends without one.
+    """
+
+    def __init__(self, masker: PIIMasker):
+        self.masker = masker
+        self._streams: Dict[int, StreamingPIIMasker] = {}
+        self._pending = b""
+        self._last_event: Optional[Dict] = None
+        self._closed = False
+
+    def _process(self, event: bytes) -> bytes:
+        if not event.startswith(b"data:"):
+            return event
+        payload = event[5:].strip()
+        if payload == b"[DONE]":
+            return _flush_events(self._streams, self._last_event) + event
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            return event
+        changed = False
+        for choice in data.get("choices") or []:
+            index = choice.get("index", 0)
+            delta = choice.get("delta")
+            if not isinstance(delta, dict):
+                delta = choice["delta"] = {}
+            content = delta.get("content")
+            stream = self._streams.get(index)
+            if isinstance(content, str):
+                if stream is None:
+                    stream = self._streams[index] = StreamingPIIMasker(self.masker)
+                delta["content"] = stream.feed(content)
+                changed = True
+            if choice.get("finish_reason") and stream is not None:
+                delta["content"] = (delta.get("content") or "") + stream.finish()
+                changed = True
+        self._last_event = data
+        return b"data: " + json.dumps(data, ensure_ascii=False).encode() if changed else event
+
+    def feed(self, chunk) -> bytes:
+        """Masked output for the events completed by chunk (b"" if none)"""
+        self._pending += chunk if isinstance(chunk, bytes) else chunk.encode()
+        output = []
+        while True:
+            end = self._pending.find(b"\n\n")
+            if end < 0:
+                break
+            event, self._pending = self._pending[:end], self._pending[end + 2:]
+            output.append(self._process(event) + b"\n\n")
+        return b"".join(output)
+
+    def finish(self) -> bytes:
+        """Whatever is left at the end of the stream"""
+        output = b""
+        if self._pending:
+            output, self._pending = self._process(self._pending), b""
+        output += _flush_events(self._streams, self._last_event)
+        self.close()
+        return output
+
+    def close(self):
+        """Record the stream's masking statistics (once)"""
+        if self._closed:
+            return
+        self._closed = True
+        streams = self._streams.values()
+        if streams:
+            self.masker.record_stream(
+                sum(stream.chunks for stream in streams),
+                sum(stream.feed_seconds for stream in streams),
+                max(stream.max_feed_seconds for stream in streams),
+                max(stream.max_held_chars for stream in streams),
+            )
+
+def _flush_events(streams: Dict[int, StreamingPIIMasker], template: Optional[Dict]) -> bytes:
+    # One extra event per choice that still has held-back text
+    output = b""
+    for index, stream in streams.items():
+        held = stream.finish()
+        if not held:
+            continue
+        event = {key: value for key, value in (template or {}).items() if key != "choices"}
+        event["choices"] = [{"index": index, "delta": {"content": held}, "finish_reason": None}]
+        output += b"data: " + json.dumps(event, ensure_ascii=False).encode() + b"\n\n"
+    return output
+
+def _load_config(config_path: str) -> Dict:
+    try:
+        import yaml
+    except ImportError:
+        logger.warning("PyYAML is not installed; ignoring PII settings in config.yaml")
+        return {}
+    try:
+        with open(config_path, "r") as f:
+            return yaml.safe_load(f) or {}
+    except FileNotFoundError:
+        return {}
+
+def load_pii_config(config_path: str) -> Dict:
+    """Read the pii_masking section of config.yaml ({} if missing)"""
+    return _load_config(config_path).get("pii_masking") or {}
+
+def response_masking_enabled(config_path: str) -> bool:
+    """litellm_settings.post_response_processing from config.yaml"""
+    return bool((_load_config(config_path).get("litellm_settings") or {}).get("post_response_processing"))
+
+def create_masker(config_path: Optional[str] = None) -> PIIMasker:
+    """Build a masker from the built-in patterns plus config.yaml extra_patterns
+
+    Each extra pattern is {name, pattern, triggers, stream_prefix}; triggers
+    lists the characters the pattern needs (regex class body). If any extra
+    pattern omits it, the no-digit fast path is turned off. stream_prefix
+    matches partial matches for streamed responses; without it a match split
+    across streamed chunks can slip through unmasked.
+    """
+    patterns = dict(DEFAULT_PATTERNS)
+    triggers = DEFAULT_TRIGGERS
+    prefixes = dict(DEFAULT_STREAM_PREFIXES)
+    settings = load_pii_config(config_path) if config_path else {}
+    for extra in settings.get("extra_patterns") or []:
+        try:
+            re.compile(extra["pattern"])
+            if extra.get("stream_prefix"):
+                re.compile(extra["stream_prefix"])
+        except (KeyError, re.error) as e:
+            logger.error(f"Ignoring invalid PII pattern {extra.get('name')}: {str(e)}")
+            continue
+        patterns[extra["name"]] = extra["pattern"]
+        if extra.get("stream_prefix"):
+            prefixes[extra["name"]] = extra["stream_prefix"]
+        if triggers is not None:
+            triggers = triggers + extra["triggers"] if extra.get("triggers") else None
+    return PIIMasker(patterns, triggers, prefixes, int(settings.get("max_holdback", DEFAULT_MAX_HOLDBACK)))
+
+# Benchmark corpora: prompts with and without PII
+BENCH_CORPORA = {
+    "english": [
+        "Summarize the following meeting notes and list the action items for next week. " * 20,
+        "Contact John at john.doe@example.com or call 03-1234-5678 about invoice 4111-1111-1111-1111. " * 10,
+        "Write a Python function that sorts a list of dictionaries by a given key and explain it. " * 20,
+    ],
+    "japanese": [
+        "来週の会議の議事録を要約して、担当者ごとのアクションアイテムを整理してください。" * 30,
+        "山田様の連絡先は090-1234-5678、住所は〒150-0001 東京都渋谷区です。メールはyamada@example.jpまで。" * 10,
+        "楽天市場で人気の商品を比較して、おすすめの理由を説明してください。" * 30,
+    ],
+}
+
+def _legacy_mask(text: str) -> str:
+    # Previous implementation: one uncompiled re.sub pass per category
+    for name, pattern in {
+        "email": DEFAULT_PATTERNS["email"],
+        "phone_jp": DEFAULT_PATTERNS["phone_jp"],
+        "credit_card": DEFAULT_PATTERNS["credit_card"],
+        "address_jp": DEFAULT_PATTERNS["address_jp"],
+    }.items():
+        text = re.sub(pattern, f"[{name}]", text)
+    return text
+
+def run_benchmark(iterations: int = 2000):
+    masker = PIIMasker()
+    for corpus, texts in BENCH_CORPORA.items():
+        for label, func in (("multi-pass", _legacy_mask), ("single-pass", masker.mask)):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                for text in texts:
+                    func(text)
+            elapsed = time.perf_counter() - start
+            per_text = elapsed / (iterations * len(texts)) * 1e6
+            print(f"{corpus:10s} {label:12s} {per_text:8.2f} us/prompt")
+
+    # Streaming: feed each text in small token-sized chunks
+    for corpus, texts in BENCH_CORPORA.items():
+        chunks = [text[i:i + 4] for text in texts for i in range(0, len(text), 4)]
+        stream = StreamingPIIMasker(masker)
+        for _ in range(max(1, iterations // 20)):
+            for chunk in chunks:
+                stream.feed(chunk)
+            stream.finish()
+        print(f"{corpus:10s} {'streaming':12s} {stream.feed_seconds / stream.chunks * 1e6:8.2f} us/chunk "
+              f"(max {stream.max_feed_seconds * 1e6:.1f} us, max held {stream.max_held_chars} chars)")
+    print(f"matches: {masker.metrics()['matches']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PII masking tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    bench_parser = subparsers.add_parser("bench", help="Compare single-pass masking with the multi-pass implementation")
+    bench_parser.add_argument("--iterations", type=int, default=2000, help="Passes over each corpus")
+    mask_parser = subparsers.add_parser("mask", help="Mask PII in a string")
+    mask_parser.add_argument("text", type=str)
+    mask_parser.add_argument("--config", type=str, default="config.yaml", help="config.yaml with extra patterns")
+
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        run_benchmark(args.iterations)
+    elif args.command == "mask":
+        print(create_masker(args.config).mask(args.text))
@@ -0,0 +1,184 @@
+import argparse
+import logging
+import os
+from array import array
+from typing import Dict, Iterable, List, Optional, Sequence
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger("litellm-proxy")
+
+# Pricing registry
+#
+# Prices are loaded once into two parallel arrays (input / output USD per
+# 1K tokens) indexed by a small integer model id. Row 0 is the default
+# price for models without an entry. Model names, litellm model strings
+# ("openai/gpt-4") and their bare names all resolve to the same row.
+#
+# Sources, lowest priority first: model_router.MODEL_INFO
+# (cost_per_1k_tokens, same price for input and output), then
+# model_list[].model_info in config.yaml (LiteLLM's input_cost_per_token /
+# output_cost_per_token).
+
+# Price per 1K tokens for models that are not in the registry
+DEFAULT_COST_PER_1K_TOKENS = 0.002
+
+class PricingTable:
+    def __init__(self, default_per_1k: float = DEFAULT_COST_PER_1K_TOKENS):
+        self.model_ids: Dict[str, int] = {}
+        self.models: List[str] = ["<default>"]
+        self.input_per_1k = array("d", [default_per_1k])
+        self.output_per_1k = array("d", [default_per_1k])
+        self._np_input = None
+        self._np_output = None
+
+    def set_price(self, model: str, input_per_1k: float, output_per_1k: float, aliases: Iterable[str] = ()):
+        """Add or update a model row; aliases resolve to it unless already taken"""
+        model_id = self.model_ids.get(model)
+        if model_id is None:
+            model_id = len(self.models)
+            self.models.append(model)
+            self.input_per_1k.append(input_per_1k)
+            self.output_per_1k.append(output_per_1k)
+            self.model_ids[model] = model_id
+        else:
+            self.input_per_1k[model_id] = input_per_1k
+            self.output_per_1k[model_id] = output_per_1k
+        for alias in aliases:
+            self.model_ids.setdefault(alias, model_id)
+        self._np_input = self._np_output = None
+
+    def index(self, model: Optional[str]) -> int:
+        """Model id for model (0, the default row, if unknown)"""
+        return self.model_ids.get(model, 0) if model else 0
+
+    def cost(self, model: Optional[str], input_tokens: int, output_tokens: int) -> float:
+        model_id = self.index(model)
+        return (input_tokens / 1000 * self.input_per_1k[model_id]) + (output_tokens / 1000 * self.output_per_1k[model_id])
+
+    def cost_many(self, models: Sequence[Optional[str]], input_tokens: Sequence[int], output_tokens: Sequence[int]):
+        """Price many usage rows at once; returns a NumPy array (a list without NumPy)"""
+        ids = [self.index(model) for model in models]
+        if np is None:
+            input_prices = self.input_per_1k
+            output_prices = self.output_per_1k
+            return [
+                (tokens_in / 1000 * input_prices[model_id]) + (tokens_out / 1000 * output_prices[model_id])
+                for model_id, tokens_in, tokens_out in zip(ids, input_tokens, output_tokens)
+            ]
+        if self._np_input is None:
+            self._np_input = np.frombuffer(self.input_per_1k, dtype=np.float64).copy()
+            self._np_output = np.frombuffer(self.output_per_1k, dtype=np.float64).copy()
+        ids = np.asarray(ids, dtype=np.intp)
+        return (np.asarray(input_tokens, dtype=np.float64) * self._np_input[ids]
+                + np.asarray(output_tokens, dtype=np.float64) * self._np_output[ids]) / 1000
+
+    def price_records(self, records: Sequence[Dict]):
+        """Costs for usage records ({model, input_tokens, output_tokens}) under the current prices"""
+        return self.cost_many(
+            [record.get("model") for record in records],
+            [record.get("input_tokens", 0) for record in records],
+            [record.get("output_tokens", 0) for record in records],
+        )
+
+    def to_dict(self) -> Dict[str, Dict]:
+        return {
+            model: {"input_per_1k": self.input_per_1k[model_id], "output_per_1k": self.output_per_1k[model_id]}
+            for model_id, model in enumerate(self.models)
+        }
+
+def load_pricing(config_path: Optional[str] = None, model_info: Optional[Dict[str, Dict]] = None) -> PricingTable:
+    """Build the registry from MODEL_INFO and config.yaml"""
+    if model_info is None:
+        from model_router import MODEL_INFO as model_info
+
+    table = PricingTable()
+    for model, info in model_info.items():
+        if "cost_per_1k_tokens" in info:
+            table.set_price(model, info["cost_per_1k_tokens"], info["cost_per_1k_tokens"])
+
+    for entry in load_model_list(config_path) if config_path else []:
+        name = entry.get("model_name")
+        info = entry.get("model_info") or {}
+        litellm_model = (entry.get("litellm_params") or {}).get("model")
+        aliases = [litellm_model, litellm_model.split("/", 1)[-1]] if litellm_model else []
+        if "input_cost_per_token" in info or "output_cost_per_token" in info:
+            input_per_1k = round(float(info.get("input_cost_per_token", 0.0)) * 1000, 12)
+            output_per_1k = round(float(info.get("output_cost_per_token", info.get("input_cost_per_token", 0.0))) * 1000, 12)
+            table.set_price(name, input_per_1k, output_per_1k, aliases)
+        elif name in table.model_ids:
+            # Priced from MODEL_INFO; let the litellm model names resolve to it too
+            model_id = table.model_ids[name]
+            for alias in aliases:
+                table.model_ids.setdefault(alias, model_id)
+    return table
+
+def load_model_list(config_path: str) -> List[Dict]:
+    """model_list entries from config.yaml ([] if missing)"""
+    try:
+        import yaml
+    except ImportError:
+        logger.warning("PyYAML is not installed; ignoring model prices in config.yaml")
+        return []
+    try:
+        with open(config_path, "r") as f:
+            return (yaml.safe_load(f) or {}).get("model_list") or []
+    except FileNotFoundError:
+        return []
+
+def reprice_journal(journal, pricing: PricingTable, batch_size: int = 10000) -> Dict[str, Dict]:
+    """Recompute per-key totals for a usage journal with the current prices"""
+    totals: Dict[str, Dict] = {}
+
+    def add(batch):
+        for record, cost in zip(batch, pricing.price_records(batch)):
+            key_totals = totals.setdefault(record["key_id"], {"recorded_cost": 0.0, "cost": 0.0, "requests": 0})
+            key_totals["recorded_cost"] += record["cost"]
+            key_totals["cost"] += float(cost)
+            key_totals["requests"] += 1
+
+    batch = []
+    for record in journal.iter_records():
+        batch.append(record)
+        if len(batch) >= batch_size:
+            add(batch)
+            batch = []
+    if batch:
+        add(batch)
+    return totals
+
+if __name__ == "__main__":
+    import json
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Model pricing tools")
+    parser.add_argument("--config", type=str, default=os.environ.get("CONFIG_FILE", "config.yaml"), help="config.yaml with model prices")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("show", help="Print the pricing table")
+    reprice_parser = subparsers.add_parser("reprice", help="Recompute per-key usage cost with the current prices")
+    reprice_parser.add_argument("--usage-dir", type=str, default=os.environ.get("USAGE_LOG_DIR", "/app/data/usage"), help="Usage journal directory")
+    reprice_parser.add_argument("--db", type=str, default=None, help="Read usage from a SQLite store instead")
+
+    args = parser.parse_args()
+    pricing = load_pricing(args.config)
+
+    if args.command == "show":
+        print(json.dumps(pricing.to_dict(), indent=2))
+    elif args.command == "reprice":
+        if args.db:
+            from sqlite_store import SQLiteStore, SQLiteUsageJournal
+
+            journal = SQLiteUsageJournal(SQLiteStore(args.db, pool_size=1))
+            journal.open()
+            try:
+                print(json.dumps(reprice_journal(journal, pricing), indent=2))
+            finally:
+                journal.close()
+        else:
+            from usage_log import UsageJournal
+
+            print(json.dumps(reprice_journal(UsageJournal(args.usage_dir), pricing), indent=2))
@@ -0,0 +1,101 @@
+import hashlib
+import json
+from functools import cached_property
+from typing import Any, Dict, Optional
+
+from model_router import PromptFeatures, estimate_prompt_tokens, extract_features, user_inputs_of
+
+# Per-request context
+#
+# ModelRouterMiddleware decodes a chat request body once into a
+# RequestContext and stores it in the ASGI scope, where endpoints find it as
+# request.state.request_context. Admission, cost estimation, routing and
+# hedging read the parsed body and the derived features from it instead of
+# decoding the body or scanning the prompt again. Features are computed on
+# first use and kept for the rest of the request.
+#
+# The parsed body is also handed to LiteLLM's proxy through
+# scope["parsed_body"], which it checks before reading the body itself.
+#
+# orjson (installed with litellm[proxy]) is used to decode and encode
+# bodies when available; the json module otherwise.
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def loads(data: bytes) -> Any:
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson refuses some input the json module accepts (NaN, Infinity)
+            pass
+    return json.loads(data)
+
+def dumps(value: Any) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            pass
+    return json.dumps(value, ensure_ascii=False).encode()
+
+def api_key_of(auth_header: Optional[str]) -> Optional[str]:
+    """API key from an Authorization header ("Bearer " prefix optional)"""
+    if not auth_header:
+        return None
+    return auth_header[7:] if auth_header.startswith("Bearer ") else auth_header
+
+class RequestContext:
+    def __init__(self, body: bytes, data: Dict[str, Any], api_key: Optional[str] = None):
+        # Body as last encoded; encode() refreshes it after data changed
+        self.body = body
+        self.data = data
+        self.api_key = api_key
+        # Key record (from the key index) once the request has been admitted
+        self.key_record: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def from_body(cls, body: bytes, auth_header: Optional[str] = None) -> "RequestContext":
+        """Decode a request body; raises ValueError if it is not a JSON object"""
+        data = loads(body)
+        if not isinstance(data, dict):
+            raise ValueError("Request body must be a JSON object")
+        return cls(body, data, api_key_of(auth_header))
+
+    @property
+    def messages(self):
+        return self.data.get("messages") or []
+
+    @cached_property
+    def user_inputs(self) -> str:
+        """User messages joined, as routed on"""
+        return user_inputs_of(self.messages)
+
+    @cached_property
+    def features(self) -> PromptFeatures:
+        return extract_features(self.user_inputs)
+
+    @cached_property
+    def prompt_tokens(self) -> int:
+        """Estimated input tokens of the whole conversation"""
+        return estimate_prompt_tokens(self.messages)
+
+    @cached_property
+    def prompt_hash(self) -> str:
+        """Hash of the messages (key order does not matter); stands in for them in the response cache key"""
+        canonical = json.dumps(self.messages, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+        return hashlib.blake2b(canonical.encode("utf-8", "surrogatepass"), digest_size=16).hexdigest()
+
+    def encode(self) -> bytes:
+        self.body = dumps(self.data)
+        return self.body
+
+    def parsed_body(self) -> tuple:
+        """data in the form LiteLLM's proxy caches in scope["parsed_body"]"""
+        return tuple(self.data.keys()), self.data
+
+def set_request_context(scope, context: RequestContext):
+    scope.setdefault("state", {})["request_context"] = context
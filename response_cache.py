@@ -0,0 +1,460 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger("litellm-proxy")
+
+# Two-tier response cache
+#
+# Completed chat completions are served by ModelRouterMiddleware from an
+# in-process LRU bounded by total bytes, backed by a SQLite file so entries
+# survive restarts and are shared by the workers of a machine. Lookups try
+# memory first and then disk, promoting disk hits into memory; only misses
+# reach LiteLLM (and litellm.Cache behind it). Entries expire ttl seconds
+# after they were stored (CACHE_TTL unless the request sets cache.ttl).
+#
+# Keys are a hash of the canonicalized request: the routed model, the
+# messages and the parameters that change the completion. Transport fields
+# (stream, metadata, user, ...) are left out, and key order and whitespace
+# in the body do not matter.
+#
+# Streaming requests share the entries: a cached completion is replayed as
+# a chat.completion.chunk SSE stream, its text split into stream_chunk_chars
+# pieces, and a streamed upstream response is assembled back into a
+# completion and stored once it has finished.
+#
+# Requests opt out with LiteLLM's cache controls ("cache": {"no-cache":
+# true} skips the lookup, {"no-store": true} skips storing) or a
+# Cache-Control: no-cache / no-store header; API keys opt out with
+# "response_cache": false in their metadata.
+
+# Request fields that change the completion
+KEY_FIELDS = (
+    "model", "messages", "temperature", "top_p", "n", "max_tokens", "max_completion_tokens", "stop",
+    "presence_penalty", "frequency_penalty", "logit_bias", "seed", "logprobs", "top_logprobs",
+    "tools", "tool_choice", "functions", "function_call", "response_format",
+)
+
+# Approximate per-entry bookkeeping overhead (key, tuple, OrderedDict node)
+ENTRY_OVERHEAD = 200
+
+DISK_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key BLOB PRIMARY KEY,
+    body BLOB NOT NULL,
+    stored_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_responses_expires_at ON responses (expires_at);
+CREATE INDEX IF NOT EXISTS idx_responses_stored_at ON responses (stored_at);
+"""
+
+SELECT_RESPONSE = "SELECT body, expires_at FROM responses WHERE key = ?"
+UPSERT_RESPONSE = "INSERT OR REPLACE INTO responses (key, body, stored_at, expires_at) VALUES (?, ?, ?, ?)"
+DELETE_RESPONSE = "DELETE FROM responses WHERE key = ?"
+DELETE_EXPIRED = "DELETE FROM responses WHERE expires_at < ?"
+DELETE_OLDEST = "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY stored_at LIMIT ?)"
+DISK_USAGE = "SELECT COUNT(*), COALESCE(SUM(LENGTH(body)), 0) FROM responses"
+
+# Writes between pruning passes over the disk tier
+PRUNE_EVERY = 256
+
+def cache_key(request_data: Dict[str, Any], prompt_hash: Optional[str] = None) -> bytes:
+    """Hash of the fields of a chat request that change its completion
+
+    prompt_hash (RequestContext.prompt_hash) stands in for the messages so
+    they are not serialized a second time.
+    """
+    fields = {field: request_data[field] for field in KEY_FIELDS if request_data.get(field) is not None}
+    if prompt_hash is not None:
+        fields["messages"] = prompt_hash
+    canonical = json.dumps(fields, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.blake2b(canonical.encode("utf-8", "surrogatepass"), digest_size=20).digest()
+
+def cache_controls(request_data: Dict[str, Any], cache_control_header: Optional[str] = None) -> Dict[str, Any]:
+    """LiteLLM-style per-request controls (no-cache, no-store, ttl) merged with Cache-Control"""
+    cache = request_data.get("cache")
+    controls = dict(cache) if isinstance(cache, dict) else {}
+    for directive in (cache_control_header or "").lower().split(","):
+        directive = directive.strip()
+        if directive in ("no-cache", "no-store"):
+            controls[directive] = True
+    return controls
+
+def completion_to_sse(body: bytes, chunk_chars: int = 0, include_usage: bool = False) -> list:
+    """SSE events (bytes, ending with [DONE]) replaying a cached chat.completion
+
+    Each choice starts with its role, then its content in pieces of
+    chunk_chars characters (0 = one piece) and its tool calls, and ends
+    with its finish_reason. Raises ValueError if body is not a completion.
+    """
+    completion = json.loads(body)
+    if not isinstance(completion, dict) or not isinstance(completion.get("choices"), list):
+        raise ValueError("Cached body is not a chat completion")
+    template = {
+        "id": completion.get("id"),
+        "object": "chat.completion.chunk",
+        "created": completion.get("created"),
+        "model": completion.get("model"),
+    }
+    if completion.get("system_fingerprint"):
+        template["system_fingerprint"] = completion["system_fingerprint"]
+
+    def event(choices, **extra):
+        chunk = dict(template, choices=choices, **extra)
+        return b"data: " + json.dumps(chunk, ensure_ascii=False, separators=(",", ":")).encode() + b"\n\n"
+
+    events = []
+    for choice in completion["choices"]:
+        index = choice.get("index", 0)
+        message = choice.get("message") or {}
+        events.append(event([{"index": index, "delta": {"role": message.get("role", "assistant"), "content": ""}, "finish_reason": None}]))
+        content = message.get("content") or ""
+        step = chunk_chars if chunk_chars > 0 else max(len(content), 1)
+        for start in range(0, len(content), step):
+            events.append(event([{"index": index, "delta": {"content": content[start:start + step]}, "finish_reason": None}]))
+        if message.get("tool_calls"):
+            tool_calls = [dict(call, index=position) for position, call in enumerate(message["tool_calls"])]
+            events.append(event([{"index": index, "delta": {"tool_calls": tool_calls}, "finish_reason": None}]))
+        events.append(event([{"index": index, "delta": {}, "finish_reason": choice.get("finish_reason") or "stop"}]))
+    if include_usage and completion.get("usage"):
+        events.append(event([], usage=completion["usage"]))
+    events.append(b"data: [DONE]\n\n")
+    return events
+
+class StreamAssembler:
+    """Rebuilds a chat.completion from the chat.completion.chunk SSE stream as it passes
+
+    result() is None unless the stream reached [DONE] with every choice
+    finished, or once more than max_bytes of events went by.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.done = False
+        self.failed = False
+        self._pending = b""
+        self._completion: Dict[str, Any] = {}
+        self._choices: Dict[int, Dict[str, Any]] = {}
+
+    def feed(self, chunk: bytes):
+        if self.failed:
+            return
+        self.size += len(chunk)
+        if self.size > self.max_bytes * 4:
+            # SSE framing repeats id/model per event; the assembled body is far smaller
+            self.failed = True
+            return
+        self._pending += chunk
+        while True:
+            end = self._pending.find(b"\n\n")
+            if end < 0:
+                break
+            event, self._pending = self._pending[:end], self._pending[end + 2:]
+            self._event(event)
+
+    def _event(self, event: bytes):
+        if not event.startswith(b"data:"):
+            return
+        payload = event[5:].strip()
+        if payload == b"[DONE]":
+            self.done = True
+            return
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            self.failed = True
+            return
+        for field in ("id", "created", "model", "system_fingerprint"):
+            if data.get(field) is not None:
+                self._completion.setdefault(field, data[field])
+        if data.get("usage"):
+            self._completion["usage"] = data["usage"]
+        for choice in data.get("choices") or []:
+            state = self._choices.setdefault(choice.get("index", 0), {"role": "assistant", "content": [], "tool_calls": {}})
+            delta = choice.get("delta") or {}
+            if delta.get("role"):
+                state["role"] = delta["role"]
+            if delta.get("content"):
+                state["content"].append(delta["content"])
+            for call in delta.get("tool_calls") or []:
+                merged = state["tool_calls"].setdefault(call.get("index", 0), {"type": "function", "function": {"name": "", "arguments": ""}})
+                if call.get("id"):
+                    merged["id"] = call["id"]
+                if call.get("type"):
+                    merged["type"] = call["type"]
+                function = call.get("function") or {}
+                merged["function"]["name"] += function.get("name") or ""
+                merged["function"]["arguments"] += function.get("arguments") or ""
+            if choice.get("finish_reason"):
+                state["finish_reason"] = choice["finish_reason"]
+
+    def result(self) -> Optional[bytes]:
+        if self.failed or not self.done or not self._choices:
+            return None
+        if any(not state.get("finish_reason") for state in self._choices.values()):
+            return None
+        choices = []
+        for index in sorted(self._choices):
+            state = self._choices[index]
+            message = {"role": state["role"], "content": "".join(state["content"]) or None}
+            if state["tool_calls"]:
+                message["tool_calls"] = [
+                    dict({"id": call.get("id")}, type=call["type"], function=call["function"])
+                    for _, call in sorted(state["tool_calls"].items())
+                ]
+            choices.append({"index": index, "message": message, "finish_reason": state["finish_reason"]})
+        completion = {
+            "id": self._completion.get("id"),
+            "object": "chat.completion",
+            "created": self._completion.get("created"),
+            "model": self._completion.get("model"),
+            "choices": choices,
+        }
+        for field in ("system_fingerprint", "usage"):
+            if self._completion.get(field) is not None:
+                completion[field] = self._completion[field]
+        body = json.dumps(completion, ensure_ascii=False, separators=(",", ":")).encode()
+        return body if len(body) <= self.max_bytes else None
+
+class DiskTier:
+    """SQLite store for cached response bodies (used from worker threads)"""
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def open(self):
+        if self._conn is not None:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(DISK_SCHEMA)
+        self._conn = conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def get(self, key: bytes, now: float) -> Optional[tuple]:
+        with self._lock:
+            if self._conn is None:
+                return None
+            row = self._conn.execute(SELECT_RESPONSE, (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                with self._conn:
+                    self._conn.execute(DELETE_RESPONSE, (key,))
+                return None
+            return bytes(row[0]), row[1]
+
+    def put(self, key: bytes, body: bytes, now: float, expires_at: float):
+        with self._lock:
+            if self._conn is None:
+                # Closed at shutdown while the write was queued
+                return
+            with self._conn:
+                self._conn.execute(UPSERT_RESPONSE, (key, body, now, expires_at))
+            self._writes += 1
+            if self._writes % PRUNE_EVERY == 0:
+                self._prune(now)
+
+    def _prune(self, now: float):
+        # Drop expired entries, then the oldest ones while over max_bytes
+        with self._conn:
+            self._conn.execute(DELETE_EXPIRED, (now,))
+        count, size = self._conn.execute(DISK_USAGE).fetchone()
+        if size > self.max_bytes and count:
+            excess = int(count * (size - self.max_bytes) / size) + 1
+            with self._conn:
+                self._conn.execute(DELETE_OLDEST, (excess,))
+
+    def clear(self):
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM responses")
+
+    def usage(self) -> tuple:
+        with self._lock:
+            return self._conn.execute(DISK_USAGE).fetchone()
+
+class ResponseCache:
+    def __init__(self, ttl: float = 3600.0, max_memory_bytes: int = 64 * 1024 * 1024,
+                 max_entry_bytes: int = 1024 * 1024, disk_path: Optional[str] = None,
+                 max_disk_bytes: int = 1024 * 1024 * 1024, stream_chunk_chars: int = 16):
+        self.ttl = ttl
+        # Characters of content per replayed SSE event (0 = all in one event)
+        self.stream_chunk_chars = stream_chunk_chars
+        self.max_memory_bytes = max_memory_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.disk = DiskTier(disk_path, max_disk_bytes) if disk_path else None
+        # key -> (body, expires_at); used from the event loop only
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self.memory_bytes = 0
+        self.stats = {
+            "memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "skipped": 0,
+            "evictions": 0, "expired": 0, "too_large": 0, "disk_errors": 0, "bytes_saved": 0,
+            "stream_hits": 0, "stream_stores": 0,
+        }
+
+    def open(self):
+        if self.disk is not None:
+            try:
+                self.disk.open()
+            except sqlite3.Error as e:
+                logger.error(f"Response cache disk tier disabled: {str(e)}")
+                self.disk = None
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+
+    def key_for(self, request_data: Dict[str, Any], key_record: Optional[Dict[str, Any]] = None,
+                cache_control_header: Optional[str] = None, prompt_hash: Optional[str] = None) -> Optional[tuple]:
+        """(key, controls) for a request, or None if it opted out of caching"""
+        if key_record is not None and (key_record.get("metadata") or {}).get("response_cache") is False:
+            self.stats["skipped"] += 1
+            return None
+        controls = cache_controls(request_data, cache_control_header)
+        if controls.get("no-cache") and controls.get("no-store"):
+            self.stats["skipped"] += 1
+            return None
+        return cache_key(request_data, prompt_hash), controls
+
+    async def get(self, key: bytes, controls: Optional[Dict[str, Any]] = None) -> Optional[bytes]:
+        """Cached response body, from memory or disk"""
+        if controls and controls.get("no-cache"):
+            self.stats["skipped"] += 1
+            return None
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[1] >= now:
+                self._entries.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                self.stats["bytes_saved"] += len(entry[0])
+                return entry[0]
+            self._drop(key)
+            self.stats["expired"] += 1
+        if self.disk is not None:
+            try:
+                found = await asyncio.to_thread(self.disk.get, key, now)
+            except sqlite3.Error as e:
+                self.stats["disk_errors"] += 1
+                logger.warning(f"Response cache read failed: {str(e)}")
+                found = None
+            if found is not None:
+                body, expires_at = found
+                self._remember(key, body, expires_at)
+                self.stats["disk_hits"] += 1
+                self.stats["bytes_saved"] += len(body)
+                return body
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key: bytes, body: bytes, controls: Optional[Dict[str, Any]] = None):
+        """Store a response body in memory now and on disk in the background"""
+        if controls and controls.get("no-store"):
+            return
+        if len(body) > self.max_entry_bytes:
+            self.stats["too_large"] += 1
+            return
+        now = time.time()
+        ttl = float((controls or {}).get("ttl") or self.ttl)
+        self._remember(key, body, now + ttl)
+        self.stats["stores"] += 1
+        if self.disk is not None:
+            asyncio.get_running_loop().run_in_executor(None, self._write_disk, key, body, now, now + ttl)
+
+    def replay(self, body: bytes, request_data: Dict[str, Any]) -> Optional[list]:
+        """SSE events replaying a cached completion for a streaming request (None if it cannot be replayed)"""
+        include_usage = bool((request_data.get("stream_options") or {}).get("include_usage"))
+        try:
+            events = completion_to_sse(body, self.stream_chunk_chars, include_usage)
+        except ValueError:
+            return None
+        self.stats["stream_hits"] += 1
+        return events
+
+    def assembler(self) -> StreamAssembler:
+        return StreamAssembler(self.max_entry_bytes)
+
+    def put_stream(self, key: bytes, assembler: StreamAssembler, controls: Optional[Dict[str, Any]] = None):
+        """Store a finished streamed response"""
+        if controls and controls.get("no-store"):
+            return
+        body = assembler.result()
+        if body is None:
+            if assembler.failed and assembler.size > self.max_entry_bytes:
+                self.stats["too_large"] += 1
+            return
+        self.stats["stream_stores"] += 1
+        self.put(key, body, controls)
+
+    def _write_disk(self, key: bytes, body: bytes, now: float, expires_at: float):
+        try:
+            self.disk.put(key, body, now, expires_at)
+        except sqlite3.Error as e:
+            self.stats["disk_errors"] += 1
+            logger.warning(f"Response cache write failed: {str(e)}")
+
+    def _remember(self, key: bytes, body: bytes, expires_at: float):
+        size = len(body) + ENTRY_OVERHEAD
+        if size > self.max_memory_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (body, expires_at)
+        self.memory_bytes += size
+        while self.memory_bytes > self.max_memory_bytes:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.stats["evictions"] += 1
+
+    def _drop(self, key: bytes):
+        body, _ = self._entries.pop(key)
+        self.memory_bytes -= len(body) + ENTRY_OVERHEAD
+
+    async def clear(self):
+        self._entries.clear()
+        self.memory_bytes = 0
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.clear)
+
+    async def metrics(self) -> Dict[str, Any]:
+        metrics = dict(self.stats)
+        hits = metrics["memory_hits"] + metrics["disk_hits"]
+        lookups = hits + metrics["misses"]
+        metrics["hit_rate"] = hits / lookups if lookups else 0.0
+        metrics["memory_entries"] = len(self._entries)
+        metrics["memory_bytes"] = self.memory_bytes
+        metrics["max_memory_bytes"] = self.max_memory_bytes
+        metrics["ttl"] = self.ttl
+        metrics["stream_chunk_chars"] = self.stream_chunk_chars
+        if self.disk is not None:
+            try:
+                entries, size = await asyncio.to_thread(self.disk.usage)
+                metrics["disk_entries"] = entries
+                metrics["disk_bytes"] = size
+            except sqlite3.Error:
+                pass
+            metrics["max_disk_bytes"] = self.disk.max_bytes
+        return metrics
@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger("litellm-proxy")
+
+# Shared counter state for multiple proxy workers / machines
+#
+# Balances, budget reservations and rate counters are plain float counters
+# with Redis semantics (INCRBYFLOAT / MGET / SETNX / EXPIRE). SharedCounters
+# keeps a local cache in front of the backend: increments are buffered and
+# sent in one pipelined batch every flush_interval, and cached values are
+# refreshed once they are older than max_staleness. Reads never wait on the
+# network; they see the cached global value plus this process's unflushed
+# increments, so other workers' updates show up within
+# flush_interval + max_staleness.
+
+class LocalBackend:
+    """In-process stand-in for Redis, for single-worker deployments and tests"""
+
+    def __init__(self):
+        self._values: Dict[str, float] = {}
+        self._expires: Dict[str, float] = {}
+
+    def _expire(self, names: Iterable[str]):
+        now = time.monotonic()
+        for name in names:
+            expires = self._expires.get(name)
+            if expires is not None and expires <= now:
+                self._values.pop(name, None)
+                self._expires.pop(name, None)
+
+    async def incr_many(self, deltas: Dict[str, float], ttls: Dict[str, float]) -> Dict[str, float]:
+        self._expire(deltas)
+        now = time.monotonic()
+        for name, delta in deltas.items():
+            self._values[name] = self._values.get(name, 0.0) + delta
+            if name in ttls:
+                self._expires[name] = now + ttls[name]
+        return {name: self._values[name] for name in deltas}
+
+    async def get_many(self, names: List[str]) -> Dict[str, Optional[float]]:
+        self._expire(names)
+        return {name: self._values.get(name) for name in names}
+
+    async def set_many_if_absent(self, values: Dict[str, float]):
+        for name, value in values.items():
+            self._values.setdefault(name, value)
+
+    async def close(self):
+        pass
+
+class RedisBackend:
+    """Redis (or any Redis-compatible server) backend using pipelined commands"""
+
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("SHARED_STATE_URL points at redis but the redis package is not installed")
+        self._client = redis.from_url(url)
+
+    async def incr_many(self, deltas: Dict[str, float], ttls: Dict[str, float]) -> Dict[str, float]:
+        pipe = self._client.pipeline(transaction=False)
+        names = list(deltas)
+        for name in names:
+            pipe.incrbyfloat(name, deltas[name])
+            if name in ttls:
+                pipe.expire(name, max(1, int(ttls[name])))
+        results = await pipe.execute()
+        totals = {}
+        index = 0
+        for name in names:
+            totals[name] = float(results[index])
+            index += 2 if name in ttls else 1
+        return totals
+
+    async def get_many(self, names: List[str]) -> Dict[str, Optional[float]]:
+        values = await self._client.mget(names)
+        return {name: float(value) if value is not None else None for name, value in zip(names, values)}
+
+    async def set_many_if_absent(self, values: Dict[str, float]):
+        pipe = self._client.pipeline(transaction=False)
+        for name, value in values.items():
+            pipe.setnx(name, value)
+        await pipe.execute()
+
+    async def close(self):
+        await self._client.close()
+
+class SharedCounters:
+    def __init__(self, backend, flush_interval: float = 0.05, max_staleness: float = 0.5, namespace: str = "fly-llm:"):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.max_staleness = max_staleness
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._pending: Dict[str, float] = {}
+        self._inflight: Dict[str, float] = {}
+        self._ttls: Dict[str, float] = {}
+        # name -> (global value, monotonic time it was fetched)
+        self._cache: Dict[str, Tuple[float, float]] = {}
+        # names with a TTL -> monotonic time after which they are forgotten locally
+        self._local_expiry: Dict[str, float] = {}
+        self.stats = {"flushes": 0, "increments_sent": 0, "refreshes": 0, "errors": 0}
+
+    def add(self, name: str, delta: float, ttl: Optional[float] = None):
+        """Buffer an increment; it reaches the backend on the next flush"""
+        with self._lock:
+            self._pending[name] = self._pending.get(name, 0.0) + delta
+            if ttl is not None:
+                self._ttls[name] = ttl
+                self._local_expiry[name] = time.monotonic() + ttl
+            elif name not in self._cache:
+                self._cache[name] = (0.0, 0.0)
+
+    def get(self, name: str) -> float:
+        """Cached global value plus this process's unflushed increments"""
+        with self._lock:
+            cached = self._cache.get(name)
+            if cached is None:
+                # Start tracking; the next sync fetches the global value
+                self._cache[name] = (0.0, 0.0)
+                cached = (0.0, 0.0)
+            return cached[0] + self._inflight.get(name, 0.0) + self._pending.get(name, 0.0)
+
+    def cached_items(self, prefix: str) -> List[Tuple[str, float]]:
+        """(name without prefix, value) for every tracked counter starting with prefix"""
+        with self._lock:
+            return [
+                (name[len(prefix):], value + self._inflight.get(name, 0.0) + self._pending.get(name, 0.0))
+                for name, (value, _) in self._cache.items()
+                if name.startswith(prefix)
+            ]
+
+    async def seed(self, values: Dict[str, float]):
+        """Initialise counters that do not exist in the backend yet (SETNX)"""
+        if values:
+            await self.backend.set_many_if_absent({self.namespace + name: value for name, value in values.items()})
+            await self._refresh(list(values))
+
+    async def sync(self):
+        """Send buffered increments and refresh stale cached values"""
+        with self._lock:
+            deltas, self._pending = self._pending, {}
+            self._inflight = deltas
+            ttls = {name: self._ttls[name] for name in deltas if name in self._ttls}
+            self._forget_expired()
+        if deltas:
+            try:
+                totals = await self.backend.incr_many(
+                    {self.namespace + name: delta for name, delta in deltas.items()},
+                    {self.namespace + name: ttl for name, ttl in ttls.items()},
+                )
+            except Exception:
+                # Keep the increments for the next attempt
+                with self._lock:
+                    for name, delta in deltas.items():
+                        self._pending[name] = self._pending.get(name, 0.0) + delta
+                    self._inflight = {}
+                raise
+            now = time.monotonic()
+            with self._lock:
+                for name in deltas:
+                    self._cache[name] = (totals[self.namespace + name], now)
+                self._inflight = {}
+                self.stats["flushes"] += 1
+                self.stats["increments_sent"] += len(deltas)
+
+        now = time.monotonic()
+        with self._lock:
+            stale = [name for name, (_, fetched) in self._cache.items() if now - fetched >= self.max_staleness]
+        if stale:
+            await self._refresh(stale)
+
+    async def _refresh(self, names: List[str]):
+        values = await self.backend.get_many([self.namespace + name for name in names])
+        now = time.monotonic()
+        with self._lock:
+            for name in names:
+                value = values[self.namespace + name]
+                self._cache[name] = (value or 0.0, now)
+            self.stats["refreshes"] += 1
+
+    def _forget_expired(self):
+        now = time.monotonic()
+        expired = [name for name, expires in self._local_expiry.items() if expires <= now and name not in self._pending]
+        for name in expired:
+            self._local_expiry.pop(name, None)
+            self._ttls.pop(name, None)
+            self._cache.pop(name, None)
+
+    async def run(self):
+        """Background task that syncs with the backend every flush_interval seconds"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Shared state sync failed: {str(e)}")
+
+    async def close(self):
+        try:
+            await self.sync()
+        finally:
+            await self.backend.close()
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            metrics = dict(self.stats)
+            metrics["tracked_counters"] = len(self._cache)
+            metrics["pending_increments"] = len(self._pending)
+        return metrics
+
+# Fixed-window request counter shared by all workers
+class RateLimiter:
+    def __init__(self, counters: SharedCounters, limit: int, window: float):
+        self.counters = counters
+        self.limit = limit
+        self.window = window
+
+    def hit(self, identity: str) -> bool:
+        """Count one request for identity; False if the window's limit is already used up"""
+        name = f"rate:{identity}:{int(time.time() // self.window)}"
+        if self.counters.get(name) + 1 > self.limit:
+            return False
+        self.counters.add(name, 1, ttl=self.window * 2)
+        return True
+
+def create_shared_counters(url: str, flush_interval: float = 0.05, max_staleness: float = 0.5) -> SharedCounters:
+    """Build SharedCounters for a SHARED_STATE_URL ("local" or redis://...)"""
+    if url == "local":
+        backend = LocalBackend()
+    elif url.startswith(("redis://", "rediss://", "unix://")):
+        backend = RedisBackend(url)
+    else:
+        raise ValueError(f"Unsupported SHARED_STATE_URL: {url}")
+    return SharedCounters(backend, flush_interval=flush_interval, max_staleness=max_staleness)
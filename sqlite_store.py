@@ -0,0 +1,382 @@
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger("litellm-proxy")
+
+# SQLite storage engine for keys, usage and balances
+#
+# The database runs in WAL mode so the usage writer never blocks readers.
+# Connections come from a small pool; each connection keeps its compiled
+# statements in sqlite3's statement cache, so the SQL constants below are
+# prepared once per connection and reused.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS api_keys (
+    key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    expires_at TEXT,
+    models TEXT,
+    metadata TEXT,
+    max_budget REAL,
+    usage REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key_id TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    model TEXT NOT NULL,
+    input_tokens INTEGER NOT NULL DEFAULT 0,
+    output_tokens INTEGER NOT NULL DEFAULT 0,
+    cost REAL NOT NULL,
+    request_id TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_usage_key_timestamp ON usage (key_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_usage_timestamp ON usage (timestamp);
+CREATE INDEX IF NOT EXISTS idx_usage_model_timestamp ON usage (model, timestamp);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+SELECT_KEYS = "SELECT key, name, created_at, expires_at, models, metadata, max_budget, usage FROM api_keys"
+UPSERT_KEY = """
+INSERT INTO api_keys (key, name, created_at, expires_at, models, metadata, max_budget, usage)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(key) DO UPDATE SET
+    name = excluded.name,
+    created_at = excluded.created_at,
+    expires_at = excluded.expires_at,
+    models = excluded.models,
+    metadata = excluded.metadata,
+    max_budget = excluded.max_budget
+"""
+DELETE_KEY = "DELETE FROM api_keys WHERE key = ?"
+ADD_KEY_USAGE = "UPDATE api_keys SET usage = usage + ? WHERE key = ?"
+# Bumped by every key write so other processes know to reload their key index
+BUMP_KEYS_VERSION = """
+INSERT INTO meta (name, value) VALUES ('keys_version', 1)
+ON CONFLICT(name) DO UPDATE SET value = value + 1
+"""
+SELECT_KEYS_VERSION = "SELECT value FROM meta WHERE name = 'keys_version'"
+INSERT_USAGE = """
+INSERT INTO usage (key_id, timestamp, model, input_tokens, output_tokens, cost, request_id)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+USAGE_COLUMNS = "id, key_id, timestamp, model, input_tokens, output_tokens, cost, request_id"
+SELECT_USAGE_REQUEST_IDS = "SELECT request_id FROM usage WHERE request_id IS NOT NULL"
+SELECT_ANY_USAGE = "SELECT 1 FROM usage LIMIT 1"
+SELECT_USAGE_AFTER = f"SELECT {USAGE_COLUMNS} FROM usage WHERE id > ? ORDER BY id LIMIT ?"
+
+# Rows fetched per round trip when streaming the usage table
+READ_BATCH_SIZE = 1000
+
+class SQLiteStore:
+    def __init__(self, path: str, pool_size: int = 4, timeout: float = 30.0):
+        self.path = path
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._pool: Optional[queue.Queue] = None
+        self._write_lock = threading.Lock()
+
+    def open(self):
+        """Create the database, switch it to WAL mode and fill the connection pool"""
+        if self._pool is not None:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        pool = queue.Queue(maxsize=self.pool_size)
+        for _ in range(self.pool_size):
+            pool.put(self._connect())
+        with self._borrow(pool) as conn:
+            conn.executescript(SCHEMA)
+        self._pool = pool
+
+    def close(self):
+        if self._pool is None:
+            return
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+        self._pool = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False, cached_statements=64)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextlib.contextmanager
+    def _borrow(self, pool: Optional[queue.Queue] = None):
+        pool = pool or self._pool
+        conn = pool.get()
+        try:
+            yield conn
+        finally:
+            pool.put(conn)
+
+    def connection(self):
+        """Borrow a pooled connection (context manager)"""
+        return self._borrow()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Borrow a connection for a write transaction; SQLite allows one writer at a time"""
+        with self._write_lock, self._borrow() as conn:
+            with conn:
+                yield conn
+
+    # API keys
+
+    def load_keys(self) -> Dict[str, Dict]:
+        with self.connection() as conn:
+            rows = conn.execute(SELECT_KEYS).fetchall()
+        return {row[0]: _key_from_row(row) for row in rows}
+
+    def save_keys(self, upserts: Dict[str, Dict], deletes: Iterable[str], usage: Dict[str, float]):
+        """Upsert the changed keys (keeping their stored usage), delete the revoked keys and add usage
+
+        Keys not mentioned are left alone, so processes sharing the database
+        never drop each other's keys.
+        """
+        with self.transaction() as conn:
+            conn.executemany(UPSERT_KEY, [_key_to_row(key, data) for key, data in upserts.items()])
+            conn.executemany(DELETE_KEY, [(key,) for key in deletes])
+            conn.executemany(ADD_KEY_USAGE, [(cost, key) for key, cost in usage.items()])
+            conn.execute(BUMP_KEYS_VERSION)
+
+    def keys_version(self) -> int:
+        """Counter that changes whenever any process writes keys"""
+        with self.connection() as conn:
+            row = conn.execute(SELECT_KEYS_VERSION).fetchone()
+        return row[0] if row else 0
+
+    # Usage
+
+    def insert_usage(self, records: Iterable[Dict]) -> Optional[int]:
+        """Insert usage records and return the id of the last row of this batch (None if empty)"""
+        rows = [_usage_to_row(record) for record in records]
+        if not rows:
+            return None
+        with self.transaction() as conn:
+            conn.executemany(INSERT_USAGE, rows)
+            # This connection's own last insert; MAX(id) could be another process's row
+            return conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+
+    def iter_usage_after(self, last_id: int = 0) -> Iterator[Tuple[int, Dict]]:
+        """Yield (id, record) for usage rows with id greater than last_id"""
+        while True:
+            with self.connection() as conn:
+                rows = conn.execute(SELECT_USAGE_AFTER, (last_id, READ_BATCH_SIZE)).fetchall()
+            for row in rows:
+                last_id = row[0]
+                yield last_id, _usage_from_row(row)
+            if len(rows) < READ_BATCH_SIZE:
+                return
+
+    def query_usage(self, since: Optional[str] = None, until: Optional[str] = None,
+                    key_id: Optional[str] = None, model: Optional[str] = None,
+                    after: Optional[Tuple[str, int]] = None, limit: int = 100) -> Tuple[List[Dict], Optional[Tuple[str, int]]]:
+        """Return up to limit matching records ordered by (timestamp, id)
+
+        The filters map onto the (key_id, timestamp), (model, timestamp) and
+        timestamp indexes, so only the matching range is read. after is the
+        (timestamp, id) of the last record of the previous page.
+        """
+        clauses = []
+        params = []
+        if key_id:
+            clauses.append("key_id = ?")
+            params.append(key_id)
+        if model:
+            clauses.append("model = ?")
+            params.append(model)
+        if since:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until:
+            clauses.append("timestamp < ?")
+            params.append(until)
+        if after:
+            clauses.append("(timestamp > ? OR (timestamp = ? AND id > ?))")
+            params.extend([after[0], after[0], after[1]])
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        sql = f"SELECT {USAGE_COLUMNS} FROM usage{where} ORDER BY timestamp, id LIMIT ?"
+        params.append(limit)
+
+        with self.connection() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        next_after = (rows[-1][2], rows[-1][0]) if len(rows) == limit else None
+        return [_usage_from_row(row) for row in rows], next_after
+
+    def checkpoint(self):
+        with self.connection() as conn:
+            conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+# Usage journal backed by the SQLite usage table
+#
+# Implements the same interface as usage_log.UsageJournal so the usage
+# queue and rollups work unchanged. Journal positions are (0, row id).
+class SQLiteUsageJournal:
+    def __init__(self, store: SQLiteStore, checkpoint_interval: float = 60.0):
+        self.store = store
+        self.checkpoint_interval = checkpoint_interval
+
+    def open(self):
+        self.store.open()
+
+    def close(self):
+        self.store.close()
+
+    def append(self, record: Dict):
+        return self.append_many([record])
+
+    def append_many(self, records: Iterable[Dict]):
+        last_id = self.store.insert_usage(records)
+        return (0, last_id) if last_id is not None else None
+
+    def sync(self):
+        # Every batch is committed in its own transaction
+        pass
+
+    async def run_syncer(self):
+        """Background task that checkpoints the WAL into the main database file"""
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            try:
+                await asyncio.to_thread(self.store.checkpoint)
+            except Exception as e:
+                logger.error(f"SQLite checkpoint failed: {str(e)}")
+
+    def iter_records(self, start=None) -> Iterator[Dict]:
+        for record, _ in self.iter_records_with_position(start):
+            yield record
+
+    def query(self, since=None, until=None, key_id=None, model=None, after=None, limit=100):
+        return self.store.query_usage(since, until, key_id, model, tuple(after) if after else None, limit)
+
+    def iter_records_with_position(self, start=None):
+        last_id = start[1] if start else 0
+        for row_id, record in self.store.iter_usage_after(last_id):
+            yield record, (0, row_id)
+
+def _key_to_row(key: str, data: Dict):
+    return (
+        key,
+        data["name"],
+        data["created_at"],
+        data.get("expires_at"),
+        json.dumps(data.get("models")) if data.get("models") is not None else None,
+        json.dumps(data.get("metadata") or {}),
+        data.get("max_budget"),
+        data.get("usage", 0.0),
+    )
+
+def _key_from_row(row) -> Dict:
+    return {
+        "name": row[1],
+        "created_at": row[2],
+        "expires_at": row[3],
+        "models": json.loads(row[4]) if row[4] is not None else None,
+        "metadata": json.loads(row[5]) if row[5] else {},
+        "max_budget": row[6],
+        "usage": row[7],
+    }
+
+def _usage_to_row(record: Dict):
+    return (
+        record["key_id"],
+        record["timestamp"],
+        record["model"],
+        record.get("input_tokens", 0),
+        record.get("output_tokens", 0),
+        record["cost"],
+        record.get("request_id"),
+    )
+
+def _usage_from_row(row) -> Dict:
+    return {
+        "key_id": row[1],
+        "timestamp": row[2],
+        "model": row[3],
+        "input_tokens": row[4],
+        "output_tokens": row[5],
+        "cost": row[6],
+        "request_id": row[7],
+    }
+
+def migrate_json(json_path: str, db_path: str, usage_dir: Optional[str] = None):
+    """Import an api_keys.json file (and optionally a usage journal) into a SQLite database"""
+    from usage_log import UsageJournal
+
+    with open(json_path, "r") as f:
+        data = json.load(f)
+
+    store = SQLiteStore(db_path, pool_size=1)
+    store.open()
+    try:
+        # Keys already in the database keep their stored usage
+        store.save_keys(data.get("keys", {}), [], {})
+
+        # Safe to run again: records whose request_id is already stored are skipped,
+        # and records without one are only imported into an empty usage table
+        with store.connection() as conn:
+            existing = {row[0] for row in conn.execute(SELECT_USAGE_REQUEST_IDS)}
+            empty = conn.execute(SELECT_ANY_USAGE).fetchone() is None
+
+        def new_records(records):
+            for record in records:
+                request_id = record.get("request_id")
+                if request_id is None:
+                    if not empty:
+                        continue
+                elif request_id in existing:
+                    continue
+                else:
+                    existing.add(request_id)
+                yield record
+
+        records = iter(data.get("usage") or [])
+        if usage_dir and os.path.isdir(usage_dir):
+            records = itertools.chain(records, UsageJournal(usage_dir).iter_records())
+
+        imported = 0
+        batch = []
+        for record in new_records(records):
+            batch.append(record)
+            if len(batch) >= READ_BATCH_SIZE:
+                store.insert_usage(batch)
+                imported += len(batch)
+                batch = []
+        if batch:
+            store.insert_usage(batch)
+            imported += len(batch)
+    finally:
+        store.close()
+
+    logger.info(f"Migrated {len(data.get('keys', {}))} keys and {imported} usage records into {db_path}")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Manage the SQLite key and usage store")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="Import an existing api_keys.json file")
+    migrate_parser.add_argument("json_path", type=str, help="Path to api_keys.json")
+    migrate_parser.add_argument("db_path", type=str, help="Path to the SQLite database to create or update")
+    migrate_parser.add_argument("--usage-dir", type=str, default=None, help="Usage journal directory to import as well")
+
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        migrate_json(args.json_path, args.db_path, args.usage_dir)
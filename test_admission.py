@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected, UpstreamLimiter
+
+def test_try_acquire_takes_only_free_slots():
+    async def scenario():
+        controller = AdmissionController({"gpt-4o": UpstreamLimiter(max_concurrency=1, max_queue=1)})
+        release = controller.try_acquire("gpt-4o")
+        assert release is not None
+        assert controller.try_acquire("gpt-4o") is None
+        release()
+        release()
+        assert controller.metrics()["gpt-4o"]["active"] == 0
+        assert controller.try_acquire("gpt-4o") is not None
+
+    asyncio.run(scenario())
+
+def test_try_acquire_does_not_jump_the_queue():
+    async def scenario():
+        limiter = UpstreamLimiter(max_concurrency=1, max_queue=2, queue_timeout=1.0)
+        controller = AdmissionController({"gpt-4o": limiter})
+        release = await controller.acquire("gpt-4o")
+        waiter = asyncio.create_task(controller.acquire("gpt-4o"))
+        await asyncio.sleep(0)
+        release()
+        # The slot went to the queued request, not to a hedge
+        assert controller.try_acquire("gpt-4o") is None
+        (await waiter)()
+        assert limiter.active == 0
+
+    asyncio.run(scenario())
+
+def test_unlimited_models_always_admit():
+    controller = AdmissionController({})
+    release = controller.try_acquire("anything")
+    assert callable(release)
+    release()
+
+def test_full_queue_rejects_with_retry_after():
+    async def scenario():
+        controller = AdmissionController({"gpt-4o": UpstreamLimiter(max_concurrency=1, max_queue=0, queue_timeout=7.0)})
+        await controller.acquire("gpt-4o")
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire("gpt-4o")
+        assert rejected.value.status_code == 429
+        assert rejected.value.headers == {"Retry-After": "7"}
+
+    asyncio.run(scenario())
@@ -0,0 +1,48 @@
+import pytest
+
+from budget_ledger import BudgetLedger
+
+def test_reservations_count_against_the_budget():
+    ledger = BudgetLedger()
+    first = ledger.reserve("sk-a", 4.0, spent=0.0, max_budget=10.0)
+    second = ledger.reserve("sk-a", 4.0, spent=0.0, max_budget=10.0)
+    assert first and second
+    assert ledger.reserve("sk-a", 4.0, spent=0.0, max_budget=10.0) is None
+    assert ledger.outstanding("sk-a") == pytest.approx(8.0)
+    # Other keys have their own budgets
+    assert ledger.reserve("sk-b", 4.0, spent=0.0, max_budget=10.0)
+
+def test_release_gives_the_reservation_back_once():
+    ledger = BudgetLedger()
+    reservation = ledger.reserve("sk-a", 6.0, spent=0.0, max_budget=10.0)
+    ledger.release(reservation)
+    ledger.release(reservation)
+    ledger.release(None)
+    ledger.release("not-a-reservation")
+    assert ledger.outstanding("sk-a") == 0.0
+    assert ledger.metrics()["released"] == 1
+    assert ledger.reserve("sk-a", 10.0, spent=0.0, max_budget=10.0)
+
+def test_settled_cost_stays_pending_until_applied():
+    ledger = BudgetLedger()
+    reservation = ledger.reserve("sk-a", 5.0, spent=0.0, max_budget=10.0)
+    ledger.settle("sk-a", 2.0, reservation)
+    assert ledger.outstanding("sk-a") == pytest.approx(2.0)
+    assert ledger.reserve("sk-a", 9.0, spent=0.0, max_budget=10.0) is None
+    # The usage writer added the cost to the key balance
+    ledger.applied("sk-a", 2.0)
+    assert ledger.outstanding("sk-a") == 0.0
+    assert ledger.reserve("sk-a", 8.0, spent=2.0, max_budget=10.0)
+
+def test_spent_balance_counts_against_the_budget():
+    ledger = BudgetLedger()
+    assert ledger.reserve("sk-a", 1.0, spent=9.5, max_budget=10.0) is None
+    # Keys without a budget are never rejected
+    assert ledger.reserve("sk-a", 100.0, spent=9.5, max_budget=None)
+
+def test_expired_reservations_are_swept():
+    ledger = BudgetLedger(shards=1, reservation_ttl=-1.0, sweep_every=2)
+    ledger.reserve("sk-a", 6.0, spent=0.0, max_budget=10.0)
+    # The second operation on the shard sweeps the reservation that never reported back
+    assert ledger.reserve("sk-a", 6.0, spent=0.0, max_budget=10.0)
+    assert ledger.metrics()["expired"] == 1
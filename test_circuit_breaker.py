@@ -0,0 +1,65 @@
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakers
+
+class UpstreamError(Exception):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+def test_opens_after_failures():
+    breaker = CircuitBreaker(failure_threshold=0.5, min_requests=3, window=60.0, open_seconds=30.0)
+    breaker.record("success", 0.0)
+    breaker.record("error", 1.0)
+    assert breaker.state == CLOSED
+    breaker.record("timeout", 2.0)
+    assert breaker.state == OPEN
+    assert not breaker.allow(3.0)
+    assert breaker.snapshot(12.0)["retry_in"] == 20.0
+
+def test_half_open_probe_after_cooldown():
+    breaker = CircuitBreaker(min_requests=1, open_seconds=30.0, half_open_probes=1)
+    breaker.record("error", 0.0)
+    assert not breaker.available(29.0)
+    assert breaker.allow(30.0)
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow(31.0)
+    breaker.record("error", 32.0)
+    assert breaker.state == OPEN
+    assert breaker.allow(62.0)
+    breaker.record("success", 63.0)
+    assert breaker.state == CLOSED
+    assert breaker.allow(64.0)
+
+def test_unanswered_probe_is_forgotten():
+    breaker = CircuitBreaker(min_requests=1, open_seconds=10.0)
+    breaker.record("error", 0.0)
+    assert breaker.allow(10.0)
+    assert not breaker.allow(15.0)
+    assert breaker.allow(21.0)
+
+def test_client_errors_do_not_count():
+    breakers = CircuitBreakers(min_requests=1)
+    breakers.record("gpt-4o", False, UpstreamError(400))
+    assert not breakers.is_open("gpt-4o")
+    breakers.record("gpt-4o", False, UpstreamError(503))
+    assert breakers.is_open("gpt-4o")
+
+def test_reset_closes_breakers():
+    breakers = CircuitBreakers(min_requests=1)
+    breakers.record("gpt-4o", False)
+    breakers.record("claude-3-haiku", False)
+    breakers.reset("gpt-4o")
+    assert not breakers.is_open("gpt-4o")
+    assert breakers.is_open("claude-3-haiku")
+    breakers.reset()
+    assert breakers.snapshot() == {}
+
+def test_route_around_uses_the_fallback_chain():
+    breakers = CircuitBreakers(min_requests=1)
+    breakers.fallbacks = {"gpt-4o": "gpt-4", "gpt-4": "claude-3-sonnet", "claude-3-sonnet": "gpt-4o"}
+    assert breakers.route_around("gpt-4o") == "gpt-4o"
+    breakers.record("gpt-4o", False)
+    assert breakers.route_around("gpt-4o") == "gpt-4"
+    breakers.record("gpt-4", False)
+    assert breakers.route_around("gpt-4o") == "claude-3-sonnet"
+    breakers.record("claude-3-sonnet", False)
+    assert breakers.route_around("gpt-4o") is None
+    assert breakers.route_around("mistral-medium") == "mistral-medium"
@@ -0,0 +1,97 @@
+import pytest
+
+from key_store import APIKeyIndex, apply_key_changes
+
+class Store:
+    """In-memory backing store shared by several indexes, like one keys file shared by workers"""
+
+    def __init__(self, keys=None):
+        self.keys = keys or {}
+        self.version = 0
+        self.saves = []
+        self.fail = False
+
+    def load(self):
+        return {key: dict(data) for key, data in self.keys.items()}
+
+    def save(self, upserts, deletes, usage):
+        if self.fail:
+            raise OSError("disk full")
+        self.saves.append((upserts, deletes, usage))
+        apply_key_changes(self.keys, upserts, deletes, usage)
+        self.version += 1
+
+    def index(self):
+        index = APIKeyIndex(self.load, self.save, version=lambda: self.version)
+        index.load()
+        return index
+
+def record(name, usage=0.0):
+    return {"name": name, "created_at": "2025-01-01T00:00:00", "expires_at": None, "usage": usage}
+
+def test_flush_writes_only_changes():
+    store = Store({"sk-a": record("a"), "sk-b": record("b")})
+    index = store.index()
+    index.put("sk-c", record("c"))
+    index.add_usage("sk-a", 1.5)
+    index.flush()
+    index.flush()
+    assert store.saves == [({"sk-c": {"name": "c", "created_at": "2025-01-01T00:00:00", "expires_at": None}}, [], {"sk-a": 1.5})]
+    assert store.keys["sk-a"]["usage"] == 1.5
+
+def test_workers_do_not_overwrite_each_other():
+    store = Store({"sk-a": record("a")})
+    first, second = store.index(), store.index()
+    first.put("sk-new", record("new"))
+    first.add_usage("sk-a", 1.0)
+    second.add_usage("sk-a", 2.0)
+    first.flush()
+    second.flush()
+    assert set(store.keys) == {"sk-a", "sk-new"}
+    assert store.keys["sk-a"]["usage"] == 3.0
+
+def test_key_created_elsewhere_is_found_on_miss():
+    store = Store({"sk-a": record("a")})
+    first, second = store.index(), store.index()
+    first.put("sk-new", record("new"))
+    first.flush()
+    assert "sk-new" in second
+    assert second.get("sk-new")["name"] == "new"
+
+def test_refresh_drops_deleted_keys_and_keeps_pending_changes():
+    store = Store({"sk-a": record("a", usage=1.0), "sk-b": record("b")})
+    first, second = store.index(), store.index()
+    first.delete("sk-b")
+    first.add_usage("sk-a", 1.0)
+    first.flush()
+    second.add_usage("sk-a", 0.5)
+    second.put("sk-local", record("local"))
+    assert second.refresh()
+    assert second.get("sk-b") is None
+    assert second.get("sk-a")["usage"] == 2.5
+    assert second.get("sk-local")["name"] == "local"
+    assert [key for key, _ in second.page()[0]] == ["sk-a", "sk-local"]
+    assert not second.refresh()
+
+def test_failed_flush_keeps_changes_pending():
+    store = Store({"sk-a": record("a")})
+    index = store.index()
+    index.add_usage("sk-a", 1.0)
+    index.delete("sk-a")
+    index.put("sk-b", record("b"))
+    index.add_usage("sk-b", 2.0)
+    store.fail = True
+    with pytest.raises(OSError):
+        index.flush()
+    store.fail = False
+    index.flush()
+    assert set(store.keys) == {"sk-b"}
+    assert store.keys["sk-b"]["usage"] == 2.0
+
+def test_raise_usage_is_not_persisted():
+    store = Store({"sk-a": record("a")})
+    index = store.index()
+    index.raise_usage("sk-a", 5.0)
+    index.flush()
+    assert index.get("sk-a")["usage"] == 5.0
+    assert store.saves == []
@@ -0,0 +1,57 @@
+from model_stats import ModelStatsRegistry
+
+def test_callback_after_release_still_records_failure():
+    # The middleware releases an errored request before LiteLLM's failure callback runs
+    stats = ModelStatsRegistry(min_samples=1)
+    token = stats.start("gpt-4o")
+    stats.finish(token)
+    assert stats.snapshot()["gpt-4o"]["in_flight"] == 0
+    stats.finish(token, success=False, latency=1.0, model="gpt-4o")
+    snapshot = stats.snapshot()["gpt-4o"]
+    assert snapshot["in_flight"] == 0
+    assert snapshot["requests"] == 1
+    assert snapshot["errors"] == 1
+
+def test_release_after_callback_is_ignored():
+    stats = ModelStatsRegistry(min_samples=1)
+    token = stats.start("gpt-4o")
+    stats.finish(token, success=False, latency=1.0)
+    stats.finish(token)
+    snapshot = stats.snapshot()["gpt-4o"]
+    assert snapshot["in_flight"] == 0
+    assert snapshot["requests"] == 1
+
+def test_outcome_is_recorded_once():
+    stats = ModelStatsRegistry()
+    token = stats.start("gpt-4o")
+    stats.finish(token, success=True, latency=0.5)
+    stats.finish(token, success=False, latency=0.5)
+    snapshot = stats.snapshot()["gpt-4o"]
+    assert snapshot["requests"] == 1
+    assert snapshot["errors"] == 0
+
+def test_released_token_uses_its_own_model():
+    stats = ModelStatsRegistry()
+    token = stats.start("claude-3-haiku")
+    stats.finish(token)
+    stats.finish(token, success=True, latency=0.2, model="some-other-group")
+    assert stats.snapshot()["claude-3-haiku"]["requests"] == 1
+    assert "some-other-group" not in stats.snapshot()
+
+def test_sweep_drops_tombstones_without_touching_in_flight():
+    stats = ModelStatsRegistry(token_ttl=0.0)
+    released = stats.start("gpt-4o")
+    stats.finish(released)
+    stats.start("gpt-4o")
+    with stats._lock:
+        stats._sweep(float("inf"))
+    assert stats.snapshot()["gpt-4o"]["in_flight"] == 0
+    assert not stats._tokens
+
+def test_failing_model_becomes_unhealthy():
+    stats = ModelStatsRegistry(min_samples=3, max_error_rate=0.5, alpha=0.5)
+    for _ in range(3):
+        token = stats.start("gpt-4o")
+        stats.finish(token)
+        stats.finish(token, success=False, latency=1.0)
+    assert not stats.is_healthy("gpt-4o")
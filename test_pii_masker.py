@@ -0,0 +1,89 @@
+import json
+
+from pii_masker import PIIMasker, SSEMaskingStream
+
+def sse(data) -> bytes:
+    return b"data: " + json.dumps(data, ensure_ascii=False).encode() + b"\n\n"
+
+def chunk(delta, finish_reason=None, index=0):
+    return {"id": "chatcmpl-1", "object": "chat.completion.chunk",
+            "choices": [{"index": index, "delta": delta, "finish_reason": finish_reason}]}
+
+def stream_content(output: bytes) -> str:
+    """Concatenated choices[].delta.content of an SSE body"""
+    content = []
+    for event in output.split(b"\n\n"):
+        payload = event[5:].strip() if event.startswith(b"data:") else b""
+        if not payload or payload == b"[DONE]":
+            continue
+        for choice in json.loads(payload).get("choices") or []:
+            content.append((choice.get("delta") or {}).get("content") or "")
+    return "".join(content)
+
+def run(events, split=None) -> bytes:
+    stream = SSEMaskingStream(PIIMasker())
+    body = b"".join(events)
+    pieces = [body[i:i + split] for i in range(0, len(body), split)] if split else [body]
+    return b"".join(stream.feed(piece) for piece in pieces) + stream.finish()
+
+def test_masks_email_split_across_chunks():
+    events = [
+        sse(chunk({"role": "assistant", "content": ""})),
+        sse(chunk({"content": "mail taro.ya"})),
+        sse(chunk({"content": "mada@example.com now"})),
+        sse(chunk({}, "stop")),
+        b"data: [DONE]\n\n",
+    ]
+    assert stream_content(run(events)) == "mail [email] now"
+
+def test_final_empty_delta_releases_held_text():
+    events = [
+        sse(chunk({"role": "assistant", "content": ""})),
+        sse(chunk({"content": "the answer is 42"})),
+        sse(chunk({}, "stop")),
+        b"data: [DONE]\n\n",
+    ]
+    output = run(events)
+    assert stream_content(output) == "the answer is 42"
+    final = [json.loads(e[5:]) for e in output.split(b"\n\n") if e.startswith(b"data: {")][-1]
+    assert final["choices"][0]["finish_reason"] == "stop"
+    assert final["choices"][0]["delta"]["content"] == "42"
+
+def test_final_null_delta_releases_held_text():
+    events = [sse(chunk({"content": "call 03-1234-5678"})), sse(chunk(None, "stop")), b"data: [DONE]\n\n"]
+    assert stream_content(run(events)) == "call [phone_jp]"
+
+def test_stream_without_finish_reason_flushes_before_done():
+    events = [sse(chunk({"content": "room 101"})), b"data: [DONE]\n\n"]
+    output = run(events)
+    assert stream_content(output) == "room 101"
+    assert output.endswith(b"data: [DONE]\n\n")
+
+def test_byte_by_byte_feed_matches_whole_feed():
+    events = [
+        sse(chunk({"content": "連絡先は test@example.jp、"})),
+        sse(chunk({"content": "電話は 090-1234-5678 です"})),
+        sse(chunk({}, "stop")),
+        b"data: [DONE]\n\n",
+    ]
+    expected = "連絡先は [email]、電話は [phone_jp] です"
+    assert stream_content(run(events)) == expected
+    assert stream_content(run(events, split=1)) == expected
+
+def test_choices_are_masked_independently():
+    events = [
+        sse(chunk({"content": "a@b"}, index=0)),
+        sse(chunk({"content": "x 1"}, index=1)),
+        sse(chunk({"content": ".io"}, index=0)),
+        sse(chunk({}, "stop", index=0)),
+        sse(chunk({}, "stop", index=1)),
+        b"data: [DONE]\n\n",
+    ]
+    output = run(events)
+    per_choice = {}
+    for event in output.split(b"\n\n"):
+        if event.startswith(b"data: {"):
+            for choice in json.loads(event[5:])["choices"]:
+                per_choice.setdefault(choice["index"], []).append((choice.get("delta") or {}).get("content") or "")
+    assert "".join(per_choice[0]) == "[email]"
+    assert "".join(per_choice[1]) == "x 1"
@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+from pii_masker import PIIMasker, SSEMaskingStream
+from request_context import RequestContext
+from response_cache import ResponseCache, StreamAssembler, cache_key, completion_to_sse
+
+def completion(content, tool_calls=None, finish_reason="stop"):
+    message = {"role": "assistant", "content": content}
+    if tool_calls:
+        message["tool_calls"] = tool_calls
+    return json.dumps({
+        "id": "chatcmpl-1", "object": "chat.completion", "created": 1700000000, "model": "gpt-4o-mini",
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+        "usage": {"prompt_tokens": 5, "completion_tokens": 7, "total_tokens": 12},
+    }, ensure_ascii=False).encode()
+
+def replayed_content(events) -> str:
+    content = []
+    for event in b"".join(events).split(b"\n\n"):
+        if event.startswith(b"data: {"):
+            for choice in json.loads(event[5:])["choices"]:
+                content.append((choice.get("delta") or {}).get("content") or "")
+    return "".join(content)
+
+def test_replay_splits_content_and_ends_with_done():
+    events = completion_to_sse(completion("Hello, world! How are you?"), chunk_chars=5, include_usage=True)
+    assert events[-1] == b"data: [DONE]\n\n"
+    chunks = [json.loads(event[5:]) for event in events[:-1]]
+    assert all(chunk["object"] == "chat.completion.chunk" for chunk in chunks)
+    assert chunks[0]["choices"][0]["delta"]["role"] == "assistant"
+    assert chunks[-2]["choices"][0]["finish_reason"] == "stop"
+    assert chunks[-1]["usage"]["total_tokens"] == 12
+    assert replayed_content(events) == "Hello, world! How are you?"
+
+def test_replay_through_masker_keeps_stored_content():
+    # Response masking is on by default; the held-back tail must survive the final empty delta
+    for content in ("the answer is 42", "see room 101", "plain text only", "電話 03-1234-5678"):
+        stream = SSEMaskingStream(PIIMasker())
+        events = completion_to_sse(completion(content), chunk_chars=4)
+        output = b"".join(stream.feed(event) for event in events) + stream.finish()
+        assert replayed_content([output]) == PIIMasker().mask(content)
+
+def test_assembler_round_trips_replayed_completion():
+    tool_calls = [{"id": "call_1", "type": "function", "function": {"name": "lookup", "arguments": "{\"q\":\"x\"}"}}]
+    body = completion("Checking.", tool_calls, "tool_calls")
+    assembler = StreamAssembler(max_bytes=1 << 20)
+    for event in completion_to_sse(body, chunk_chars=3, include_usage=True):
+        assembler.feed(event)
+    assert json.loads(assembler.result()) == json.loads(body) | {"object": "chat.completion"}
+
+def test_assembler_rejects_unfinished_stream():
+    assembler = StreamAssembler(max_bytes=1 << 20)
+    for event in completion_to_sse(completion("cut short"))[:-2]:
+        assembler.feed(event)
+    assert assembler.result() is None
+
+def test_cache_key_ignores_transport_fields_and_key_order():
+    request = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "hi"}], "temperature": 0}
+    reordered = {"temperature": 0, "stream": True, "user": "u1", "messages": request["messages"], "model": "gpt-4o-mini"}
+    assert cache_key(request) == cache_key(reordered)
+    assert cache_key(request) != cache_key(dict(request, temperature=1))
+
+def test_disk_tier_survives_restart(tmp_path):
+    async def scenario():
+        key = cache_key({"model": "m", "messages": []})
+        first = ResponseCache(disk_path=str(tmp_path / "cache.db"))
+        first.open()
+        first.put(key, b'{"ok":true}')
+        # The disk write happens in the background
+        for _ in range(100):
+            if first.disk.usage()[0]:
+                break
+            await asyncio.sleep(0.01)
+        first.close()
+        second = ResponseCache(disk_path=str(tmp_path / "cache.db"))
+        second.open()
+        try:
+            assert await second.get(key) == b'{"ok":true}'
+            assert second.stats["disk_hits"] == 1
+            assert await second.get(key, {"no-cache": True}) is None
+        finally:
+            second.close()
+
+    asyncio.run(scenario())
+
+def test_cache_key_uses_the_prompt_hash():
+    request = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "hi"}]}
+    context = RequestContext.from_body(json.dumps(request).encode())
+    other = RequestContext.from_body(json.dumps(dict(request, messages=[{"content": "hi", "role": "user"}])).encode())
+    assert cache_key(request, context.prompt_hash) == cache_key(request, other.prompt_hash)
+    changed = RequestContext.from_body(json.dumps(dict(request, messages=[{"role": "user", "content": "ho"}])).encode())
+    assert cache_key(request, context.prompt_hash) != cache_key(request, changed.prompt_hash)
@@ -0,0 +1,39 @@
+import asyncio
+
+from budget_ledger import BudgetLedger
+from shared_state import LocalBackend, RateLimiter, SharedCounters
+
+def test_workers_enforce_one_budget_through_shared_counters():
+    async def scenario():
+        backend = LocalBackend()
+        workers = [BudgetLedger(shared=SharedCounters(backend, max_staleness=0.0)) for _ in range(2)]
+        for ledger in workers:
+            await ledger.seed_balances({"sk-a": 2.0})
+        assert workers[0].reserve("sk-a", 5.0, spent=0.0, max_budget=10.0)
+        await workers[0].shared.sync()
+        await workers[1].shared.sync()
+        # The other worker sees the balance and the reservation
+        assert workers[1].reserve("sk-a", 5.0, spent=0.0, max_budget=10.0) is None
+        assert workers[1].reserve("sk-a", 3.0, spent=0.0, max_budget=10.0)
+
+        workers[0].settle("sk-a", 1.0)
+        workers[0].applied("sk-a", 1.0)
+        await workers[0].shared.sync()
+        await workers[1].shared.sync()
+        assert dict(workers[1].shared_balances())["sk-a"] == 3.0
+
+    asyncio.run(scenario())
+
+def test_rate_limit_is_shared_between_workers():
+    async def scenario():
+        backend = LocalBackend()
+        limiters = [RateLimiter(SharedCounters(backend, max_staleness=0.0), limit=3, window=60) for _ in range(2)]
+        assert limiters[0].hit("sk-a") and limiters[0].hit("sk-a")
+        assert limiters[1].hit("sk-a")
+        # Counts converge once both workers have flushed and refreshed
+        for limiter in limiters + limiters:
+            await limiter.counters.sync()
+        assert not limiters[0].hit("sk-a")
+        assert not limiters[1].hit("sk-a")
+
+    asyncio.run(scenario())
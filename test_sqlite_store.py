@@ -0,0 +1,74 @@
+import json
+
+from sqlite_store import SQLiteStore, SQLiteUsageJournal, migrate_json
+
+def usage(request_id):
+    return {"key_id": "sk-test", "timestamp": "2025-01-01T00:00:00", "model": "gpt-4o",
+            "input_tokens": 1, "output_tokens": 2, "cost": 0.01, "request_id": request_id}
+
+def test_insert_usage_returns_the_batch_own_last_id(tmp_path):
+    path = str(tmp_path / "api_keys.db")
+    first, second = SQLiteStore(path), SQLiteStore(path)
+    first.open()
+    second.open()
+    try:
+        assert first.insert_usage([usage("a1"), usage("a2")]) == 2
+        assert second.insert_usage([usage("b1")]) == 3
+        last_id = first.insert_usage([usage("a3")])
+        rows = {record["request_id"]: row_id for row_id, record in second.iter_usage_after(0)}
+        assert last_id == rows["a3"]
+        assert first.insert_usage([]) is None
+    finally:
+        first.close()
+        second.close()
+
+def test_journal_positions_follow_own_batches(tmp_path):
+    store = SQLiteStore(str(tmp_path / "api_keys.db"))
+    journal = SQLiteUsageJournal(store)
+    journal.open()
+    try:
+        assert journal.append_many([usage("a1")]) == (0, 1)
+        assert journal.append_many([]) is None
+        assert [record["request_id"] for _, record in store.iter_usage_after(0)] == ["a1"]
+    finally:
+        journal.close()
+
+def key(name, usage=0.0):
+    return {"name": name, "created_at": "2025-01-01T00:00:00", "expires_at": None, "models": None,
+            "metadata": {}, "max_budget": None, "usage": usage}
+
+def test_save_keys_touches_only_the_given_keys(tmp_path):
+    path = str(tmp_path / "api_keys.db")
+    first, second = SQLiteStore(path), SQLiteStore(path)
+    first.open()
+    second.open()
+    try:
+        first.save_keys({"sk-a": key("a"), "sk-b": key("b")}, [], {})
+        version = second.keys_version()
+        second.save_keys({"sk-c": key("c")}, [], {"sk-a": 1.0})
+        first.save_keys({"sk-a": key("renamed")}, ["sk-b"], {"sk-a": 2.0})
+        keys = second.load_keys()
+        assert set(keys) == {"sk-a", "sk-c"}
+        assert keys["sk-a"]["name"] == "renamed"
+        assert keys["sk-a"]["usage"] == 3.0
+        assert first.keys_version() > version
+    finally:
+        first.close()
+        second.close()
+
+def test_migrate_json_can_run_twice(tmp_path):
+    json_path = tmp_path / "api_keys.json"
+    json_path.write_text(json.dumps({
+        "keys": {"sk-a": key("a", usage=1.0)},
+        "usage": [usage("r1"), usage("r2"), dict(usage(None), request_id=None)],
+    }))
+    db_path = str(tmp_path / "api_keys.db")
+    migrate_json(str(json_path), db_path)
+    migrate_json(str(json_path), db_path)
+    store = SQLiteStore(db_path)
+    store.open()
+    try:
+        assert store.load_keys()["sk-a"]["usage"] == 1.0
+        assert [record["request_id"] for _, record in store.iter_usage_after(0)] == ["r1", "r2", None]
+    finally:
+        store.close()
@@ -0,0 +1,42 @@
+import json
+
+import pytest
+
+from token_estimator import TokenEstimator, load_weights
+
+def test_cache_is_keyed_by_digest_and_skips_long_texts():
+    estimator = TokenEstimator(cache_size=8, cache_max_chars=100)
+    short = "hello world"
+    assert estimator.count(short) == estimator.count(short)
+    assert estimator.stats["hits"] == 1
+    assert all(isinstance(key, bytes) and len(key) == 16 for key in estimator._cache)
+    estimator.count("x" * 101)
+    assert estimator.stats["uncached"] == 1
+    assert len(estimator._cache) == 1
+
+def test_exact_tokenizer_caches_long_texts():
+    calls = []
+    estimator = TokenEstimator(exact=lambda text: calls.append(text) or len(text), cache_size=8, cache_max_chars=10)
+    long_text = "y" * 1000
+    assert estimator.count(long_text) == estimator.count(long_text) == 1000
+    assert len(calls) == 1
+
+def test_lru_is_bounded():
+    estimator = TokenEstimator(cache_size=2)
+    for text in ("a", "b", "c"):
+        estimator.count(text)
+    assert len(estimator._cache) == 2
+
+def test_calibrated_weights_load_back(tmp_path):
+    fitted = TokenEstimator().calibrate(["abc def", "12345", "こんにちは"], lambda text: len(text))
+    path = tmp_path / "weights.json"
+    path.write_text(json.dumps(fitted))
+    estimator = TokenEstimator(weights=load_weights(str(path)))
+    assert estimator.weights == fitted
+    assert load_weights("") is None
+
+def test_load_weights_rejects_unknown_classes(tmp_path):
+    path = tmp_path / "weights.json"
+    path.write_text(json.dumps({"letters": 0.3}))
+    with pytest.raises(ValueError):
+        load_weights(str(path))
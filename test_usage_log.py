@@ -0,0 +1,125 @@
+import os
+import threading
+
+import usage_log
+from usage_log import UsageJournal
+
+def usage(n, timestamp="2025-01-01T00:00:00", key_id="sk-a", model="gpt-4o"):
+    return {"key_id": key_id, "timestamp": timestamp, "model": model,
+            "input_tokens": n, "output_tokens": n, "cost": 0.001 * n, "request_id": f"req-{n}"}
+
+def open_journal(path, **kwargs):
+    journal = UsageJournal(str(path), **kwargs)
+    journal.open()
+    return journal
+
+def test_segments_rotate_and_keep_write_order(tmp_path):
+    journal = open_journal(tmp_path, segment_bytes=400)
+    try:
+        for n in range(20):
+            journal.append(usage(n))
+        assert len(journal.segments()) > 1
+        assert all(os.path.getsize(path) <= 400 for path in journal.segments())
+        assert [record["input_tokens"] for record in journal.iter_records()] == list(range(20))
+    finally:
+        journal.close()
+
+def test_workers_sharing_a_directory_do_not_interleave(tmp_path):
+    journals = [open_journal(tmp_path, segment_bytes=2000) for _ in range(3)]
+
+    def write(offset, journal):
+        for n in range(offset, offset + 100, 5):
+            journal.append_many([usage(n + i) for i in range(5)])
+
+    try:
+        threads = [threading.Thread(target=write, args=(100 * i, journal)) for i, journal in enumerate(journals)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        numbers = [record["input_tokens"] for record in journals[0].iter_records()]
+        assert sorted(numbers) == list(range(300))
+        assert all(os.path.getsize(path) <= 2000 for path in journals[0].segments())
+        # Each batch of five stays contiguous
+        assert all(numbers[i + 4] == numbers[i] + 4 for i in range(0, 300, 5))
+    finally:
+        for journal in journals:
+            journal.close()
+
+def test_positions_resume_after_the_record(tmp_path):
+    journal = open_journal(tmp_path, segment_bytes=400)
+    try:
+        positions = [journal.append(usage(n)) for n in range(12)]
+        rest = [record["input_tokens"] for record in journal.iter_records(positions[4])]
+        assert rest == list(range(5, 12))
+        assert list(journal.iter_records(positions[-1])) == []
+    finally:
+        journal.close()
+
+def test_reopen_drops_torn_last_line(tmp_path):
+    journal = open_journal(tmp_path, segment_bytes=400)
+    for n in range(10):
+        journal.append(usage(n))
+    journal.close()
+    newest = journal.segments()[-1]
+    with open(newest, "ab") as f:
+        f.write(b'{"key_id": "sk-a", "timest')
+
+    journal = open_journal(tmp_path, segment_bytes=400)
+    try:
+        journal.append(usage(10))
+        with open(newest, "rb") as f:
+            assert f.read().endswith(b"}\n")
+        assert [record["input_tokens"] for record in journal.iter_records()] == list(range(11))
+    finally:
+        journal.close()
+
+def test_query_pages_through_matching_records(tmp_path):
+    journal = open_journal(tmp_path, segment_bytes=600)
+    try:
+        for n in range(30):
+            journal.append(usage(n, key_id="sk-a" if n % 2 == 0 else "sk-b"))
+        seen, cursor = [], None
+        while True:
+            page, cursor = journal.query(key_id="sk-a", after=cursor, limit=4)
+            assert len(page) <= 4
+            seen.extend(record["input_tokens"] for record in page)
+            if cursor is None:
+                break
+        assert seen == list(range(0, 30, 2))
+    finally:
+        journal.close()
+
+def test_query_filters_by_time_range_across_segments(tmp_path):
+    journal = open_journal(tmp_path, segment_bytes=600)
+    try:
+        for hour in range(12):
+            journal.append(usage(hour, timestamp=f"2025-01-01T{hour:02d}:30:00", model="gpt-4o" if hour % 3 else "claude-3-haiku"))
+        assert len(journal.segments()) > 2
+        page, cursor = journal.query(since="2025-01-01T03:00:00", until="2025-01-01T09:00:00", limit=100)
+        assert [record["input_tokens"] for record in page] == [3, 4, 5, 6, 7, 8]
+        assert cursor is None
+        page, _ = journal.query(since="2025-01-01T03:00:00", model="claude-3-haiku", limit=100)
+        assert [record["input_tokens"] for record in page] == [3, 6, 9]
+        # A range after every record matches nothing
+        assert journal.query(since="2026-01-01T00:00:00")[0] == []
+    finally:
+        journal.close()
+
+def test_query_by_key_skips_segments_without_it(tmp_path, monkeypatch):
+    journal = open_journal(tmp_path, segment_bytes=600)
+    try:
+        for n in range(20):
+            journal.append(usage(n, key_id="sk-rare" if n == 17 else "sk-a"))
+        segments = journal.segments()
+        assert len(segments) > 2
+        journal.query(key_id="sk-rare")
+        read = []
+        original = usage_log._read_segment
+        monkeypatch.setattr(usage_log, "_read_segment", lambda path, offset=0: read.append(path) or original(path, offset))
+        page, cursor = journal.query(key_id="sk-rare")
+        assert [record["input_tokens"] for record in page] == [17]
+        assert cursor is None
+        assert segments[0] not in read
+    finally:
+        journal.close()
@@ -0,0 +1,82 @@
+import asyncio
+import threading
+import time
+
+from usage_queue import UsageQueue
+
+class Sink:
+    def __init__(self, delay: float = 0.0):
+        self.records = []
+        self.threads = set()
+        self.delay = delay
+        self._lock = threading.Lock()
+
+    def __call__(self, batch):
+        time.sleep(self.delay)
+        with self._lock:
+            self.records.extend(batch)
+            self.threads.add(threading.get_ident())
+
+def test_records_are_written_in_batches():
+    async def scenario():
+        sink = Sink()
+        queue = UsageQueue(sink, batch_size=10, flush_interval=0.01)
+        queue.start()
+        for i in range(25):
+            queue.submit({"n": i})
+        await queue.stop()
+        return sink, queue.metrics()
+
+    sink, metrics = asyncio.run(scenario())
+    assert [record["n"] for record in sink.records] == list(range(25))
+    assert metrics["written"] == 25
+    assert metrics["batches"] >= 3
+
+def test_overflow_writes_run_off_the_event_loop():
+    async def scenario():
+        sink = Sink()
+        queue = UsageQueue(sink, maxsize=2, batch_size=100, flush_interval=10.0)
+        queue.start()
+        for i in range(5):
+            queue.submit({"n": i})
+        await queue.stop()
+        return sink, queue.metrics(), threading.get_ident()
+
+    sink, metrics, loop_thread = asyncio.run(scenario())
+    assert sorted(record["n"] for record in sink.records) == list(range(5))
+    assert metrics["overflow_writes"] == 3
+    assert loop_thread not in sink.threads
+
+def test_thread_submits_racing_stop_are_not_lost():
+    async def scenario():
+        sink = Sink(delay=0.001)
+        queue = UsageQueue(sink, maxsize=4, batch_size=4, flush_interval=0.001)
+        queue.start()
+        errors = []
+
+        def produce(offset):
+            for i in range(50):
+                try:
+                    queue.submit({"n": offset + i})
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=produce, args=(offset,)) for offset in (0, 1000, 2000, 3000)]
+        for thread in threads:
+            thread.start()
+        await asyncio.sleep(0.01)
+        await queue.stop()
+        await asyncio.to_thread(lambda: [thread.join() for thread in threads])
+        return sink, errors
+
+    sink, errors = asyncio.run(scenario())
+    assert not errors
+    expected = sorted(offset + i for offset in (0, 1000, 2000, 3000) for i in range(50))
+    assert sorted(record["n"] for record in sink.records) == expected
+
+def test_submit_without_running_queue_writes_directly():
+    sink = Sink()
+    queue = UsageQueue(sink)
+    queue.submit({"n": 1})
+    assert sink.records == [{"n": 1}]
+    assert queue.metrics()["queue_depth"] == 0
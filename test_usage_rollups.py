@@ -0,0 +1,53 @@
+from usage_log import UsageJournal
+from usage_rollups import UsageRollups
+
+def usage(n, timestamp="2025-01-01T00:00:00", key_id="sk-a", model="gpt-4o"):
+    return {"key_id": key_id, "timestamp": timestamp, "model": model,
+            "input_tokens": n, "output_tokens": n, "cost": 1.0, "request_id": f"req-{n}"}
+
+def test_workers_fold_the_whole_shared_journal(tmp_path):
+    first, second = UsageJournal(str(tmp_path)), UsageJournal(str(tmp_path))
+    first.open()
+    second.open()
+    try:
+        rollups = [UsageRollups(), UsageRollups()]
+        first.append_many([usage(1)])
+        rollups[0].replay(first)
+        second.append_many([usage(2, key_id="sk-b")])
+        rollups[1].replay(second)
+        first.append_many([usage(3)])
+        rollups[0].replay(first)
+        rollups[1].replay(second)
+        assert rollups[0].summary()[0] == rollups[1].summary()[0]
+        assert rollups[0].request_count == 3
+        assert rollups[0].position == rollups[1].position
+    finally:
+        first.close()
+        second.close()
+
+def test_snapshot_round_trip_reencodes_only_changed_hours(tmp_path):
+    path = str(tmp_path / "rollups.json")
+    rollups = UsageRollups(path)
+    rollups.add_many([usage(1, "2025-01-01T00:10:00"), usage(2, "2025-01-01T01:10:00")], (1, 100))
+    rollups.flush()
+    encoded = dict(rollups._hour_json)
+    rollups.add_many([usage(3, "2025-01-01T01:20:00", key_id="sk-b")], (1, 200))
+    rollups.flush()
+    assert rollups._hour_json["2025-01-01T00"] is encoded["2025-01-01T00"]
+    assert rollups._hour_json["2025-01-01T01"] != encoded["2025-01-01T01"]
+
+    loaded = UsageRollups(path)
+    loaded.load()
+    assert loaded.position == (1, 200)
+    assert loaded.summary(include_hourly=True) == rollups.summary(include_hourly=True)
+    assert loaded.summary(since_hour="2025-01-01T01")[0]["key_usage"] == {
+        "sk-a": {"cost": 1.0, "requests": 1}, "sk-b": {"cost": 1.0, "requests": 1},
+    }
+
+def test_each_process_claims_its_own_snapshot(tmp_path):
+    path = str(tmp_path / "rollups.json")
+    first, second = UsageRollups(path), UsageRollups(path)
+    first.claim_snapshot_slot()
+    second.claim_snapshot_slot()
+    assert first.path == path
+    assert second.path == f"{path}.1"
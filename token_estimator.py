@@ -0,0 +1,288 @@
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger("litellm-proxy")
+
+# Token count estimation
+#
+# Prompt sizes drive context-window routing, complexity and budget
+# reservations, so they need to be close to what the provider will bill
+# without running a real tokenizer on every request. Each character is
+# mapped to a class in one str.translate pass (bytes.translate for ASCII
+# text) and the estimate is a weighted sum of the class counts. The
+# default weights follow the usual BPE ratios (about 4-5 English
+# characters per token, roughly one token per kana and more per kanji);
+# fit them to a tokenizer with `python token_estimator.py calibrate` and
+# load the result with TOKEN_WEIGHTS_FILE. An exact tokenizer (tiktoken)
+# can be configured instead with TOKENIZER=tiktoken:<encoding>.
+#
+# Counts are cached by a digest of the text, so an entry costs the same
+# whatever the prompt size. Estimating a text costs about as much as
+# hashing it, so with the estimator texts longer than cache_max_chars
+# are counted without the cache.
+
+# Tokens per character of each class
+DEFAULT_WEIGHTS = {
+    "letter": 0.22,     # ASCII letters
+    "digit": 0.35,      # ASCII digits
+    "space": 0.25,      # ASCII whitespace (mostly word boundaries)
+    "punct": 0.5,       # ASCII punctuation and symbols
+    "kana": 0.8,        # hiragana / katakana
+    "kanji": 1.2,       # CJK ideographs
+    "hangul": 0.9,
+    "cjk_punct": 1.0,   # CJK symbols, fullwidth forms
+    "other": 0.5,       # anything else (Latin-1, Cyrillic, emoji, ...)
+}
+
+# Chat format overhead (OpenAI): tokens per message and for priming the reply
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_PRIMING_TOKENS = 3
+
+_CLASS_CODES = {
+    "letter": "a",
+    "digit": "d",
+    "space": "s",
+    "punct": "p",
+    "kana": "k",
+    "kanji": "h",
+    "hangul": "g",
+    "cjk_punct": "f",
+    "other": "o",
+}
+
+_CLASS_RANGES = {
+    "kana": [(0x3040, 0x30FF), (0x31F0, 0x31FF), (0xFF66, 0xFF9F)],
+    "kanji": [(0x3400, 0x4DBF), (0x4E00, 0x9FFF), (0xF900, 0xFAFF)],
+    "hangul": [(0x1100, 0x11FF), (0x3130, 0x318F), (0xAC00, 0xD7AF)],
+    "cjk_punct": [(0x3000, 0x303F), (0xFF00, 0xFF65), (0xFFA0, 0xFFEF)],
+}
+
+def _build_tables():
+    ascii_table = bytearray(b"o" * 256)
+    for byte in range(128):
+        char = chr(byte)
+        if char.isalpha():
+            code = "a"
+        elif char.isdigit():
+            code = "d"
+        elif char.isspace():
+            code = "s"
+        else:
+            code = "p"
+        ascii_table[byte] = ord(code)
+
+    # Code points past the end of the table are left untranslated and
+    # counted as "other"
+    table = ["o"] * 0x10000
+    for byte in range(128):
+        table[byte] = chr(ascii_table[byte])
+    for name, ranges in _CLASS_RANGES.items():
+        for start, end in ranges:
+            for codepoint in range(start, end + 1):
+                table[codepoint] = _CLASS_CODES[name]
+    return bytes(ascii_table), "".join(table)
+
+_ASCII_TABLE, _UNICODE_TABLE = _build_tables()
+
+def count_classes(text: str) -> Dict[str, int]:
+    """Number of characters of each class in text"""
+    if text.isascii():
+        classified = text.encode("ascii").translate(_ASCII_TABLE)
+        counts = {name: classified.count(code.encode()) for name, code in _CLASS_CODES.items() if name in ("letter", "digit", "space", "punct")}
+        counts.update(kana=0, kanji=0, hangul=0, cjk_punct=0, other=0)
+        return counts
+    classified = text.translate(_UNICODE_TABLE)
+    counts = {name: classified.count(code) for name, code in _CLASS_CODES.items() if name != "other"}
+    counts["other"] = len(text) - sum(counts.values())
+    return counts
+
+def load_exact_tokenizer(spec: str) -> Optional[Callable[[str], int]]:
+    """Token counter for a TOKENIZER spec ("tiktoken:<encoding>"), or None for the estimator"""
+    if not spec:
+        return None
+    kind, _, name = spec.partition(":")
+    if kind != "tiktoken":
+        raise ValueError(f"Unsupported TOKENIZER: {spec}")
+    try:
+        import tiktoken
+    except ImportError:
+        logger.warning("TOKENIZER is set but tiktoken is not installed; using the token estimator")
+        return None
+    encoding = tiktoken.get_encoding(name or "cl100k_base")
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+def load_weights(path: str) -> Optional[Dict[str, float]]:
+    """Class weights from a JSON file written by `calibrate` (None if path is empty)"""
+    if not path:
+        return None
+    with open(path, "r") as f:
+        weights = json.load(f)
+    if not isinstance(weights, dict):
+        raise ValueError(f"{path}: expected an object of class weights")
+    unknown = set(weights) - set(DEFAULT_WEIGHTS)
+    if unknown:
+        raise ValueError(f"{path}: unknown character classes {sorted(unknown)}")
+    return {name: float(weight) for name, weight in weights.items()}
+
+class TokenEstimator:
+    def __init__(self, weights: Optional[Dict[str, float]] = None, exact: Optional[Callable[[str], int]] = None,
+                 cache_size: int = 4096, cache_max_chars: int = 4096):
+        self.weights = dict(DEFAULT_WEIGHTS)
+        if weights:
+            self.weights.update(weights)
+        self.exact = exact
+        self.cache_size = cache_size
+        # Longest text the estimator caches (the exact tokenizer caches any text)
+        self.cache_max_chars = cache_max_chars
+        self._cache: "OrderedDict[bytes, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "uncached": 0}
+
+    def estimate(self, text: str) -> int:
+        """Character-class estimate, without the cache or exact tokenizer"""
+        if not text:
+            return 0
+        weights = self.weights
+        total = sum(weights[name] * count for name, count in count_classes(text).items() if count)
+        return max(1, math.ceil(total))
+
+    def count(self, text: str) -> int:
+        """Tokens in text (cached)"""
+        if not text:
+            return 0
+        if self.cache_size <= 0 or (self.exact is None and len(text) > self.cache_max_chars):
+            with self._lock:
+                self.stats["uncached"] += 1
+            return self.exact(text) if self.exact is not None else self.estimate(text)
+        key = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        with self._lock:
+            tokens = self._cache.get(key)
+            if tokens is not None:
+                self._cache.move_to_end(key)
+                self.stats["hits"] += 1
+                return tokens
+            self.stats["misses"] += 1
+        tokens = self.exact(text) if self.exact is not None else self.estimate(text)
+        with self._lock:
+            self._cache[key] = tokens
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return tokens
+
+    def count_messages(self, messages: Iterable[Dict[str, Any]]) -> int:
+        """Prompt tokens of a chat request, including the chat format overhead"""
+        tokens = REPLY_PRIMING_TOKENS
+        for message in messages or []:
+            tokens += MESSAGE_OVERHEAD_TOKENS
+            content = message.get("content")
+            if isinstance(content, str):
+                tokens += self.count(content)
+            elif isinstance(content, list):
+                tokens += sum(self.count(part.get("text", "")) for part in content if isinstance(part, dict))
+        return tokens
+
+    def calibrate(self, texts: List[str], exact: Callable[[str], int]) -> Dict[str, float]:
+        """Fit the class weights to an exact tokenizer by least squares and use them"""
+        names = list(DEFAULT_WEIGHTS)
+        rows = [count_classes(text) for text in texts if text]
+        targets = [exact(text) for text in texts if text]
+        # Normal equations (X^T X) w = X^T y, solved by Gaussian elimination
+        size = len(names)
+        matrix = [[sum(row[a] * row[b] for row in rows) for b in names] for a in names]
+        vector = [sum(row[a] * target for row, target in zip(rows, targets)) for a in names]
+        # A slight pull towards the current weights keeps the system solvable when the corpus
+        # cannot tell classes apart; classes absent from it keep their current weight
+        ridge = 1e-6 * max([1.0] + [matrix[i][i] for i in range(size)])
+        for i in range(size):
+            matrix[i][i] += ridge
+            vector[i] += ridge * self.weights[names[i]]
+        for col in range(size):
+            pivot = max(range(col, size), key=lambda row: abs(matrix[row][col]))
+            matrix[col], matrix[pivot] = matrix[pivot], matrix[col]
+            vector[col], vector[pivot] = vector[pivot], vector[col]
+            for row in range(size):
+                if row != col and matrix[row][col]:
+                    factor = matrix[row][col] / matrix[col][col]
+                    matrix[row] = [a - factor * b for a, b in zip(matrix[row], matrix[col])]
+                    vector[row] -= factor * vector[col]
+        weights = {name: round(max(0.0, vector[i] / matrix[i][i]), 3) for i, name in enumerate(names)}
+        self.weights = weights
+        with self._lock:
+            self._cache.clear()
+        return weights
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            metrics = dict(self.stats)
+            metrics["size"] = len(self._cache)
+        metrics["exact"] = self.exact is not None
+        metrics["weights"] = dict(self.weights)
+        return metrics
+
+# Shared estimator (TOKENIZER=tiktoken:cl100k_base for exact counts,
+# TOKEN_WEIGHTS_FILE for weights fitted with `calibrate`)
+token_estimator = TokenEstimator(
+    weights=load_weights(os.environ.get("TOKEN_WEIGHTS_FILE", "")),
+    exact=load_exact_tokenizer(os.environ.get("TOKENIZER", "")),
+    cache_size=int(os.environ.get("TOKEN_CACHE_SIZE", 4096)),
+    cache_max_chars=int(os.environ.get("TOKEN_CACHE_MAX_CHARS", 4096)),
+)
+
+def _corpus_texts(path: str) -> List[str]:
+    # One JSON object per line with a "text" field or chat "messages"
+    texts = []
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "text" in record:
+                texts.append(record["text"])
+            for message in record.get("messages") or []:
+                if isinstance(message.get("content"), str):
+                    texts.append(message["content"])
+    return texts
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Token count estimation tools")
+    parser.add_argument("--tokenizer", type=str, default=os.environ.get("TOKENIZER") or "tiktoken:cl100k_base",
+                        help="Exact tokenizer to compare with (tiktoken:<encoding>)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    calibrate_parser = subparsers.add_parser("calibrate", help="Fit class weights to the exact tokenizer")
+    calibrate_parser.add_argument("corpus", help="JSONL file with text or messages per line")
+    calibrate_parser.add_argument("--output", type=str, help="Write the weights to this file (for TOKEN_WEIGHTS_FILE)")
+    compare_parser = subparsers.add_parser("compare", help="Compare estimates with the exact tokenizer")
+    compare_parser.add_argument("corpus", help="JSONL file with text or messages per line")
+    compare_parser.add_argument("--weights", type=str, default=os.environ.get("TOKEN_WEIGHTS_FILE", ""),
+                                help="Weights file to evaluate (default: TOKEN_WEIGHTS_FILE, or the built-in weights)")
+
+    args = parser.parse_args()
+    exact = load_exact_tokenizer(args.tokenizer)
+    if exact is None:
+        parser.error("an exact tokenizer is required (pip install tiktoken)")
+    texts = _corpus_texts(args.corpus)
+    estimator = TokenEstimator(cache_size=0)
+
+    if args.command == "calibrate":
+        weights = estimator.calibrate(texts, exact)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(weights, f, indent=2)
+        print(json.dumps(weights, indent=2))
+    elif args.command == "compare":
+        estimator = TokenEstimator(weights=load_weights(args.weights), cache_size=0)
+        errors = sorted(abs(estimator.estimate(text) - exact(text)) / max(1, exact(text)) for text in texts if text)
+        print(json.dumps({
+            "texts": len(errors),
+            "mean_relative_error": sum(errors) / len(errors) if errors else 0.0,
+            "p90_relative_error": errors[int(len(errors) * 0.9)] if errors else 0.0,
+        }, indent=2))
@@ -0,0 +1,260 @@
+import asyncio
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger("litellm-proxy")
+
+SEGMENT_PATTERN = re.compile(r"^usage-(\d{6})\.jsonl$")
+LOCK_FILE = "journal.lock"
+
+# (segment number, byte offset) just past a record in the journal
+JournalPosition = Tuple[int, int]
+
+# Append-only usage journal
+#
+# Usage records are appended as JSON lines to numbered segment files
+# (usage-000001.jsonl, usage-000002.jsonl, ...). A new segment is started
+# once the current one reaches segment_bytes. Writes are flushed to the OS
+# immediately and fsync'ed in batches, so a crash loses at most the last
+# unsynced batch and never corrupts earlier records.
+#
+# Several worker processes may share one journal directory. Every append
+# batch (and the torn-line repair on open) runs under an exclusive flock
+# on the directory's journal.lock, so batches never interleave. Under the
+# lock a writer first moves to the newest segment if another worker has
+# rotated, and takes the segment size from the file rather than from its
+# own count, so only one worker rotates and all of them append to the
+# same segment. One shared journal (instead of a directory per worker)
+# keeps a single write order that positions and rollups can follow.
+class UsageJournal:
+    def __init__(self, directory: str, segment_bytes: int = 16 * 1024 * 1024,
+                 fsync_batch: int = 32, fsync_interval: float = 1.0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self._file = None
+        self._segment = 0
+        self._size = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        # Rotated (immutable) segments: number -> ((min, max) timestamp or None, key_ids)
+        self._segment_index: Dict[int, Tuple[Optional[Tuple[str, str]], FrozenSet[str]]] = {}
+
+    def open(self):
+        """Open the newest segment for appending, repairing a torn last line"""
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            self._lock_file = open(os.path.join(self.directory, LOCK_FILE), "a")
+            with self._exclusive():
+                segments = self._segment_numbers()
+                self._segment = segments[-1] if segments else 1
+                path = self._segment_path(self._segment)
+                _truncate_partial_line(path)
+                self._file = open(path, "ab")
+                self._size = self._file.tell()
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._sync_locked()
+            self._file.close()
+            self._file = None
+            self._lock_file.close()
+            self._lock_file = None
+
+    @contextlib.contextmanager
+    def _exclusive(self):
+        # Cross-process lock held while appending (threads are serialized by self._lock)
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def append(self, record: Dict) -> JournalPosition:
+        return self.append_many([record])
+
+    def append_many(self, records: Iterable[Dict]) -> JournalPosition:
+        """Append records to the current segment, rotating and syncing as needed
+
+        Returns the journal position just past the last appended record.
+        """
+        lines = [(json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8") for record in records]
+        with self._lock, self._exclusive():
+            # Follow rotations done by other workers and count their appends
+            while os.path.exists(self._segment_path(self._segment + 1)):
+                self._switch_locked(self._segment + 1)
+            self._size = os.fstat(self._file.fileno()).st_size
+            for line in lines:
+                if self._size and self._size + len(line) > self.segment_bytes:
+                    self._rotate_locked()
+                self._file.write(line)
+                self._size += len(line)
+                self._unsynced += 1
+            self._file.flush()
+            if self._unsynced >= self.fsync_batch or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync_locked()
+            return (self._segment, self._size)
+
+    def sync(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync_locked()
+
+    async def run_syncer(self):
+        """Background task that fsyncs pending records every fsync_interval seconds"""
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            if self._unsynced:
+                try:
+                    await asyncio.to_thread(self.sync)
+                except Exception as e:
+                    logger.error(f"Usage journal sync failed: {str(e)}")
+
+    def segments(self) -> List[str]:
+        return [self._segment_path(number) for number in self._segment_numbers()]
+
+    def iter_records(self, start: Optional[JournalPosition] = None) -> Iterator[Dict]:
+        """Yield records in write order, optionally only those after start"""
+        for record, _ in self.iter_records_with_position(start):
+            yield record
+
+    def iter_records_with_position(self, start: Optional[JournalPosition] = None) -> Iterator[Tuple[Dict, JournalPosition]]:
+        """Yield (record, position just past the record) pairs in write order"""
+        start_segment, start_offset = start or (0, 0)
+        for number in self._segment_numbers():
+            if number < start_segment:
+                continue
+            offset = start_offset if number == start_segment else 0
+            for record, end in _read_segment(self._segment_path(number), offset):
+                yield record, (number, end)
+
+    def query(self, since: Optional[str] = None, until: Optional[str] = None,
+              key_id: Optional[str] = None, model: Optional[str] = None,
+              after: Optional[JournalPosition] = None, limit: int = 100) -> Tuple[List[Dict], Optional[JournalPosition]]:
+        """Return up to limit matching records in write order
+
+        since/until are ISO timestamps (since inclusive, until exclusive).
+        Rotated segments whose timestamp range lies outside [since, until),
+        or that hold no record of key_id, are skipped without being read.
+        Returns the records and the position to resume from, or None when
+        the scan is complete.
+        """
+        records = []
+        after_segment, after_offset = after or (0, 0)
+        for number in self._segment_numbers():
+            if number < after_segment:
+                continue
+            if (since or until or key_id) and number < self._segment:
+                bounds, key_ids = self._rotated_segment_index(number)
+                if bounds is None or (since and bounds[1] < since) or (until and bounds[0] >= until):
+                    continue
+                if key_id and key_id not in key_ids:
+                    continue
+            offset = after_offset if number == after_segment else 0
+            for record, end in _read_segment(self._segment_path(number), offset):
+                if key_id and record["key_id"] != key_id:
+                    continue
+                if model and record["model"] != model:
+                    continue
+                if (since and record["timestamp"] < since) or (until and record["timestamp"] >= until):
+                    continue
+                records.append(record)
+                if len(records) >= limit:
+                    return records, (number, end)
+        return records, None
+
+    def _rotated_segment_index(self, number: int) -> Tuple[Optional[Tuple[str, str]], FrozenSet[str]]:
+        # Computed on first use; rotated segments never change
+        if number not in self._segment_index:
+            timestamps = []
+            key_ids = set()
+            for record, _ in _read_segment(self._segment_path(number)):
+                timestamps.append(record["timestamp"])
+                key_ids.add(record["key_id"])
+            bounds = (min(timestamps), max(timestamps)) if timestamps else None
+            self._segment_index[number] = (bounds, frozenset(key_ids))
+        return self._segment_index[number]
+
+    def _switch_locked(self, number: int):
+        self._sync_locked()
+        self._file.close()
+        self._segment = number
+        self._file = open(self._segment_path(number), "ab")
+        self._size = self._file.tell()
+
+    def _rotate_locked(self):
+        self._switch_locked(self._segment + 1)
+        _fsync_directory(self.directory)
+        logger.info(f"Usage journal rotated to segment {self._segment}")
+
+    def _sync_locked(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _segment_numbers(self) -> List[int]:
+        numbers = []
+        for name in os.listdir(self.directory):
+            match = SEGMENT_PATTERN.match(name)
+            if match:
+                numbers.append(int(match.group(1)))
+        return sorted(numbers)
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.directory, f"usage-{number:06d}.jsonl")
+
+def _read_segment(path: str, offset: int = 0) -> Iterator[Tuple[Dict, int]]:
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                # Torn write from a crash; the record was never acknowledged
+                break
+            offset += len(line)
+            yield json.loads(line), offset
+
+def _truncate_partial_line(path: str):
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return
+        # Walk back to the last complete record
+        position = size
+        while position > 0:
+            step = min(4096, position)
+            position -= step
+            f.seek(position)
+            chunk = f.read(step)
+            newline = chunk.rfind(b"\n")
+            if newline != -1:
+                f.truncate(position + newline + 1)
+                return
+        f.truncate(0)
+
+def _fsync_directory(directory: str):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger("litellm-proxy")
+
+# Batched usage accounting queue
+#
+# Completion callbacks only enqueue usage records; a single writer task
+# drains the bounded queue in batches and hands each batch to the writer
+# function off the event loop. A batch is written as soon as it reaches
+# batch_size or flush_interval seconds after its first record arrived.
+#
+# Backpressure: callers on other threads block until there is room in the
+# queue. Callers on the event loop cannot block, so when the queue is full
+# their record is written by a worker thread and counted as an overflow
+# write.
+#
+# Shutdown: stop() marks the queue as closing under a lock, waits for the
+# enqueues and overflow writes already under way, then drains the queue.
+# Records submitted once it is closing are written directly by the caller.
+class UsageQueue:
+    def __init__(self, writer: Callable[[List[Dict]], None], maxsize: int = 10000,
+                 batch_size: int = 256, flush_interval: float = 0.5):
+        self._writer = writer
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: Optional[asyncio.Queue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        # Guards _closing and _queue, and the in-flight enqueues and overflow writes
+        self._lock = threading.RLock()
+        self._pending: set = set()
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            "submitted": 0,
+            "written": 0,
+            "batches": 0,
+            "overflow_writes": 0,
+            "blocked_submits": 0,
+            "write_errors": 0,
+            "max_queue_depth": 0,
+            "last_batch_size": 0,
+            "last_write_seconds": 0.0,
+        }
+
+    def start(self):
+        """Start the writer task on the running event loop"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._loop = loop
+            self._queue = asyncio.Queue(maxsize=self.maxsize)
+            self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    def submit(self, record: Dict):
+        """Enqueue a usage record from any thread"""
+        self._count("submitted")
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        with self._lock:
+            if self._queue is None or self._closing:
+                # Not running (startup/shutdown or offline use): write directly
+                future = None
+            elif running_loop is self._loop:
+                try:
+                    self._queue.put_nowait(record)
+                    self._track_depth()
+                    return
+                except asyncio.QueueFull:
+                    # The event loop cannot block or write: hand the record to a worker thread
+                    self._count("overflow_writes")
+                    future = self._loop.run_in_executor(None, self._write, [record])
+                    self._track(future)
+                    return
+            else:
+                # Called from a worker thread: block this thread while the queue is full
+                if self._queue.full():
+                    self._count("blocked_submits")
+                future = asyncio.run_coroutine_threadsafe(self._put(record), self._loop)
+                self._track(future)
+        if future is None:
+            self._write([record])
+        else:
+            future.result()
+
+    async def _put(self, record: Dict):
+        await self._queue.put(record)
+        self._track_depth()
+
+    def _track(self, future):
+        # Caller holds _lock; stop() waits for every tracked future
+        self._pending.add(future)
+        future.add_done_callback(self._untrack)
+
+    def _untrack(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    async def stop(self):
+        """Stop accepting records and drain everything still queued"""
+        if self._task is None:
+            return
+        with self._lock:
+            self._closing = True
+            pending = list(self._pending)
+        # Enqueues and overflow writes that started before closing finish first
+        for future in pending:
+            try:
+                await asyncio.wrap_future(future)
+            except Exception as e:
+                logger.error(f"Usage record lost during shutdown: {str(e)}")
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        with self._lock:
+            self._queue = None
+
+    def metrics(self) -> Dict:
+        with self._stats_lock:
+            metrics = dict(self.stats)
+        queue = self._queue
+        metrics["queue_depth"] = queue.qsize() if queue is not None else 0
+        metrics["queue_capacity"] = self.maxsize
+        return metrics
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            if first is None:
+                break
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    record = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if record is None:
+                    stopping = True
+                    break
+                batch.append(record)
+            await asyncio.to_thread(self._write, batch)
+
+        # Drain whatever arrived before the stop marker was processed
+        remaining = []
+        while not self._queue.empty():
+            record = self._queue.get_nowait()
+            if record is not None:
+                remaining.append(record)
+        for start in range(0, len(remaining), self.batch_size):
+            await asyncio.to_thread(self._write, remaining[start:start + self.batch_size])
+
+    def _write(self, batch: List[Dict]):
+        started = time.perf_counter()
+        try:
+            self._writer(batch)
+        except Exception as e:
+            self._count("write_errors")
+            logger.error(f"Usage batch write failed ({len(batch)} records): {str(e)}")
+            return
+        elapsed = time.perf_counter() - started
+        with self._stats_lock:
+            self.stats["written"] += len(batch)
+            self.stats["batches"] += 1
+            self.stats["last_batch_size"] = len(batch)
+            self.stats["last_write_seconds"] = elapsed
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def _track_depth(self):
+        depth = self._queue.qsize()
+        with self._stats_lock:
+            if depth > self.stats["max_queue_depth"]:
+                self.stats["max_queue_depth"] = depth
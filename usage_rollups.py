@@ -0,0 +1,353 @@
+import argparse
+import asyncio
+import bisect
+import copy
+import fcntl
+import json
+import logging
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from usage_log import JournalPosition, UsageJournal
+
+logger = logging.getLogger("litellm-proxy")
+
+# Bump when the snapshot layout changes; older snapshots are rebuilt from the journal
+SNAPSHOT_VERSION = 2
+
+# Incrementally maintained usage rollups
+#
+# Every usage record updates running totals per key, per model, per
+# key/model pair and per hour, so /api/usage never rescans the journal.
+# Hourly buckets also keep a key/model breakdown so time-range queries
+# only visit the hours inside the requested range.
+# The rollups are snapshotted together with the journal position they
+# cover; on startup only the journal tail after that position is replayed.
+#
+# Workers sharing a journal each fold it in order by replaying its tail
+# (rather than only the records they wrote), so every worker's rollups
+# and snapshot cover the same prefix of the journal. Each worker writes
+# its own snapshot file (claim_snapshot_slot), and the serialized hourly
+# detail is cached per hour so a flush only re-encodes the hours that
+# changed since the last one.
+class UsageRollups:
+    def __init__(self, path: Optional[str] = None, flush_interval: float = 5.0):
+        self.path = path
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._slot_lock = None
+        self._reset()
+
+    def _reset(self):
+        self.total_cost = 0.0
+        self.request_count = 0
+        self.key_usage: Dict[str, Dict] = {}
+        self.model_usage: Dict[str, Dict] = {}
+        self.key_model_usage: Dict[str, Dict[str, Dict]] = {}
+        self.hourly_usage: Dict[str, Dict] = {}
+        # hour -> key -> model -> [cost, requests]
+        self.hourly_detail: Dict[str, Dict[str, Dict[str, List]]] = {}
+        self.position: Optional[JournalPosition] = None
+        self._hours: List[str] = []
+        self._keys: List[str] = []
+        # hour -> JSON of hourly_detail[hour] as last flushed, and the hours changed since
+        self._hour_json: Dict[str, str] = {}
+        self._dirty_hours: Set[str] = set()
+
+    def add(self, record: Dict, position: Optional[JournalPosition] = None):
+        """Fold a single usage record into the rollups"""
+        with self._lock:
+            self._add_locked(record, position)
+            self._dirty = True
+
+    def add_many(self, records: Iterable[Dict], position: Optional[JournalPosition] = None):
+        """Fold a batch of records; position is the journal position after the batch"""
+        with self._lock:
+            for record in records:
+                self._add_locked(record, None)
+            if position is not None:
+                self.position = position
+            self._dirty = True
+
+    def _add_locked(self, record: Dict, position: Optional[JournalPosition]):
+        cost = record["cost"]
+        key = record["key_id"]
+        model = record["model"]
+        hour = record["timestamp"][:13]
+
+        if key not in self.key_usage:
+            bisect.insort(self._keys, key)
+        if hour not in self.hourly_usage:
+            bisect.insort(self._hours, hour)
+
+        self.total_cost += cost
+        self.request_count += 1
+        _bump(self.key_usage.setdefault(key, _empty()), cost)
+        _bump(self.model_usage.setdefault(model, _empty()), cost)
+        _bump(self.key_model_usage.setdefault(key, {}).setdefault(model, _empty()), cost)
+        _bump(self.hourly_usage.setdefault(hour, _empty()), cost)
+        cell = self.hourly_detail.setdefault(hour, {}).setdefault(key, {}).setdefault(model, [0.0, 0])
+        cell[0] += cost
+        cell[1] += 1
+        self._dirty_hours.add(hour)
+
+        if position is not None:
+            self.position = position
+
+    def replay(self, journal: UsageJournal) -> int:
+        """Apply journal records written after the snapshot position"""
+        count = 0
+        with self._lock:
+            for record, position in journal.iter_records_with_position(self.position):
+                self._add_locked(record, position)
+                count += 1
+            if count:
+                self._dirty = True
+        return count
+
+    def rebuild(self, journal: UsageJournal) -> int:
+        """Recompute all rollups from the raw journal"""
+        with self._lock:
+            self._reset()
+        return self.replay(journal)
+
+    def summary(self, key_id: Optional[str] = None, include_hourly: bool = False,
+                since_hour: Optional[str] = None, until_hour: Optional[str] = None,
+                model: Optional[str] = None, after_key: Optional[str] = None,
+                limit: Optional[int] = None) -> Tuple[Dict, Optional[str]]:
+        """Build the /api/usage response from the rollups
+
+        since_hour/until_hour select hourly buckets ("YYYY-MM-DDTHH",
+        since inclusive, until exclusive). Without key_id, key_usage is
+        paginated by key: limit entries after after_key. Returns the
+        response and the last key of the page when more keys follow.
+        """
+        with self._lock:
+            if since_hour or until_hour:
+                key_models = self._range_key_models(since_hour, until_hour, key_id, model)
+            elif model or key_id:
+                key_models = self._filtered_key_models(key_id, model)
+            else:
+                key_models = None
+
+            if key_id:
+                model_usage = key_models.get(key_id, {})
+                result = {
+                    "key_id": key_id,
+                    "total_cost": sum(totals["cost"] for totals in model_usage.values()),
+                    "model_usage": model_usage,
+                    "request_count": sum(totals["requests"] for totals in model_usage.values())
+                }
+                return result, None
+
+            if key_models is None:
+                # Unfiltered: answer straight from the running totals
+                total_cost = self.total_cost
+                request_count = self.request_count
+                model_usage = copy.deepcopy(self.model_usage)
+                keys = self._keys
+                key_usage_of = lambda key: dict(self.key_usage[key])
+            else:
+                model_usage = {}
+                for models in key_models.values():
+                    for name, totals in models.items():
+                        _merge(model_usage.setdefault(name, _empty()), totals)
+                total_cost = sum(totals["cost"] for totals in model_usage.values())
+                request_count = sum(totals["requests"] for totals in model_usage.values())
+                keys = sorted(key_models)
+                key_usage_of = lambda key: _sum_models(key_models[key])
+
+            start = bisect.bisect_right(keys, after_key) if after_key else 0
+            end = len(keys) if limit is None else min(len(keys), start + limit)
+            next_key = keys[end - 1] if end < len(keys) and end > start else None
+
+            result = {
+                "total_cost": total_cost,
+                "key_usage": {key: key_usage_of(key) for key in keys[start:end]},
+                "model_usage": model_usage,
+                "request_count": request_count
+            }
+            if include_hourly:
+                result["hourly_usage"] = self._hourly_range(since_hour, until_hour)
+            return result, next_key
+
+    def _hour_slice(self, since_hour: Optional[str], until_hour: Optional[str]) -> List[str]:
+        start = bisect.bisect_left(self._hours, since_hour) if since_hour else 0
+        end = bisect.bisect_left(self._hours, until_hour) if until_hour else len(self._hours)
+        return self._hours[start:end]
+
+    def _hourly_range(self, since_hour: Optional[str], until_hour: Optional[str]) -> Dict:
+        return {hour: dict(self.hourly_usage[hour]) for hour in self._hour_slice(since_hour, until_hour)}
+
+    def _range_key_models(self, since_hour, until_hour, key_id, model) -> Dict[str, Dict[str, Dict]]:
+        key_models: Dict[str, Dict[str, Dict]] = {}
+        for hour in self._hour_slice(since_hour, until_hour):
+            detail = self.hourly_detail[hour]
+            keys = [key_id] if key_id else detail.keys()
+            for key in keys:
+                for name, (cost, requests) in detail.get(key, {}).items():
+                    if model and name != model:
+                        continue
+                    totals = key_models.setdefault(key, {}).setdefault(name, _empty())
+                    totals["cost"] += cost
+                    totals["requests"] += requests
+        return key_models
+
+    def _filtered_key_models(self, key_id, model) -> Dict[str, Dict[str, Dict]]:
+        keys = [key_id] if key_id else self._keys
+        key_models = {}
+        for key in keys:
+            models = self.key_model_usage.get(key, {})
+            if model:
+                models = {model: models[model]} if model in models else {}
+            key_models[key] = copy.deepcopy(models)
+        return key_models
+
+    def claim_snapshot_slot(self, slots: int = 64):
+        """Switch path to a snapshot file no other running process uses
+
+        Slot 0 is path itself, slot n is "<path>.n". The slot stays taken
+        (an flock on "<snapshot>.lock") until the process exits, so a
+        restarted worker picks up a snapshot a previous worker left behind.
+        """
+        if not self.path or self._slot_lock is not None:
+            return
+        for slot in range(slots):
+            candidate = self.path if slot == 0 else f"{self.path}.{slot}"
+            lock_file = open(f"{candidate}.lock", "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            self.path = candidate
+            self._slot_lock = lock_file
+            return
+        raise RuntimeError(f"No free usage rollups snapshot slot next to {self.path}")
+
+    def load(self):
+        """Load the last snapshot, if any"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except json.JSONDecodeError:
+            logger.warning(f"Ignoring unreadable usage rollups snapshot: {self.path}")
+            return
+        if data.get("version") != SNAPSHOT_VERSION:
+            logger.info("Usage rollups snapshot is outdated; rebuilding from the journal")
+            return
+        with self._lock:
+            self.total_cost = data["total_cost"]
+            self.request_count = data["request_count"]
+            self.key_usage = data["key_usage"]
+            self.model_usage = data["model_usage"]
+            self.key_model_usage = data["key_model_usage"]
+            self.hourly_usage = data["hourly_usage"]
+            self.hourly_detail = data["hourly_detail"]
+            self.position = tuple(data["position"]) if data.get("position") else None
+            self._hours = sorted(self.hourly_usage)
+            self._keys = sorted(self.key_usage)
+            self._hour_json = {}
+            self._dirty_hours = set(self.hourly_detail)
+            self._dirty = False
+
+    def flush(self):
+        """Write a snapshot if the rollups changed since the last flush
+
+        Only the hours changed since the last flush are encoded again; the
+        others reuse their cached JSON.
+        """
+        if not self.path or not self._dirty:
+            return
+        with self._lock:
+            self._dirty = False
+            for hour in self._dirty_hours:
+                self._hour_json[hour] = json.dumps(self.hourly_detail[hour], separators=(",", ":"))
+            self._dirty_hours.clear()
+            head = json.dumps({
+                "version": SNAPSHOT_VERSION,
+                "total_cost": self.total_cost,
+                "request_count": self.request_count,
+                "key_usage": self.key_usage,
+                "model_usage": self.model_usage,
+                "key_model_usage": self.key_model_usage,
+                "hourly_usage": self.hourly_usage,
+                "position": self.position,
+            }, separators=(",", ":"))
+            hours = [(hour, self._hour_json[hour]) for hour in self._hours if hour in self._hour_json]
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(head[:-1])
+            f.write(',"hourly_detail":{')
+            f.write(",".join(f"{json.dumps(hour)}:{detail}" for hour, detail in hours))
+            f.write("}}")
+        os.replace(tmp_path, self.path)
+
+    async def run_flusher(self, journal: Optional[UsageJournal] = None):
+        """Background task that snapshots the rollups every flush_interval seconds
+
+        With a journal, records other workers appended are folded in first.
+        """
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                if journal is not None:
+                    await asyncio.to_thread(self.replay, journal)
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                self._dirty = True
+                logger.error(f"Usage rollups flush failed: {str(e)}")
+
+def _empty():
+    return {"cost": 0.0, "requests": 0}
+
+def _bump(totals: Dict, cost: float):
+    totals["cost"] += cost
+    totals["requests"] += 1
+
+def _merge(totals: Dict, other: Dict):
+    totals["cost"] += other["cost"]
+    totals["requests"] += other["requests"]
+
+def _sum_models(models: Dict[str, Dict]) -> Dict:
+    totals = _empty()
+    for model_totals in models.values():
+        _merge(totals, model_totals)
+    return totals
+
+def rebuild_snapshot(journal, output: str) -> UsageRollups:
+    """Recompute the rollups snapshot from a raw usage journal"""
+    rollups = UsageRollups(output)
+    count = rollups.rebuild(journal)
+    rollups.flush()
+    logger.info(f"Rebuilt usage rollups from {count} records into {output}")
+    return rollups
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Manage usage rollups")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = subparsers.add_parser("rebuild", help="Recompute rollups from the raw usage journal")
+    rebuild_parser.add_argument("--usage-dir", type=str, default=os.environ.get("USAGE_LOG_DIR", "/app/data/usage"), help="Usage journal directory")
+    rebuild_parser.add_argument("--db", type=str, default=None, help="Rebuild from a SQLite store instead of a journal directory")
+    rebuild_parser.add_argument("--output", type=str, default=None, help="Snapshot path (default: <usage-dir>/rollups.json or <db>.rollups.json)")
+
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        if args.db:
+            from sqlite_store import SQLiteStore, SQLiteUsageJournal
+
+            journal = SQLiteUsageJournal(SQLiteStore(args.db, pool_size=1))
+            journal.open()
+            try:
+                rebuild_snapshot(journal, args.output or f"{args.db}.rollups.json")
+            finally:
+                journal.close()
+        else:
+            rebuild_snapshot(UsageJournal(args.usage_dir), args.output or os.path.join(args.usage_dir, "rollups.json"))